@@ -0,0 +1,446 @@
+"""
+标注工具热点路径的离屏性能基准。
+
+在 QT_QPA_PLATFORM=offscreen 下用合成的图像和蒙版驱动 ImageLabel 与 SegmentationTool，
+统计每项操作的 p50/p95 延迟和进程峰值内存，结果写入 JSON。每种图像尺寸在独立的子进程中运行，
+因此峰值内存互不影响。
+
+另外 --leases 用多个进程模拟共享同一文件夹的标注员，验证租约分配下没有重复标注或丢失的图像，
+分别给出吞吐量随标注员人数的变化和一名标注员崩溃后的恢复时间。--preannotate 用内置的 stub 模型
+测量模型预标注流水线在不同批大小下的吞吐量和第一张建议的等待时间。
+
+用法:
+    python bench.py --sizes 1 4 16 --output bench.json
+    python bench.py --compare baseline.json --threshold 0.15
+    python bench.py --leases 1 2 4 8 --lease-images 200
+    python bench.py --preannotate 1 4 8 --preannotate-images 64
+"""
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import argparse
+import json
+import multiprocessing
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage, QPainter, QColor, QLinearGradient, QMouseEvent, QWheelEvent
+from PyQt5.QtCore import Qt, QEvent, QPoint, QPointF, QT_VERSION_STR
+
+import main
+
+DEFAULT_SIZES = (1, 4, 16, 100)
+
+
+def peak_rss_mb():
+    """进程峰值常驻内存（MB），平台不支持时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def make_dataset(root, megapixels, count=3):
+    """生成 count 张约 megapixels 百万像素（4:3）的合成图像及带有若干椭圆的蒙版"""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    os.makedirs(os.path.join(root, 'images'))
+    os.makedirs(os.path.join(root, 'masks'))
+    for i in range(count):
+        image = QImage(width, height, QImage.Format_RGB32)
+        painter = QPainter(image)
+        gradient = QLinearGradient(0, 0, width, height)
+        gradient.setColorAt(0, QColor(30 + 40 * i, 60, 160))
+        gradient.setColorAt(1, QColor(220, 200 - 40 * i, 60))
+        painter.fillRect(image.rect(), gradient)
+        painter.end()
+        image.save(os.path.join(root, 'images', f"bench_{i}.jpg"), 'JPG', 90)
+
+        mask = QImage(width, height, QImage.Format_Grayscale8)
+        mask.fill(0)
+        painter = QPainter(mask)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor(255, 255, 255))
+        for k in range(8):
+            painter.drawEllipse(QPointF(width * (k + 1) / 9, height * (0.3 + 0.05 * k)), width / 20, height / 15)
+        painter.end()
+        mask.save(os.path.join(root, 'masks', f"bench_{i}.png"))
+    return width, height
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, name, func):
+        start = time.perf_counter()
+        func()
+        self.samples.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+
+    def results(self, peaks):
+        return {
+            name: {
+                'n': len(values),
+                'p50_ms': percentile(values, 0.5),
+                'p95_ms': percentile(values, 0.95),
+                'peak_rss_mb': peaks.get(name),
+            }
+            for name, values in self.samples.items()
+        }
+
+
+def run_size(megapixels, repeat):
+    """在当前进程中运行一种图像尺寸的全部场景"""
+    app = QApplication.instance() or QApplication([])
+    root = tempfile.mkdtemp(prefix='iw_anno_bench_')
+    try:
+        width, height = make_dataset(root, megapixels)
+        window = main.SegmentationTool(session=False)
+        window.resize(1280, 900)
+        window.show()
+        app.processEvents()
+        recorder = Recorder()
+        peaks = {}
+
+        recorder.time('open_folder', lambda: window.open_folder(root))
+        app.processEvents()
+        label = window.image_label
+
+        def render():
+            # 同步绘制可见区域，计入合成与缩放的开销
+            label.repaint()
+            app.processEvents()
+
+        for _ in range(repeat):
+            recorder.time('update_display', lambda: (label.update_display(), render()))
+        peaks['update_display'] = peak_rss_mb()
+
+        center = QPointF(label.visibleRegion().boundingRect().center())
+        for i in range(repeat):
+            delta = 120 if (i // 5) % 2 == 0 else -120
+            event = QWheelEvent(center, center, QPoint(0, 0), QPoint(0, delta),
+                                Qt.NoButton, Qt.NoModifier, Qt.NoScrollPhase, False)
+            recorder.time('wheel_zoom', lambda: (label.wheelEvent(event), render()))
+        peaks['wheel_zoom'] = peak_rss_mb()
+
+        visible = label.visibleRegion().boundingRect()
+        for i in range(repeat):
+            y = visible.top() + (i * 37) % max(1, visible.height())
+            label.mousePressEvent(QMouseEvent(
+                QEvent.MouseButtonPress, QPointF(visible.left() + 5, y), Qt.LeftButton, Qt.LeftButton, Qt.NoModifier
+            ))
+            for step in range(1, 21):
+                point = QPointF(visible.left() + 5 + step * visible.width() / 25, y + step)
+                event = QMouseEvent(QEvent.MouseMove, point, Qt.LeftButton, Qt.LeftButton, Qt.NoModifier)
+                recorder.time('stroke_move', lambda: label.mouseMoveEvent(event))
+                if step % 4 == 0:
+                    # 模拟一帧内收到 4 个输入事件后的一次刷新
+                    recorder.time('stroke_frame', lambda: (label.flush_stroke(), render()))
+            label.mouseReleaseEvent(QMouseEvent(
+                QEvent.MouseButtonRelease, point, Qt.LeftButton, Qt.NoButton, Qt.NoModifier
+            ))
+        peaks['stroke_move'] = peaks['stroke_frame'] = peak_rss_mb()
+
+        for _ in range(repeat):
+            window.mask_dirty = True
+            recorder.time('save_mask', window.save_mask)
+            recorder.time('save_mask_flush', window.mask_writer.flush)
+        peaks['save_mask'] = peaks['save_mask_flush'] = peak_rss_mb()
+
+        for _ in range(repeat):
+            recorder.time('load_next_image', lambda: (window.load_next_image(), render()))
+            window.load_previous_image()
+            render()
+        peaks['load_next_image'] = peak_rss_mb()
+
+        peaks['open_folder'] = peak_rss_mb()
+        window.close()
+        return {'width': width, 'height': height, 'scenarios': recorder.results(peaks)}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run_all(sizes, repeat):
+    """每种尺寸在独立子进程中运行，返回完整结果"""
+    results = {}
+    for megapixels in sizes:
+        print(f"Running {megapixels:g} MP...", file=sys.stderr)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', str(megapixels), '--repeat', str(repeat)],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout
+        size_result = json.loads(output.strip().splitlines()[-1])
+        for name, stats in size_result['scenarios'].items():
+            results[f"{megapixels:g}MP/{name}"] = stats
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'platform': platform.platform(),
+            'numpy': main.np is not None,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def lease_worker(root, worker_id, count, work_ms, lease_seconds, crash_after, ready, go):
+    """
+    模拟一名标注员：从自己负责的区段（第 worker_id / count 处）开始，用 acquire_batch
+    成批认领没有蒙版的图像，"标注" work_ms 毫秒后写入蒙版并释放租约；自己的区段做完后
+    继续向后认领，他人剩下的图像也会被分担。crash_after 不为 None 时在完成 crash_after 张图像后
+    直接退出，留下这一批未释放的租约，并记录退出时间和被遗留的图像。
+    """
+    image_folder = os.path.join(root, 'images')
+    mask_folder = os.path.join(root, 'masks')
+    names = sorted(os.listdir(image_folder), key=main.natural_sort_key)
+    order = {name: i for i, name in enumerate(names)}
+    leases = main.LeaseManager(root, owner=f"worker-{worker_id}", duration=lease_seconds,
+                               heartbeat=lease_seconds / 4)
+    mask = QImage(16, 16, QImage.Format_Grayscale8)
+    mask.fill(255)
+
+    def mask_path(name):
+        return os.path.join(mask_folder, os.path.splitext(name)[0] + '.png')
+
+    done = 0
+    position = len(names) * worker_id // count
+    log = open(os.path.join(root, f"done-{worker_id}.log"), 'a', encoding='utf-8')
+    # 进程启动和导入的时间不计入，所有标注员同时开始
+    ready.set()
+    go.wait()
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        pending = [name for name in names if not os.path.exists(mask_path(name))]
+        if not pending:
+            break
+        start = next((i for i, name in enumerate(pending) if order[name] >= position), 0)
+        batch = leases.acquire_batch(pending, main.LEASE_BATCH, start)
+        if not batch:
+            # 剩下的图像都被他人持有，等待其完成或租约过期
+            time.sleep(lease_seconds / 8)
+            continue
+        for name in batch:
+            # 认领之后再确认一次，其他人可能刚刚完成并释放
+            if os.path.exists(mask_path(name)):
+                leases.release(name)
+                continue
+            if crash_after is not None and done >= crash_after:
+                with open(os.path.join(root, 'crash.json'), 'w', encoding='utf-8') as f:
+                    json.dump({'time': time.time(), 'abandoned': sorted(leases.held)}, f)
+                os._exit(1)
+            time.sleep(work_ms / 1000)
+            main.save_mask_file(mask, mask_path(name))
+            # 每完成一张立即记录，崩溃的进程也不会丢失已完成的记录
+            log.write(f"{name} {time.time()}\n")
+            log.flush()
+            done += 1
+            leases.release(name)
+        position = order[batch[-1]] + 1
+    leases.stop()
+    log.close()
+
+
+def run_lease_round(count, images, work_ms, lease_seconds, crash=False):
+    """
+    在新的临时文件夹中启动 count 名标注员（crash 为 True 时最后一名完成一张后崩溃），
+    返回耗时、吞吐量、重复与遗漏的数量，以及崩溃时遗留图像的恢复耗时。
+    """
+    context = multiprocessing.get_context('spawn')
+    root = tempfile.mkdtemp(prefix='iw_anno_leases_')
+    try:
+        os.makedirs(os.path.join(root, 'images'))
+        os.makedirs(os.path.join(root, 'masks'))
+        for i in range(images):
+            open(os.path.join(root, 'images', f"img{i}.png"), 'wb').close()
+        go = context.Event()
+        readies = [context.Event() for _ in range(count)]
+        workers = [
+            context.Process(target=lease_worker, args=(
+                root, i, count, work_ms, lease_seconds, 1 if crash and i == count - 1 else None, readies[i], go
+            ))
+            for i in range(count)
+        ]
+        for worker in workers:
+            worker.start()
+        for ready in readies:
+            ready.wait()
+        start = time.perf_counter()
+        go.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        finished = {}
+        annotated = []
+        for i in range(count):
+            path = os.path.join(root, f"done-{i}.log")
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    for line in f:
+                        name, stamp = line.split()
+                        annotated.append(name)
+                        finished[name] = float(stamp)
+        recovery = None
+        crash_path = os.path.join(root, 'crash.json')
+        if os.path.exists(crash_path):
+            with open(crash_path, encoding='utf-8') as f:
+                crashed = json.load(f)
+            stamps = [finished[name] for name in crashed['abandoned'] if name in finished]
+            recovery = max(stamps) - crashed['time'] if stamps else None
+        return {
+            'annotators': count, 'seconds': elapsed, 'images_per_second': images / elapsed,
+            'duplicates': len(annotated) - len(set(annotated)), 'missing': images - len(set(annotated)),
+            'recovery_seconds': recovery,
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run_leases(counts, images, work_ms, lease_seconds=2.0):
+    """
+    分两部分测量：吞吐量随标注员人数的变化（没有崩溃），以及一名标注员崩溃后其租约过期、
+    遗留图像被他人接手所需的时间。两部分都检查所有图像恰好被标注一次。
+    """
+    scaling = [run_lease_round(count, images, work_ms, lease_seconds) for count in counts]
+    recovery = run_lease_round(max(2, max(counts)), images, work_ms, lease_seconds, crash=True)
+    results = scaling + [recovery]
+    ok = all(not result['duplicates'] and not result['missing'] for result in results)
+
+    print(f"{'annotators':>10} {'seconds':>8} {'img/s':>8} {'speedup':>8} {'dup':>4} {'miss':>4}")
+    for result in scaling:
+        speedup = result['images_per_second'] / scaling[0]['images_per_second']
+        print(f"{result['annotators']:>10} {result['seconds']:8.2f} {result['images_per_second']:8.1f} "
+              f"{speedup:8.2f} {result['duplicates']:>4} {result['missing']:>4}")
+    recovered = recovery['recovery_seconds']
+    print(f"crash recovery: {recovery['annotators']} annotators, one crashes after its first image; "
+          f"lease {lease_seconds:g} s, abandoned images re-annotated after "
+          f"{'-' if recovered is None else f'{recovered:.2f}'} s, total {recovery['seconds']:.2f} s, "
+          f"dup {recovery['duplicates']}, miss {recovery['missing']}")
+    return {'scaling': scaling, 'crash_recovery': recovery}, ok
+
+
+def run_preannotate(batch_sizes, images, megapixels=1, model='stub'):
+    """对每种批大小用新的进程池为 images 张图像生成建议蒙版，返回耗时、吞吐量和第一张建议的等待时间"""
+    root = tempfile.mkdtemp(prefix='iw_anno_preannotate_')
+    results = []
+    try:
+        make_dataset(root, megapixels, images)
+        image_paths = sorted(
+            os.path.join(root, 'images', name) for name in os.listdir(os.path.join(root, 'images'))
+        )
+        for batch_size in batch_sizes:
+            engine = main.PreannotationEngine(model, batch_size=batch_size)
+            cache_dir = os.path.join(root, f"proposals-{batch_size}")
+            start = time.perf_counter()
+            first = None
+            done = 0
+            while done < len(image_paths) and not engine.failed:
+                # 与界面中一样反复调度，凑不满一批的图像在进程空闲时提交
+                engine.schedule(cache_dir, image_paths)
+                done = sum(engine.proposal(cache_dir, path) is not None for path in image_paths)
+                if done and first is None:
+                    first = time.perf_counter() - start
+                time.sleep(0.005)
+            elapsed = time.perf_counter() - start
+            engine.shutdown()
+            results.append({
+                'batch_size': batch_size, 'workers': engine.workers, 'seconds': elapsed,
+                'images_per_second': done / elapsed, 'first_proposal_s': first, 'failed': engine.failed,
+            })
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print(f"{'batch':>6} {'workers':>8} {'seconds':>8} {'img/s':>8} {'first s':>8}")
+    for result in results:
+        print(f"{result['batch_size']:>6} {result['workers']:>8} {result['seconds']:8.2f} "
+              f"{result['images_per_second']:8.1f} {result['first_proposal_s'] or 0:8.2f}")
+    return results, not any(result['failed'] for result in results)
+
+
+def compare(current, baseline, threshold, metric):
+    """与基准结果比较，返回变慢超过阈值的场景列表"""
+    regressions = []
+    print(f"{'scenario':40} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, stats in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f"{name:40} {'-':>10} {stats[metric]:10.2f} {'new':>8}")
+            continue
+        change = stats[metric] / base[metric] - 1 if base[metric] > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print(f"{name:40} {base[metric]:10.2f} {stats[metric]:10.2f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offscreen benchmark of the annotation hot paths.")
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES,
+                        help="image sizes in megapixels")
+    parser.add_argument('--repeat', type=int, default=20, help="samples per scenario")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help="allowed relative slowdown before failing (default 0.15)")
+    parser.add_argument('--metric', choices=('p50_ms', 'p95_ms'), default='p50_ms')
+    parser.add_argument('--leases', type=int, nargs='+',
+                        help="simulate this many annotators sharing one folder, then a run where one crashes")
+    parser.add_argument('--lease-images', type=int, default=200, help="images in the simulated folder")
+    parser.add_argument('--lease-work-ms', type=float, default=20, help="simulated annotation time per image")
+    parser.add_argument('--preannotate', type=int, nargs='+',
+                        help="measure model pre-annotation throughput with these batch sizes")
+    parser.add_argument('--preannotate-images', type=int, default=64, help="images to pre-annotate")
+    parser.add_argument('--preannotate-model', default='stub', help="model as module:function (default: stub)")
+    parser.add_argument('--worker', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.leases:
+        _, ok = run_leases(args.leases, args.lease_images, args.lease_work_ms)
+        return 0 if ok else 1
+
+    if args.preannotate:
+        _, ok = run_preannotate(args.preannotate, args.preannotate_images, model=args.preannotate_model)
+        return 0 if ok else 1
+
+    if args.worker is not None:
+        print(json.dumps(run_size(args.worker, args.repeat)))
+        return 0
+
+    current = run_all(args.sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold, args.metric)
+        if regressions:
+            print(f"{len(regressions)} scenario(s) slower than baseline by more than {args.threshold:.0%}")
+            return 1
+    elif not args.output:
+        print(json.dumps(current, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
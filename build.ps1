@@ -1,3 +1,8 @@
+# 默认打包为文件夹（--onedir），启动时无需解压；-OneFile 打包为单个 exe，但每次启动都要先解压到临时目录
+param(
+    [switch]$OneFile
+)
+
 # 获取脚本所在的文件夹路径
 $rootFolder = $PSScriptRoot
 
@@ -25,6 +30,11 @@ if (-not $pyinstallerInstalled) {
 
 # 执行 pyinstaller 打包命令，使用 --add-data 参数将 resources 文件夹的内容包括进来，并指定版本号文件，修改文件名
 Write-Host "Building exe from $pythonScript with version $version..."
-pyinstaller --onefile --windowed --add-data "$resourcesFolder;resources" --name "$outputFileName" $pythonScript
+$bundleMode = if ($OneFile) { "--onefile" } else { "--onedir" }
+pyinstaller $bundleMode --windowed --add-data "$resourcesFolder;resources" --name "$outputFileName" $pythonScript
 
-Write-Host "Build complete. Check the 'dist' folder for the '$outputFileName.exe' file."
+if ($OneFile) {
+    Write-Host "Build complete. Check the 'dist' folder for the '$outputFileName.exe' file."
+} else {
+    Write-Host "Build complete. Check the 'dist\$outputFileName' folder for '$outputFileName.exe'."
+}
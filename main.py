@@ -2,19 +2,2959 @@ import os
 os.environ["QT_XCB_FORCE_SOFTWARE_OPENGL"] = "1"
 
 import sys
+import time
+# 启动计时的起点，在导入 PyQt5 等较重的模块之前记录
+STARTUP_BEGIN = time.perf_counter()
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget,
     QPushButton, QHBoxLayout, QSizePolicy, QCheckBox, QAction,
-    QSlider, QSpinBox, QScrollArea, QFileDialog, QButtonGroup, QMessageBox, QShortcut
+    QSlider, QSpinBox, QScrollArea, QFileDialog, QButtonGroup, QMessageBox, QShortcut,
+    QColorDialog, QActionGroup, QDockWidget, QListView, QInputDialog
 )
 from PyQt5.QtGui import (
-    QPixmap, QImage, QPainter, QColor, QPen, QKeySequence,
-    QRegion, QBitmap
+    QPixmap, QImage, QPainter, QColor, QPen, QKeySequence, QTransform,
+    QRegion, QBitmap, QPainterPath
 )
-from PyQt5.QtCore import Qt, QPoint
-from PyQt5.QtGui import QIcon
-from PyQt5.QtCore import QSize
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QRectF, QObject, QTimer, QSettings, pyqtSignal
+from PyQt5.QtGui import QIcon, QImageReader, QPolygon, QGuiApplication
+from PyQt5.QtCore import QSize, QEvent, QAbstractListModel, QModelIndex, QBuffer, QByteArray, QIODevice
+from PyQt5 import sip
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import base64
+import contextlib
+import ctypes
+import functools
+import getpass
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import logging.handlers
+import math
+import mmap
+import multiprocessing
 import re
+import shutil
+import socket
+import sqlite3
+import struct
+import tarfile
+import tempfile
+import threading
+import uuid
+import zipfile
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # 没有 NumPy 时只能使用 Qt 合成路径
+    np = None
+
+# 瓦片边长（像素）及瓦片缓存的内存上限
+TILE_SIZE = 256
+TILE_CACHE_BYTES = 256 * 1024 * 1024
+# 像素数超过该值的图像才把金字塔瓦片持久化到磁盘
+PYRAMID_DISK_CACHE_MIN_PIXELS = 16 * 1000 * 1000
+# 预读取：沿浏览方向向前、向后预解码的图像数量，以及解码缓存的内存上限
+PREFETCH_AHEAD = 3
+PREFETCH_BEHIND = 1
+PREFETCH_CACHE_BYTES = 512 * 1024 * 1024
+# 超过该像素数且未预读取的图像先显示缩小的预览，全分辨率在后台解码
+PROGRESSIVE_MIN_PIXELS = 16_000_000
+PREVIEW_MAX_SIDE = 2048
+# 撤销历史：差异瓦片的边长，以及所有图像历史合计的内存上限
+UNDO_TILE_SIZE = 64
+UNDO_MEMORY_BYTES = 256 * 1024 * 1024
+# 超过该像素数的蒙版存放在内存映射文件中，按瓦片记录修改
+MASK_MAP_MIN_PIXELS = 64_000_000
+MASK_MAP_TILE_SIZE = 256
+# 超像素：在长边不超过 SUPERPIXEL_MAX_SIDE 的缩小图像上计算，结果缓存到磁盘
+SUPERPIXEL_SEGMENTS = 1500
+SUPERPIXEL_COMPACTNESS = 10.0
+SUPERPIXEL_ITERATIONS = 5
+SUPERPIXEL_MAX_SIDE = 1024
+SUPERPIXEL_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+SUPERPIXEL_CACHE_BYTES = 64 * 1024 * 1024
+# 模型预标注：运行模型的进程数、每批图像数、领先当前图像生成建议的张数，以及送入模型的图像长边
+PREANNOTATE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+PREANNOTATE_BATCH = 4
+PREANNOTATE_AHEAD = 8
+PREANNOTATE_MAX_SIDE = 1024
+# 多人标注：租约有效期、续期间隔（秒）以及每次预先认领的图像数
+LEASE_SECONDS = 120
+LEASE_HEARTBEAT_SECONDS = 30
+LEASE_BATCH = 5
+
+# 笔画日志：两次 fsync 之间的最短间隔（秒），日志超过该大小时在保存后压缩
+JOURNAL_SYNC_INTERVAL = 0.5
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024
+# 缩放、拖动停止多久（毫秒）后用平滑插值重绘
+SMOOTH_RENDER_DELAY_MS = 150
+
+# 胶片栏缩略图的长边、生成线程数、内存缓存上限，以及最多积压的生成请求
+THUMBNAIL_SIZE = 128
+THUMBNAIL_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+THUMBNAIL_CACHE_BYTES = 64 * 1024 * 1024
+THUMBNAIL_QUEUE = 512
+
+# 流式导出：每个 tar 分片的样本数，以及最后一次修改后等待多久（秒）再重写分片
+EXPORT_SHARD_SAMPLES = 1000
+EXPORT_DELAY_SECONDS = 60
+
+# 命令行批处理支持的操作及默认进程数
+BATCH_OPERATIONS = OrderedDict([
+    ('resize', "resize masks whose size differs from the image"),
+    ('binarize', "threshold masks back to pure 0/255"),
+    ('convert', "rewrite masks in another storage format"),
+    ('contours', "export mask outlines as polygon JSON"),
+])
+BATCH_JOBS = os.cpu_count() or 1
+
+# 数据集质检：覆盖率低于/高于这些比例的蒙版会被标记
+QA_TINY_RATIO = 0.001
+QA_HUGE_RATIO = 0.9
+# 需要重新统计的图像不超过该数量时直接在当前进程计算，省去启动进程池的开销
+QA_INLINE_LIMIT = 4
+QA_FLAGS = OrderedDict([
+    ('no_mask', "No Mask"),
+    ('empty', "Empty Mask"),
+    ('size_mismatch', "Size Mismatch"),
+    ('tiny', "Tiny Coverage"),
+    ('huge', "Huge Coverage"),
+    ('not_binary', "Non-Binary Pixels"),
+])
+# 性能跟踪：设置该环境变量（值为跟踪文件路径，或 1 使用默认路径）或使用 --trace 参数开启
+TRACE_ENV = 'IW_ANNO_TRACE'
+TRACE_DEFAULT_PATH = 'iw_anno_trace.jsonl'
+TRACE_MAX_BYTES = 16 * 1024 * 1024
+TRACE_BACKUPS = 3
+# 多类别标签图：菜单中列出可见性开关的类别数（类别编号 1-255，0 为背景）
+LABEL_CLASSES = 8
+# 支持的图像扩展名
+IMAGE_EXTENSIONS = (".png", ".jpg")
+# 蒙版存储格式：8 位灰度 PNG（默认）、1 位打包 PNG、COCO 风格游程编码的 JSON 旁路文件
+MASK_FORMATS = OrderedDict([('png', "8-bit PNG"), ('png1', "1-bit PNG"), ('rle', "RLE (JSON)")])
+RLE_SUFFIX = '.rle.json'
+
+
+class Profiler:
+    """
+    热点路径的计时与计数。未开启时 stage() 返回共享的空上下文，timed() 包装的函数只多一次属性判断；
+    开启后每次计时写入按大小轮转的 JSON-lines 跟踪文件，并保留最近的样本供 HUD 显示平均值。
+    """
+    _null_stage = contextlib.nullcontext()
+
+    def __init__(self, window=120):
+        self.enabled = False
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._logger = None
+
+    def enable(self, trace_path=None, max_bytes=TRACE_MAX_BYTES, backups=TRACE_BACKUPS):
+        """开始记录；trace_path 为 None 时只在内存中统计（供 HUD 使用）"""
+        if trace_path is not None and self._logger is None:
+            handler = logging.handlers.RotatingFileHandler(trace_path, maxBytes=max_bytes, backupCount=backups)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger = logging.getLogger('iw_anno.trace')
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(handler)
+        self.enabled = True
+
+    def _write(self, record):
+        if self._logger is not None:
+            record['ts'] = time.time()
+            record['thread'] = threading.current_thread().name
+            self._logger.info(json.dumps(record))
+
+    def record(self, name, elapsed_ms):
+        with self._lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+            samples.append(elapsed_ms)
+        self._write({'stage': name, 'ms': round(elapsed_ms, 3)})
+
+    @contextlib.contextmanager
+    def _timing(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def stage(self, name):
+        """用 with 语句为一段代码计时"""
+        return self._timing(name) if self.enabled else self._null_stage
+
+    def timed(self, name):
+        """为整个函数计时的装饰器"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._timing(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        """记录一次开销较大的操作（例如整幅图像的复制）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            total = self.counts[name] = self.counts.get(name, 0) + n
+        self._write({'count': name, 'total': total})
+
+    def averages(self):
+        """各阶段最近样本的平均耗时（毫秒）"""
+        with self._lock:
+            return {name: sum(samples) / len(samples) for name, samples in self.samples.items() if samples}
+
+
+PROFILER = Profiler()
+
+
+def app_data_path(main_folder, *parts):
+    """返回主文件夹下工具数据目录 .iw_anno 中的路径"""
+    return os.path.join(main_folder, '.iw_anno', *parts)
+
+
+def image_nbytes(image):
+    """QImage 像素数据占用的字节数"""
+    return image.bytesPerLine() * image.height()
+
+
+def natural_sort_key(name):
+    """
+    将自然排序键编码为可按字符串直接比较的形式（数字部分补零到定长，文本部分以 \\x01 结尾），
+    排序结果与 SegmentationTool.natural_key 一致，可用于数据库索引。
+    """
+    parts = re.split(r'(\d+)', name)
+    return ''.join(part.zfill(20) if i % 2 else part.lower() + '\x01' for i, part in enumerate(parts))
+
+
+# 可以原地读取的图像归档格式
+SHARD_EXTENSIONS = ('.tar', '.zip')
+# 归档中的图像以 "<归档文件名>/<成员路径>" 命名，图像路径形如 images/shard.tar/000/1.jpg
+SHARD_PATH_PATTERN = re.compile(r'^(.*?\.(?:tar|zip))[\\/](.+)$', re.IGNORECASE)
+# 读取归档成员尺寸时先只解析这么多字节的文件头，不够时再读取整个成员
+SHARD_HEADER_BYTES = 256 * 1024
+
+
+def split_shard_path(path):
+    """图像路径位于 tar / zip 归档内时返回 (归档路径, 成员名)，否则返回 None"""
+    match = SHARD_PATH_PATTERN.match(path)
+    if match is None or not os.path.isfile(match.group(1)):
+        return None
+    return match.group(1), match.group(2).replace('\\', '/')
+
+
+def image_reader(image_path):
+    """返回图像的 QImageReader；归档成员从内存中的成员数据读取"""
+    shard = split_shard_path(image_path)
+    if shard is None:
+        return QImageReader(image_path)
+    buffer = QBuffer()
+    buffer.setData(QByteArray(shard_archive(shard[0]).read(shard[1])))
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    # QImageReader 不持有设备的所有权，读取器存活期间缓冲区也必须存活
+    reader.buffer = buffer
+    return reader
+
+
+def read_image_size(image_path):
+    """图像尺寸（不解码像素）；归档成员的尺寸缓存在成员索引中，不必每次读取整个成员"""
+    shard = split_shard_path(image_path)
+    if shard is None:
+        return QImageReader(image_path).size()
+    return shard_archive(shard[0]).image_size(shard[1])
+
+
+def image_exists(image_path):
+    """图像文件或归档成员是否存在"""
+    shard = split_shard_path(image_path)
+    if shard is None:
+        return os.path.isfile(image_path)
+    return shard_archive(shard[0]).contains(shard[1])
+
+
+def image_stem(image_path):
+    """用作缓存文件名的图像主名；归档成员带上归档名并把子路径展平，避免不同分片的同名成员冲突"""
+    shard = split_shard_path(image_path)
+    name = f"{os.path.basename(shard[0])}/{shard[1]}" if shard else os.path.basename(image_path)
+    return os.path.splitext(name)[0].replace('/', '__')
+
+
+@PROFILER.timed('decode_image')
+def decode_image(image_path):
+    """解码图像并转换为 RGB32 格式"""
+    PROFILER.count('full_image_copy')
+    return image_reader(image_path).read().convertToFormat(QImage.Format_RGB32)
+
+
+@PROFILER.timed('decode_preview')
+def decode_preview(image_path, max_side=PREVIEW_MAX_SIDE):
+    """解码长边不超过 max_side 的缩小预览图；JPEG 可以在解码时直接按 DCT 缩放，远快于完整解码"""
+    reader = image_reader(image_path)
+    size = reader.size()
+    scale = max_side / max(size.width(), size.height(), 1)
+    if scale < 1:
+        reader.setScaledSize(QSize(max(1, round(size.width() * scale)), max(1, round(size.height() * scale))))
+    return reader.read().convertToFormat(QImage.Format_RGB32)
+
+
+def mask_files(mask_path):
+    """蒙版（以 .png 路径标识）在各种存储格式下对应的文件"""
+    return [mask_path, os.path.splitext(mask_path)[0] + RLE_SUFFIX]
+
+
+def resolve_mask_file(mask_path):
+    """返回该蒙版实际存在的文件，用于自动识别格式；都不存在时返回 None"""
+    for path in mask_files(mask_path):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def mask_mtime_ns(mask_path):
+    """蒙版文件（任意格式）的修改时间，不存在时返回 None"""
+    path = resolve_mask_file(mask_path)
+    return file_mtime_ns(path) if path else None
+
+
+def rle_encode(mask):
+    """将二值蒙版编码为 COCO 风格的未压缩 RLE（列优先，从背景游程开始）"""
+    array = qimage_array(mask, writable=False)
+    height, width = array.shape
+    flat = (array.T >= 128).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size]))).tolist()
+    if flat.size and flat[0]:
+        counts.insert(0, 0)
+    return {'size': [height, width], 'counts': counts}
+
+
+def rle_decode(data):
+    """将 rle_encode 的结果解码为 Grayscale8 蒙版"""
+    height, width = data['size']
+    counts = np.asarray(data['counts'], dtype=np.int64)
+    values = np.zeros(counts.size, np.uint8)
+    values[1::2] = 255
+    flat = np.repeat(values, counts)
+    if flat.size != height * width:
+        raise ValueError(f"RLE covers {flat.size} pixels, expected {height * width}")
+    mask = QImage(width, height, QImage.Format_Grayscale8)
+    qimage_array(mask)[:] = flat.reshape(width, height).T
+    return mask
+
+
+def read_mask_file(mask_path):
+    """按实际存在的文件格式读取蒙版为 Grayscale8（不缩放）；不存在时返回 None"""
+    path = resolve_mask_file(mask_path)
+    if path is None:
+        return None
+    if path.endswith(RLE_SUFFIX):
+        if np is None:
+            print(f"NumPy is required to read RLE masks: {path}")
+            return None
+        with open(path, encoding='utf-8') as f:
+            return rle_decode(json.load(f))
+    return QImage(path).convertToFormat(QImage.Format_Grayscale8)
+
+
+def stored_mask_format(mask_path):
+    """磁盘上蒙版的存储格式（MASK_FORMATS 的键），不存在时返回 None"""
+    path = resolve_mask_file(mask_path)
+    if path is None:
+        return None
+    if path.endswith(RLE_SUFFIX):
+        return 'rle'
+    return 'png1' if QImageReader(path).imageFormat() == QImage.Format_Mono else 'png'
+
+
+def stored_mask_size(mask_path):
+    """磁盘上蒙版的尺寸（只读取文件头），不存在时返回 None"""
+    path = resolve_mask_file(mask_path)
+    if path is None:
+        return None
+    if path.endswith(RLE_SUFFIX):
+        with open(path, encoding='utf-8') as f:
+            height, width = json.load(f)['size']
+        return QSize(width, height)
+    return QImageReader(path).size()
+
+
+@PROFILER.timed('mask_load')
+def decode_mask(mask_path, size, smooth=True):
+    """
+    读取蒙版并转换为 Grayscale8，尺寸与图像不一致时缩放；文件不存在时返回 None。
+    标签图的像素值是类别编号，不能插值，smooth 为 False 时按最近邻缩放。
+    """
+    mask = read_mask_file(mask_path)
+    if mask is None:
+        return None
+    PROFILER.count('full_image_copy')
+    if mask.size() != size:
+        with PROFILER.stage('mask_rescale'):
+            PROFILER.count('full_image_copy')
+            # 平滑缩放的结果是 RGB32，需要转换回 Grayscale8
+            mode = Qt.SmoothTransformation if smooth else Qt.FastTransformation
+            mask = mask.scaled(size, Qt.IgnoreAspectRatio, mode)
+            mask = mask.convertToFormat(QImage.Format_Grayscale8)
+    return mask
+
+
+def label_color(class_id):
+    """标签图中类别的显示颜色（不含透明度）；色相按黄金角递增，相邻编号的颜色区分明显"""
+    return QColor.fromHsv(int(class_id * 137.508) % 360, 220, 255)
+
+
+@PROFILER.timed('mask_encode')
+def save_mask_file(mask, mask_path, fmt='png', png_compression=-1):
+    """
+    按指定格式原子地写入蒙版，并删除其他格式留下的旧文件。
+    png_compression 为 zlib 压缩级别 0-9，-1 表示使用默认值。
+    """
+    # 归档成员的蒙版按成员路径存放在 masks/<归档名>/ 下的子目录中
+    os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+    if fmt == 'rle':
+        target = mask_files(mask_path)[1]
+        data = json.dumps(rle_encode(mask), separators=(',', ':')).encode('utf-8')
+        write_bytes_atomic(data, target)
+    else:
+        target = mask_path
+        if fmt == 'png1':
+            PROFILER.count('full_image_copy')
+            mask = mask.convertToFormat(QImage.Format_Mono, Qt.ThresholdDither)
+        # Qt 将 PNG 的质量参数 q 映射为压缩级别 (100 - q) * 9 / 91
+        quality = 100 - math.ceil(png_compression * 91 / 9) if png_compression >= 0 else -1
+        write_image_atomic(mask, target, 'PNG', quality)
+    for path in mask_files(mask_path):
+        if path != target and os.path.exists(path):
+            os.remove(path)
+
+
+def file_mtime_ns(path):
+    """文件的修改时间（纳秒），文件不存在时返回 None；归档成员使用归档文件的修改时间"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        shard = split_shard_path(path)
+        return file_mtime_ns(shard[0]) if shard else None
+
+
+def write_image_atomic(image, path, fmt='PNG', quality=-1):
+    """先写入同目录下的临时文件再重命名，保证目标文件要么是旧内容要么是完整的新内容"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        if not image.save(tmp_path, fmt, quality):
+            raise OSError(f"Failed to encode {path}")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_bytes_atomic(data, path):
+    """以临时文件加重命名的方式原子地写入字节数据"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def qimage_array(image, writable=True):
+    """
+    以 NumPy 数组访问 QImage 的像素数据（不复制）。
+    32 位格式返回 (高, 宽, 4) 的字节数组，Grayscale8 返回 (高, 宽)。
+    """
+    ptr = image.bits() if writable else image.constBits()
+    ptr.setsize(image.bytesPerLine() * image.height())
+    channels = image.depth() // 8
+    array = np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())
+    array = array[:, :image.width() * channels]
+    if channels > 1:
+        return array.reshape(image.height(), image.width(), channels)
+    return array
+
+
+class LRUCache:
+    """按字节数限制容量的线程安全 LRU 缓存"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            # 淘汰最久未使用的条目，至少保留刚放入的一项
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+
+    def discard(self, key):
+        self.pop(key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.total_bytes -= entry[1]
+            return entry[0]
+
+    def discard_if(self, predicate):
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self.total_bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+
+class ImagePyramid:
+    """
+    图像的多分辨率金字塔。第 0 层为原图，每升一层宽高减半；
+    每层按 TILE_SIZE 切分为瓦片，按需生成并存入共享的 LRU 缓存。
+    指定 disk_dir 时，第 1 层及以上的瓦片会持久化到磁盘以便下次直接读取。
+    """
+    _uids = itertools.count()
+
+    def __init__(self, image, cache, disk_dir=None, size=None, smooth=True):
+        self.image = image
+        self.cache = cache
+        self.disk_dir = disk_dir
+        # 标签图的上层瓦片按最近邻缩小，保证像素值仍是有效的类别编号
+        self.transformation = Qt.SmoothTransformation if smooth else Qt.FastTransformation
+        self.uid = next(ImagePyramid._uids)
+        # 逐层计算尺寸，直到整层可以放进一个瓦片
+        size = size or image.size()
+        width, height = size.width(), size.height()
+        self.level_sizes = [QSize(width, height)]
+        while max(width, height) > TILE_SIZE:
+            width, height = (width + 1) // 2, (height + 1) // 2
+            self.level_sizes.append(QSize(width, height))
+
+    def level_for_zoom(self, zoom):
+        """选择不低于显示分辨率的最粗一层"""
+        level = int(math.floor(math.log2(1 / zoom))) if zoom < 1 else 0
+        return max(0, min(level, len(self.level_sizes) - 1))
+
+    def tile_rect(self, level, tx, ty):
+        size = self.level_sizes[level]
+        x, y = tx * TILE_SIZE, ty * TILE_SIZE
+        return QRect(x, y, min(TILE_SIZE, size.width() - x), min(TILE_SIZE, size.height() - y))
+
+    def tiles_in(self, level, rect):
+        """返回与该层坐标下 rect 相交的瓦片编号"""
+        rect = rect.intersected(QRect(QPoint(0, 0), self.level_sizes[level]))
+        if rect.isEmpty():
+            return []
+        return [
+            (tx, ty)
+            for ty in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1)
+            for tx in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1)
+        ]
+
+    def tile(self, level, tx, ty):
+        if level == 0:
+            # 第 0 层直接从原图复制，不占用缓存
+            return self.image.copy(self.tile_rect(0, tx, ty))
+        key = (self.uid, level, tx, ty)
+        tile = self.cache.get(key)
+        if tile is None:
+            tile = self._load_tile(level, tx, ty)
+            if tile is None:
+                tile = self._build_tile(level, tx, ty)
+                self._save_tile(level, tx, ty, tile)
+            self.cache.put(key, tile, image_nbytes(tile))
+        return tile
+
+    def _region(self, level, rect):
+        """拼接该层坐标下 rect 区域的图像"""
+        if level == 0:
+            return self.image.copy(rect)
+        region = QImage(rect.size(), self.image.format())
+        painter = QPainter(region)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for tx, ty in self.tiles_in(level, rect):
+            tile_rect = self.tile_rect(level, tx, ty)
+            painter.drawImage(tile_rect.topLeft() - rect.topLeft(), self.tile(level, tx, ty))
+        painter.end()
+        return region
+
+    @PROFILER.timed('scale')
+    def _build_tile(self, level, tx, ty):
+        # 由上一层对应的 2x2 区域缩小得到
+        rect = self.tile_rect(level, tx, ty)
+        parent_size = self.level_sizes[level - 1]
+        source_rect = QRect(rect.x() * 2, rect.y() * 2, rect.width() * 2, rect.height() * 2)
+        source_rect = source_rect.intersected(QRect(QPoint(0, 0), parent_size))
+        return self._region(level - 1, source_rect).scaled(rect.size(), Qt.IgnoreAspectRatio, self.transformation)
+
+    def _tile_path(self, level, tx, ty):
+        return os.path.join(self.disk_dir, f"L{level}_{tx}_{ty}.jpg")
+
+    def _load_tile(self, level, tx, ty):
+        if self.disk_dir is None:
+            return None
+        path = self._tile_path(level, tx, ty)
+        if not os.path.exists(path):
+            return None
+        tile = QImage(path)
+        if tile.isNull() or tile.size() != self.tile_rect(level, tx, ty).size():
+            return None
+        return tile.convertToFormat(self.image.format())
+
+    def _save_tile(self, level, tx, ty, tile):
+        if self.disk_dir is None:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            tile.save(self._tile_path(level, tx, ty), 'JPG', 90)
+        except OSError as e:
+            print(f"Failed to cache pyramid tile: {e}")
+            self.disk_dir = None
+
+    def invalidate(self, rect):
+        """丢弃各层中覆盖原图坐标 rect 的瓦片（用于内容被修改的蒙版）"""
+        for level in range(1, len(self.level_sizes)):
+            level_rect = QRect(
+                QPoint(rect.left() >> level, rect.top() >> level),
+                QPoint(rect.right() >> level, rect.bottom() >> level)
+            ).adjusted(-1, -1, 1, 1)
+            for tx, ty in self.tiles_in(level, level_rect):
+                self.cache.discard((self.uid, level, tx, ty))
+
+    def release(self):
+        """从缓存中移除该金字塔的全部瓦片"""
+        self.cache.discard_if(lambda key: key[0] == self.uid)
+
+    @staticmethod
+    def remove_stale(disk_dir):
+        """
+        删除同一图像旧版本的磁盘瓦片目录。目录名为 <主名>_<修改时间>，
+        图像被修改后旧目录不会再被读取，不清理的话会随编辑次数无限增长。
+        """
+        parent, current = os.path.split(disk_dir)
+        stem = current.rpartition('_')[0]
+        try:
+            entries = os.listdir(parent)
+        except OSError:
+            return
+        for entry in entries:
+            prefix, _, mtime = entry.rpartition('_')
+            # 只匹配完全相同的主名，a_1 的目录不会被当作 a 的旧版本
+            if prefix == stem and mtime.isdigit() and entry != current:
+                shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+
+class PreviewPyramid(ImagePyramid):
+    """
+    全分辨率图像解码完成前使用的金字塔。层级和瓦片坐标按原图尺寸 size 计算，
+    瓦片内容由缩小的预览图缩放得到；磁盘上已持久化的瓦片优先使用。
+    """
+
+    def __init__(self, preview, size, cache, disk_dir=None):
+        super().__init__(preview, cache, disk_dir, size)
+
+    def tile(self, level, tx, ty):
+        key = (self.uid, level, tx, ty)
+        tile = self.cache.get(key)
+        if tile is None:
+            tile = self._load_tile(level, tx, ty) if level > 0 else None
+            if tile is None:
+                tile = self._scale_preview(level, tx, ty)
+            self.cache.put(key, tile, image_nbytes(tile))
+        return tile
+
+    @PROFILER.timed('scale')
+    def _scale_preview(self, level, tx, ty):
+        rect = self.tile_rect(level, tx, ty)
+        level_size = self.level_sizes[level]
+        scale_x = self.image.width() / level_size.width()
+        scale_y = self.image.height() / level_size.height()
+        tile = QImage(rect.size(), self.image.format())
+        painter = QPainter(tile)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(QRectF(tile.rect()), self.image, QRectF(
+            rect.x() * scale_x, rect.y() * scale_y, rect.width() * scale_x, rect.height() * scale_y
+        ))
+        painter.end()
+        return tile
+
+
+class ImagePrefetcher:
+    """
+    在后台线程池中预先解码当前图像前后若干张图像及其蒙版，
+    结果按文件修改时间校验后存入按字节数限制的 LRU 缓存。
+    """
+
+    def __init__(self, max_bytes=PREFETCH_CACHE_BYTES, ahead=PREFETCH_AHEAD, behind=PREFETCH_BEHIND, workers=2):
+        self.cache = LRUCache(max_bytes)
+        self.ahead = ahead
+        self.behind = behind
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        # 尺寸不一致的蒙版是否平滑缩放（标签图使用最近邻）
+        self.smooth_masks = True
+        self.futures = {}
+        # 当前正在显示、需要完整解码的图像，重新排序预读取时不取消其任务
+        self.pinned = None
+        # Future.cancel() 会在当前线程同步调用完成回调，回调中需要再次获取锁
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _mtime(kind, path):
+        return mask_mtime_ns(path) if kind == 'mask' else file_mtime_ns(path)
+
+    def _cached(self, kind, path):
+        entry = self.cache.get((kind, path))
+        if entry is None:
+            return None
+        image, mtime_ns = entry
+        # 文件在缓存后被修改过则视为未命中
+        if self._mtime(kind, path) != mtime_ns:
+            self.cache.discard((kind, path))
+            return None
+        return image
+
+    def _store(self, kind, path, image, mtime_ns):
+        if image is not None and not image.isNull() and mtime_ns is not None:
+            self.cache.put((kind, path), (image, mtime_ns), image_nbytes(image))
+
+    def _decode(self, image_path, mask_path):
+        image = self._cached('image', image_path)
+        if image is None:
+            mtime_ns = file_mtime_ns(image_path)
+            image = decode_image(image_path)
+            self._store('image', image_path, image, mtime_ns)
+        if self._cached('mask', mask_path) is None:
+            mtime_ns = mask_mtime_ns(mask_path)
+            self._store('mask', mask_path, decode_mask(mask_path, image.size(), self.smooth_masks), mtime_ns)
+        return image
+
+    def load(self, image_path, mask_path):
+        """
+        返回 (image, mask)，蒙版文件不存在时 mask 为 None。
+        缓存未命中时在当前线程解码；该图像正在后台解码时等待其完成。
+        """
+        with self._lock:
+            self.pinned = None
+            future = self.futures.get(image_path)
+        if future is not None and not future.cancel():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Prefetch failed for {image_path}: {e}")
+        image = self._decode(image_path, mask_path)
+        mask = self._cached('mask', mask_path)
+        # 返回共享数据的浅拷贝，绘制时会自动分离，缓存中的蒙版保持不变
+        return image, QImage(mask) if mask is not None else None
+
+    def cached_image(self, image_path):
+        """返回已解码并缓存的图像，没有则返回 None"""
+        return self._cached('image', image_path)
+
+    def load_mask(self, mask_path, size):
+        """在当前线程读取蒙版（优先使用缓存），文件不存在时返回 None"""
+        mask = self._cached('mask', mask_path)
+        if mask is None:
+            mtime_ns = mask_mtime_ns(mask_path)
+            mask = decode_mask(mask_path, size, self.smooth_masks)
+            self._store('mask', mask_path, mask, mtime_ns)
+        return QImage(mask) if mask is not None else None
+
+    def request(self, image_path, mask_path):
+        """在后台优先解码当前要显示的图像，返回结果为该图像的 Future"""
+        with self._lock:
+            self.pinned = image_path
+            self._cancel_pending()
+            future = self.futures.get(image_path)
+            if future is None:
+                future = self._submit(image_path, mask_path)
+            return future
+
+    def _cancel_pending(self):
+        for path, future in list(self.futures.items()):
+            if path != self.pinned and future.cancel():
+                self.futures.pop(path, None)
+
+    def _submit(self, image_path, mask_path):
+        future = self.executor.submit(self._decode, image_path, mask_path)
+        self.futures[image_path] = future
+        future.add_done_callback(lambda f, path=image_path: self._finished(path, f))
+        return future
+
+    def schedule(self, entries):
+        """
+        按优先级顺序预读取 entries（(image_path, mask_path) 列表）。
+        尚未开始的旧任务会被取消，以便浏览方向改变时重新排序。
+        """
+        with self._lock:
+            self._cancel_pending()
+            for image_path, mask_path in entries:
+                if image_path in self.futures or ('image', image_path) in self.cache:
+                    continue
+                self._submit(image_path, mask_path)
+
+    def _finished(self, image_path, future):
+        with self._lock:
+            if self.futures.get(image_path) is future:
+                del self.futures[image_path]
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Prefetch failed for {image_path}: {future.exception()}")
+
+    def invalidate(self, image_path, mask_path):
+        """文件被删除或修改后，丢弃相关的缓存和任务"""
+        with self._lock:
+            future = self.futures.pop(image_path, None)
+        if future is not None:
+            future.cancel()
+        self.cache.discard(('image', image_path))
+        self.cache.discard(('mask', mask_path))
+
+    def clear(self):
+        with self._lock:
+            for future in list(self.futures.values()):
+                future.cancel()
+            self.futures.clear()
+        self.cache.clear()
+
+    def shutdown(self):
+        self.clear()
+        self.executor.shutdown(wait=False)
+
+
+class MaskWriter(QObject):
+    """
+    在后台线程中写入蒙版的队列。同一文件排队中的多次保存只写最后一次，
+    写入采用临时文件加原子重命名。
+    """
+    saved = pyqtSignal(str, float, int, object)  # 路径、写入耗时（秒）、剩余队列长度、提交时的 tag
+    failed = pyqtSignal(str, str)
+
+    def __init__(self):
+        super().__init__()
+        self._pending = OrderedDict()
+        self._current = None
+        self._released = set()
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='mask-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, path, image, tag=None, **options):
+        """
+        将蒙版加入写入队列，替换该路径尚未写入的旧版本；options 传给 save_mask_file，
+        tag 在写入成功后随 saved 信号原样返回。
+        """
+        with self._cond:
+            previous = self._pending.get(path)
+            if isinstance(image, MaskPatch) and previous is not None and isinstance(previous[0], MaskPatch) \
+                    and previous[0].base_path == image.base_path:
+                # 同一基准文件的补丁按顺序合并，后写入的瓦片覆盖先写入的
+                image = MaskPatch(image.base_path, image.size, previous[0].tiles + image.tiles)
+            self._pending[path] = (image, options, tag)
+            self._cond.notify_all()
+
+    def _base_in_use(self, base_path):
+        jobs = list(self._pending.values())
+        if self._current is not None:
+            jobs.append(self._current[1])
+        return any(isinstance(job[0], MaskPatch) and job[0].base_path == base_path for job in jobs)
+
+    def _remove_released(self):
+        for base_path in list(self._released):
+            if not self._base_in_use(base_path):
+                self._released.discard(base_path)
+                if os.path.exists(base_path):
+                    os.remove(base_path)
+
+    def release_base(self, base_path):
+        """MappedMask 不再使用该基准文件，等排队中的补丁写完后删除"""
+        with self._cond:
+            self._released.add(base_path)
+            self._remove_released()
+
+    def pending_image(self, path):
+        """返回该路径排队中或正在写入的蒙版（QImage 或 MaskPatch），没有则返回 None"""
+        with self._cond:
+            if path in self._pending:
+                return self._pending[path][0]
+            if self._current is not None and self._current[0] == path:
+                return self._current[1][0]
+            return None
+
+    def cancel(self, path):
+        """取消该路径排队中的写入，并等待正在进行的写入完成"""
+        with self._cond:
+            self._pending.pop(path, None)
+            while self._current is not None and self._current[0] == path:
+                self._cond.wait()
+            self._remove_released()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending) + (self._current is not None)
+
+    def flush(self):
+        """阻塞直到队列中的蒙版全部写入完成"""
+        with self._cond:
+            while self._pending or self._current is not None:
+                self._cond.wait()
+
+    def stop(self):
+        self.flush()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                self._current = self._pending.popitem(last=False)
+            path, (image, options, tag) = self._current
+            start = time.perf_counter()
+            error = None
+            try:
+                if isinstance(image, MaskPatch):
+                    base = image.apply()
+                    try:
+                        save_mask_file(base.image, path, **options)
+                    finally:
+                        base.close(remove=False)
+                else:
+                    save_mask_file(image, path, **options)
+            except Exception as e:
+                error = str(e)
+            elapsed = time.perf_counter() - start
+            with self._cond:
+                depth = len(self._pending)
+            # 先投递信号再清除 _current，flush() 返回时结果信号都已进入事件队列
+            if error is None:
+                self.saved.emit(path, elapsed, depth, tag)
+            else:
+                self.failed.emit(path, error)
+            with self._cond:
+                self._current = None
+                self._remove_released()
+                self._cond.notify_all()
+
+
+def grayscale_bytes(image, rect):
+    """复制 Grayscale8 图像中 rect 区域的原始字节"""
+    region = image.copy(rect)
+    ptr = region.constBits()
+    ptr.setsize(region.bytesPerLine() * region.height())
+    return region.bytesPerLine(), bytes(ptr)
+
+
+def rgb_to_lab(rgb):
+    """sRGB（0-255 浮点数组，最后一维为通道）转换为 CIELAB（D65 白点）"""
+    c = rgb / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([
+        [0.412453, 0.357580, 0.180423],
+        [0.212671, 0.715160, 0.072169],
+        [0.019334, 0.119193, 0.950227],
+    ], dtype=c.dtype).T
+    xyz /= np.array([0.950456, 1.0, 1.088754], dtype=c.dtype)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([
+        116 * f[..., 1] - 16,
+        500 * (f[..., 0] - f[..., 1]),
+        200 * (f[..., 1] - f[..., 2]),
+    ], axis=-1)
+
+
+def slic_superpixels(rgb, n_segments=SUPERPIXEL_SEGMENTS, compactness=SUPERPIXEL_COMPACTNESS,
+                     iterations=SUPERPIXEL_ITERATIONS):
+    """
+    SLIC 超像素的 NumPy 向量化实现。聚类中心初始化在边长 step 的网格上，
+    每个像素只与所在网格及相邻 8 个网格的中心比较；返回与 rgb 同尺寸的标签数组。
+    """
+    height, width = rgb.shape[:2]
+    lab = rgb_to_lab(rgb.astype(np.float32))
+    step = max(1, int(math.sqrt(height * width / n_segments)))
+    grid_h, grid_w = -(-height // step), -(-width // step)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    cell_y = np.minimum(ys.astype(np.int32) // step, grid_h - 1)
+    cell_x = np.minimum(xs.astype(np.int32) // step, grid_w - 1)
+    # 中心特征：L, a, b, y, x
+    features = np.concatenate([lab, ys[..., None], xs[..., None]], axis=-1).reshape(-1, 5)
+    center_y = np.minimum((np.arange(grid_h) + 0.5) * step, height - 1).astype(np.int32)
+    center_x = np.minimum((np.arange(grid_w) + 0.5) * step, width - 1).astype(np.int32)
+    centers = features.reshape(height, width, 5)[center_y[:, None], center_x[None, :]].reshape(-1, 5).copy()
+    spatial_weight = (compactness / step) ** 2
+    # 每个像素的 9 个候选中心编号，超出网格的候选用 invalid 标记
+    candidates = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            ny, nx = cell_y + dy, cell_x + dx
+            invalid = (ny < 0) | (ny >= grid_h) | (nx < 0) | (nx >= grid_w)
+            candidates.append((np.clip(ny, 0, grid_h - 1) * grid_w + np.clip(nx, 0, grid_w - 1), invalid))
+    labels = np.zeros((height, width), np.int32)
+    for _ in range(iterations):
+        best = np.full((height, width), np.inf, np.float32)
+        for k, invalid in candidates:
+            center = centers[k]
+            distance = ((lab - center[..., :3]) ** 2).sum(axis=-1)
+            distance += ((ys - center[..., 3]) ** 2 + (xs - center[..., 4]) ** 2) * spatial_weight
+            distance[invalid] = np.inf
+            better = distance < best
+            best[better] = distance[better]
+            labels[better] = k[better]
+        # 用归属像素的均值更新中心，没有像素的中心保持不动
+        flat = labels.ravel()
+        counts = np.bincount(flat, minlength=len(centers))
+        occupied = counts > 0
+        for channel in range(5):
+            sums = np.bincount(flat, weights=features[:, channel], minlength=len(centers))
+            centers[occupied, channel] = sums[occupied] / counts[occupied]
+    return labels
+
+
+def compute_superpixels(image_path, cache_path, max_side=SUPERPIXEL_MAX_SIDE):
+    """在子进程中运行：解码缩小的图像、计算超像素，并原子地写入 cache_path（.npy）"""
+    image = decode_preview(image_path, max_side).convertToFormat(QImage.Format_RGB888)
+    labels = slic_superpixels(qimage_array(image, writable=False))
+    dtype = np.uint16 if labels.max() < 65536 else np.int32
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, labels.astype(dtype))
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return cache_path
+
+
+def superpixel_region(labels, size, point):
+    """
+    返回原图坐标 point 所在超像素的外接矩形（原图坐标），以及矩形内各像素是否属于该超像素的布尔数组。
+    labels 是缩小图像上的标签，按最近邻映射到原图尺寸 size。
+    """
+    label_h, label_w = labels.shape
+    width, height = size.width(), size.height()
+    segment = labels[min(point.y() * label_h // height, label_h - 1), min(point.x() * label_w // width, label_w - 1)]
+    inside = labels == segment
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    # 缩小图像上的外接矩形换算到原图（向外取整）
+    y0, y1 = rows[0] * height // label_h, -(-(rows[-1] + 1) * height // label_h)
+    x0, x1 = cols[0] * width // label_w, -(-(cols[-1] + 1) * width // label_w)
+    row_index = np.minimum(np.arange(y0, y1) * label_h // height, label_h - 1)
+    col_index = np.minimum(np.arange(x0, x1) * label_w // width, label_w - 1)
+    return QRect(x0, y0, x1 - x0, y1 - y0), inside[row_index[:, None], col_index[None, :]]
+
+
+def draw_stroke(mask, points, size, color):
+    """以圆头画笔在蒙版上绘制折线；交互绘制与日志重放共用，保证两者结果一致"""
+    painter = QPainter(mask)
+    painter.setPen(QPen(color, size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    painter.drawPolyline(QPolygon(points))
+    painter.end()
+
+
+def paste_grayscale_bytes(image, rect, bytes_per_line, data):
+    """将 grayscale_bytes 得到的字节原样写回图像的 rect 区域"""
+    region = QImage(data, rect.width(), rect.height(), bytes_per_line, QImage.Format_Grayscale8)
+    painter = QPainter(image)
+    painter.setCompositionMode(QPainter.CompositionMode_Source)
+    painter.drawImage(rect.topLeft(), region)
+    painter.end()
+
+
+class MappedMask:
+    """
+    以内存映射的原始文件作为后备存储的 Grayscale8 蒙版。image 是直接指向映射内存的 QImage，
+    可以像普通蒙版一样绘制；新建的文件是稀疏文件，只有被修改过的页面才占用内存和磁盘。
+    注意不能对 image 做浅拷贝后继续绘制，否则 Qt 会分离出一份完整的堆内存副本。
+    """
+
+    def __init__(self, path, size, create=True, tile_size=MASK_MAP_TILE_SIZE):
+        self.path = path
+        self.size = size
+        self.tile_size = tile_size
+        self.bytes_per_line = (size.width() + 3) & ~3
+        length = self.bytes_per_line * size.height()
+        with open(path, 'w+b' if create else 'r+b') as f:
+            if create:
+                f.truncate(length)
+            self._map = mmap.mmap(f.fileno(), length)
+        self._buffer = ctypes.c_char.from_buffer(self._map)
+        self.image = QImage(
+            sip.voidptr(ctypes.addressof(self._buffer)), size.width(), size.height(),
+            self.bytes_per_line, QImage.Format_Grayscale8
+        )
+        self.dirty = set()
+        # 新建且从未写入过内容的文件全为 0
+        self.blank = create
+
+    @classmethod
+    def create(cls, folder, prefix, size, source=None):
+        """在 folder 中新建映射文件，source 不为 None 时复制其内容"""
+        fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix='.raw', dir=folder)
+        os.close(fd)
+        mapped = cls(path, size)
+        if source is not None:
+            PROFILER.count('full_image_copy')
+            mapped.blank = False
+            painter = QPainter(mapped.image)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.drawImage(0, 0, source)
+            painter.end()
+        return mapped
+
+    def mark_dirty(self, rect):
+        """记录 rect 区域已被修改"""
+        rect = rect.intersected(self.image.rect())
+        if rect.isEmpty():
+            return
+        self.blank = False
+        size = self.tile_size
+        for ty in range(rect.top() // size, rect.bottom() // size + 1):
+            for tx in range(rect.left() // size, rect.right() // size + 1):
+                self.dirty.add((tx, ty))
+
+    def take_dirty_tiles(self):
+        """返回修改过的瓦片内容 [(rect, bytes_per_line, data)] 并清空修改记录"""
+        size = self.tile_size
+        tiles = []
+        for tx, ty in sorted(self.dirty):
+            rect = QRect(tx * size, ty * size, size, size).intersected(self.image.rect())
+            tiles.append((rect, *grayscale_bytes(self.image, rect)))
+        self.dirty.clear()
+        return tiles
+
+    def snapshot(self, folder, prefix):
+        """将当前内容复制为新的映射文件（在磁盘上复制，不经过内存中的 QImage）"""
+        fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix='.raw', dir=folder)
+        os.close(fd)
+        if self.blank:
+            # 全 0 的内容直接新建稀疏文件
+            os.truncate(path, len(self._map))
+        else:
+            self._map.flush()
+            shutil.copyfile(self.path, path)
+        return path
+
+    def close(self, remove=True):
+        self.image = None
+        self._buffer = None
+        self._map.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class MaskPatch:
+    """
+    MappedMask 一次保存的内容：修改过的瓦片。写入线程把它们合并到保存基准文件
+    （上次保存时内容的原始副本）中，再从该文件编码蒙版，主线程无需复制整幅蒙版。
+    """
+
+    def __init__(self, base_path, size, tiles):
+        self.base_path = base_path
+        self.size = size
+        self.tiles = tiles
+
+    def apply(self):
+        """将瓦片写入基准文件，返回映射该文件的 MappedMask"""
+        base = MappedMask(self.base_path, self.size, create=False)
+        for rect, bytes_per_line, data in self.tiles:
+            paste_grayscale_bytes(base.image, rect, bytes_per_line, data)
+        return base
+
+
+class UndoHistory:
+    """
+    按图像分开保存的撤销/重做历史。每一步只记录被修改的瓦片在修改前后的内容（zlib 压缩），
+    所有图像的历史共享一个内存上限，超出时先丢弃最早的记录。
+    """
+
+    def __init__(self, max_bytes=UNDO_MEMORY_BYTES, tile_size=UNDO_TILE_SIZE):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.total_bytes = 0
+        self._undo = {}
+        self._redo = {}
+        self._seq = itertools.count()
+        self._key = None
+        self._mask = None
+        self._before = None
+
+    def begin(self, key, mask):
+        """开始记录一步修改（例如一笔笔画）"""
+        self._key = key
+        self._mask = mask
+        self._before = {}
+
+    @PROFILER.timed('undo_snapshot')
+    def touch(self, rect):
+        """在修改 rect 区域之前调用，保存本步尚未记录的瓦片的原始内容"""
+        if self._before is None:
+            return
+        rect = rect.intersected(self._mask.rect())
+        if rect.isEmpty():
+            return
+        size = self.tile_size
+        for ty in range(rect.top() // size, rect.bottom() // size + 1):
+            for tx in range(rect.left() // size, rect.right() // size + 1):
+                if (tx, ty) not in self._before:
+                    tile_rect = QRect(tx * size, ty * size, size, size).intersected(self._mask.rect())
+                    self._before[(tx, ty)] = (tile_rect, grayscale_bytes(self._mask, tile_rect))
+
+    @PROFILER.timed('undo_snapshot')
+    def end(self):
+        """结束当前这一步，只保留内容确实发生变化的瓦片；返回是否产生了记录"""
+        if self._before is None:
+            return False
+        changes = []
+        for tile_rect, (bytes_per_line, before) in self._before.values():
+            _, after = grayscale_bytes(self._mask, tile_rect)
+            if after != before:
+                changes.append((tile_rect, bytes_per_line, zlib.compress(before, 1), zlib.compress(after, 1)))
+        key = self._key
+        self._before = None
+        self._mask = None
+        if not changes:
+            return False
+        # 新的修改使重做记录失效
+        for step in self._redo.pop(key, []):
+            self.total_bytes -= step[2]
+        nbytes = sum(len(before) + len(after) for _, _, before, after in changes)
+        self._undo.setdefault(key, []).append((next(self._seq), changes, nbytes))
+        self.total_bytes += nbytes
+        self._enforce_limit()
+        return True
+
+    def _apply(self, source, target, key, mask, use_before):
+        steps = source.get(key)
+        if not steps:
+            return None
+        step = steps.pop()
+        target.setdefault(key, []).append(step)
+        dirty_rect = QRect()
+        for tile_rect, bytes_per_line, before, after in step[1]:
+            data = zlib.decompress(before if use_before else after)
+            paste_grayscale_bytes(mask, tile_rect, bytes_per_line, data)
+            dirty_rect = dirty_rect.united(tile_rect)
+        return dirty_rect
+
+    def undo(self, key, mask):
+        """撤销该图像的上一步，返回被修改的区域；没有可撤销的记录时返回 None"""
+        return self._apply(self._undo, self._redo, key, mask, True)
+
+    def redo(self, key, mask):
+        """重做该图像最近撤销的一步，返回被修改的区域"""
+        return self._apply(self._redo, self._undo, key, mask, False)
+
+    def discard(self, key):
+        """丢弃某张图像的全部历史"""
+        for stacks in (self._undo, self._redo):
+            for step in stacks.pop(key, []):
+                self.total_bytes -= step[2]
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self.total_bytes = 0
+
+    def _enforce_limit(self):
+        while self.total_bytes > self.max_bytes:
+            # 在所有图像的撤销/重做栈中找到最早产生的一步。撤销栈从旧到新排列，最早的在栈底；
+            # 重做栈由撤销依次压入，从新到旧排列，最早的在栈顶
+            oldest = None
+            for stacks, position in ((self._undo, 0), (self._redo, -1)):
+                for key, steps in stacks.items():
+                    if steps and (oldest is None or steps[position][0] < oldest[0]):
+                        oldest = (steps[position][0], stacks, key, position)
+            if oldest is None:
+                break
+            _, stacks, key, position = oldest
+            if position == 0:
+                self.total_bytes -= stacks[key].pop(0)[2]
+                if not stacks[key]:
+                    del stacks[key]
+            else:
+                # 重做栈顶是下一步要重做的修改，之后的各步都建立在它之上，只能整栈丢弃
+                for step in stacks.pop(key):
+                    self.total_bytes -= step[2]
+
+
+def apply_journal_record(mask, record):
+    """将一条笔画日志记录重放到蒙版上。所有记录都是覆盖写入，对已包含该修改的蒙版重放结果不变"""
+    op = record['op']
+    if op == 'stroke':
+        coords = record['points']
+        points = [QPoint(coords[i], coords[i + 1]) for i in range(0, len(coords), 2)]
+        value = 0 if record['erase'] else record.get('value', 255)
+        draw_stroke(mask, points, record['size'], QColor(value, value, value))
+    elif op == 'clear':
+        mask.fill(0)
+    elif op == 'patch':
+        rect = QRect(*record['rect'])
+        data = zlib.decompress(base64.b64decode(record['data']))
+        paste_grayscale_bytes(mask, rect, record['bytes_per_line'], data)
+
+
+class StrokeJournal:
+    """
+    预写式笔画日志（JSON 行）。每次修改蒙版追加一条记录并立即交给操作系统，
+    由后台线程按 JOURNAL_SYNC_INTERVAL 批量 fsync。蒙版写入磁盘后追加 saved 标记；
+    打开文件夹时把各图像最后一个 saved 标记之后的记录重放到已保存的蒙版上。
+    没有未保存的记录时清空日志，否则在日志过大时只保留未保存的记录。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.seq = 0
+        # 图像名 -> 尚未保存的记录
+        self.unsaved = {}
+        for record in self._read():
+            self.seq = max(self.seq, record['seq'])
+            self._track(record)
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._wake = threading.Event()
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stroke-journal', daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break  # 崩溃时写了一半的最后一行
+        return records
+
+    def _track(self, record):
+        op, image = record['op'], record['image']
+        if op == 'saved':
+            remaining = [r for r in self.unsaved.get(image, []) if r['seq'] > record['upto']]
+            if remaining:
+                self.unsaved[image] = remaining
+            else:
+                self.unsaved.pop(image, None)
+        elif op == 'discard':
+            self.unsaved.pop(image, None)
+        else:
+            self.unsaved.setdefault(image, []).append(record)
+
+    def append(self, op, image, **fields):
+        """追加一条记录并返回其序号"""
+        with self._lock:
+            self.seq += 1
+            record = dict(seq=self.seq, op=op, image=image, **fields)
+            self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            # 交给操作系统后进程崩溃也不会丢失；掉电保护由后台批量 fsync 提供
+            self._file.flush()
+            self._track(record)
+        self._wake.set()
+        return record['seq']
+
+    def stroke(self, image, points, size, erase, value=255):
+        """value 为画笔写入的蒙版值；标签图中是类别编号，默认的 255 不写入记录"""
+        coords = [coord for point in points for coord in (point.x(), point.y())]
+        if value == 255 or erase:
+            return self.append('stroke', image, points=coords, size=size, erase=erase)
+        return self.append('stroke', image, points=coords, size=size, erase=erase, value=value)
+
+    def patch(self, image, mask, rect):
+        """记录蒙版 rect 区域修改后的内容（用于超像素填充、撤销和重做）"""
+        bytes_per_line, data = grayscale_bytes(mask, rect)
+        return self.append('patch', image, rect=[rect.x(), rect.y(), rect.width(), rect.height()],
+                           bytes_per_line=bytes_per_line,
+                           data=base64.b64encode(zlib.compress(data, 1)).decode('ascii'))
+
+    def mark_saved(self, image, seq):
+        """序号不超过 seq 的修改已写入磁盘"""
+        self.append('saved', image, upto=seq)
+        self.compact()
+
+    def discard(self, image):
+        """该图像未保存的修改被放弃，不再重放"""
+        if image in self.unsaved:
+            self.append('discard', image)
+            self.compact()
+
+    def pending(self):
+        """返回 {图像名: 需要重放的记录}"""
+        with self._lock:
+            return {image: list(records) for image, records in self.unsaved.items()}
+
+    def compact(self):
+        with self._lock:
+            if not self.unsaved:
+                self._file.truncate(0)
+            elif os.fstat(self._file.fileno()).st_size > JOURNAL_COMPACT_BYTES:
+                records = sorted((r for rs in self.unsaved.values() for r in rs), key=lambda r: r['seq'])
+                data = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records)
+                self._file.close()
+                write_bytes_atomic(data.encode('utf-8'), self.path)
+                self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _sync(self):
+        with self._lock:
+            fd = os.dup(self._file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # 攒够一个间隔的记录后一次 fsync，关闭时立即同步
+            self._closing.wait(JOURNAL_SYNC_INTERVAL)
+            self._wake.clear()
+            self._sync()
+            if self._closing.is_set():
+                return
+
+    def close(self):
+        self._closing.set()
+        self._wake.set()
+        self._thread.join()
+        self.compact()
+        with self._lock:
+            self._file.close()
+
+
+class OverlayCompositor:
+    """
+    基于 NumPy 查找表的蒙版叠加合成。对每个颜色通道预先计算
+    table[蒙版值 * 256 + 底图值] 的混合结果，合成时每个通道只需一次查表，
+    结果直接写入输出 QImage 的像素缓冲区。
+    """
+
+    def __init__(self, color):
+        # RGB32 在内存中的字节顺序取决于字节序
+        self.channels = (2, 1, 0) if sys.byteorder == 'little' else (1, 2, 3)
+        self.alpha_channel = 3 if sys.byteorder == 'little' else 0
+        self._scratch = {}
+        self.set_color(color)
+
+    def set_color(self, color):
+        """设置叠加颜色，透明度取自 color 的 alpha，并按蒙版灰度值线性缩放"""
+        alpha = np.arange(256, dtype=np.float32) / 255 * (color.alpha() / 255)
+        self._build_tables([(color.red(), color.green(), color.blue())] * 256, alpha)
+
+    def set_palette(self, colors):
+        """
+        标签图使用的调色板：colors 为 256 个 QColor，蒙版值 k 的像素按 colors[k] 及其 alpha 叠加。
+        查找表的布局与单色叠加相同，合成时同样每个通道只查一次表。
+        """
+        alpha = np.array([color.alpha() for color in colors], dtype=np.float32) / 255
+        self._build_tables([(color.red(), color.green(), color.blue()) for color in colors], alpha)
+
+    def _build_tables(self, rgb, alpha):
+        base_values = np.arange(256, dtype=np.float32)[None, :]
+        alpha = alpha[:, None]
+        self.tables = []
+        for values in np.array(rgb, dtype=np.float32).T:
+            table = np.rint(base_values + (values[:, None] - base_values) * alpha)
+            self.tables.append(table.astype(np.uint8).ravel())
+
+    def _buffers(self, shape):
+        # 按瓦片尺寸复用的临时缓冲区
+        buffers = self._scratch.get(shape)
+        if buffers is None:
+            buffers = (np.empty(shape, np.uint16), np.empty(shape, np.uint8))
+            self._scratch[shape] = buffers
+        return buffers
+
+    def compose(self, size, image_tile, mask_tile, out=None):
+        """合成瓦片，out 为尺寸相同的 RGB32 图像时直接复用其缓冲区"""
+        if out is None or out.size() != size or out.format() != QImage.Format_RGB32:
+            out = QImage(size, QImage.Format_RGB32)
+        if mask_tile is None:
+            if image_tile is None:
+                out.fill(Qt.white)
+            else:
+                qimage_array(out)[:] = qimage_array(image_tile, writable=False)
+            return out
+        out_array = qimage_array(out)
+        mask_array = qimage_array(mask_tile, writable=False)
+        base_array = qimage_array(image_tile, writable=False) if image_tile is not None else None
+        index, result = self._buffers(mask_array.shape)
+        for channel, table in zip(self.channels, self.tables):
+            if base_array is None:
+                # 白色背景只需按蒙版值查表
+                np.take(table.reshape(256, 256)[:, 255], mask_array, out=result)
+            else:
+                np.multiply(mask_array, 256, out=index, dtype=np.uint16)
+                np.bitwise_or(index, base_array[..., channel], out=index)
+                np.take(table, index, out=result, mode='clip')
+            out_array[..., channel] = result
+        out_array[..., self.alpha_channel] = 255
+        return out
+
+
+class ShardArchive:
+    """
+    原地读取 tar / zip 归档中的图像。首次打开时顺序扫描一遍成员，把每个图像成员的数据偏移、
+    长度和压缩方式保存到 .iw_anno/shards/<归档名>.sqlite；之后归档大小和修改时间不变就直接复用索引，
+    读取成员时按偏移从内存映射中切片，不再解析归档。只支持未压缩的 tar 和存储/deflate 方式的 zip。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+        # 归档位于 <主文件夹>/images/ 下，索引和其他工具数据一样放在主文件夹的 .iw_anno 中
+        main_folder = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+        index_path = app_data_path(main_folder, 'shards', os.path.basename(path) + '.sqlite')
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            "name TEXT PRIMARY KEY, offset INTEGER NOT NULL, stored_size INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, compression INTEGER NOT NULL)"
+        )
+        # 成员的图像尺寸在第一次查询时读取文件头得到
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS dimensions (name TEXT PRIMARY KEY, width INTEGER, height INTEGER)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        if row is None or row[0] != self.signature:
+            self._build_index()
+        self._file = open(path, 'rb')
+        # 空文件不能映射；映射失败时退回到按偏移 seek 读取
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self._map = None
+
+    def _scan_tar(self):
+        with tarfile.open(self.path, 'r:') as tar:
+            for info in tar:
+                if info.isfile() and info.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield info.name, info.offset_data, info.size, info.size, zipfile.ZIP_STORED
+
+    def _scan_zip(self):
+        with zipfile.ZipFile(self.path) as archive, open(self.path, 'rb') as f:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or info.flag_bits & 0x1:
+                    print(f"Skipping {info.filename} in {self.path}: unsupported compression or encryption")
+                    continue
+                # 中央目录里的扩展字段长度可能与本地文件头不同，数据偏移要以本地文件头为准
+                f.seek(info.header_offset)
+                header = f.read(30)
+                name_length, extra_length = struct.unpack('<HH', header[26:30])
+                offset = info.header_offset + 30 + name_length + extra_length
+                yield info.filename, offset, info.compress_size, info.file_size, info.compress_type
+
+    @PROFILER.timed('shard_index')
+    def _build_index(self):
+        scan = self._scan_zip if zipfile.is_zipfile(self.path) else self._scan_tar
+        self.db.execute("DELETE FROM members")
+        self.db.execute("DELETE FROM dimensions")
+        # 同名成员以归档中最后出现的为准，与解包后的结果一致
+        self.db.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)", scan())
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('signature', ?)", (self.signature,))
+        self.db.commit()
+
+    def members(self):
+        """归档内全部图像成员的名称及未压缩大小"""
+        with self._lock:
+            return self.db.execute("SELECT name, size FROM members").fetchall()
+
+    def contains(self, member):
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM members WHERE name = ?", (member,)).fetchone() is not None
+
+    @PROFILER.timed('shard_read')
+    def read(self, member, limit=None):
+        """读取成员的完整内容（指定 limit 时只读取开头约 limit 字节）；成员不存在时抛出 KeyError"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT offset, stored_size, compression FROM members WHERE name = ?", (member,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(member)
+            offset, stored_size, compression = row
+            if limit is not None:
+                stored_size = min(stored_size, limit)
+            if self._map is not None:
+                data = self._map[offset:offset + stored_size]
+            else:
+                self._file.seek(offset)
+                data = self._file.read(stored_size)
+        if compression == zipfile.ZIP_DEFLATED:
+            # 截断的压缩数据用解压对象解出已有的部分
+            data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+        return data
+
+    def image_size(self, member):
+        """
+        成员图像的尺寸。先只解析文件头（通常足以得到尺寸），解析不出时再读取整个成员；
+        结果写入索引，之后直接返回。
+        """
+        with self._lock:
+            row = self.db.execute("SELECT width, height FROM dimensions WHERE name = ?", (member,)).fetchone()
+        if row is not None:
+            return QSize(*row)
+        size = QSize()
+        for limit in (SHARD_HEADER_BYTES, None):
+            buffer = QBuffer()
+            buffer.setData(QByteArray(self.read(member, limit)))
+            buffer.open(QIODevice.ReadOnly)
+            size = QImageReader(buffer).size()
+            if size.isValid():
+                break
+        if size.isValid():
+            with self._lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO dimensions (name, width, height) VALUES (?, ?, ?)",
+                    (member, size.width(), size.height())
+                )
+                self.db.commit()
+        return size
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+            self._file.close()
+            self.db.close()
+
+
+_shard_archives = {}
+_shard_archives_lock = threading.Lock()
+
+
+def shard_archive(path, refresh=False):
+    """
+    返回归档的共享读取器（进程内按路径缓存）。refresh 为 True 时检查归档是否被替换，
+    变化后重新打开并重建成员索引。
+    """
+    path = os.path.abspath(path)
+    with _shard_archives_lock:
+        archive = _shard_archives.get(path)
+        if archive is not None and refresh:
+            stat = os.stat(path)
+            if archive.signature != f"{stat.st_size}:{stat.st_mtime_ns}":
+                # 旧读取器可能仍被其他线程使用，交给垃圾回收关闭
+                archive = None
+        if archive is None:
+            archive = _shard_archives[path] = ShardArchive(path)
+        return archive
+
+
+class DatasetIndex:
+    """
+    保存在主文件夹中的持久化数据集索引（SQLite），记录文件名、自然排序键、
+    文件大小、修改时间和蒙版状态。通过 os.scandir 增量同步：目录修改时间未变时
+    不扫描，扫描时也只更新发生变化的条目。
+    images/ 下的 tar / zip 归档按成员展开为 "<归档名>/<成员路径>" 条目。
+    """
+
+    def __init__(self, main_folder):
+        path = app_data_path(main_folder, 'index.sqlite')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # 索引可以随时从文件系统重建，不需要每次提交都落盘
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "name TEXT PRIMARY KEY, sort_key TEXT NOT NULL, size INTEGER, "
+            "mtime_ns INTEGER, has_mask INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS images_sort_key ON images (sort_key)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+            self.db.commit()
+
+    def _folder_changed(self, folder, key, recursive=False):
+        """
+        目录自上次同步后是否有文件增删；返回 (是否变化, 当前目录修改时间)。
+        recursive 为 True 时一并比较归档子目录树中各目录的修改时间。
+        """
+        mtime_ns = str(file_mtime_ns(folder))
+        if recursive and os.path.isdir(folder):
+            with os.scandir(folder) as entries:
+                roots = [entry.path for entry in entries if entry.name.lower().endswith(SHARD_EXTENSIONS) and entry.is_dir()]
+            digest = hashlib.sha1()
+            for root in sorted(roots):
+                for path, _, _ in os.walk(root):
+                    digest.update(f"{path}:{file_mtime_ns(path)}\n".encode('utf-8'))
+            if roots:
+                mtime_ns += ':' + digest.hexdigest()
+        return self.get_meta(key) != mtime_ns, mtime_ns
+
+    def sync(self, image_folder, mask_folder):
+        """与文件系统增量同步，返回是否有条目发生变化"""
+        changed = False
+        images_changed, images_mtime = self._folder_changed(image_folder, 'images_mtime_ns')
+        # 旧版本建立的索引没有记录归档列表，需要重新扫描一次
+        images_changed = images_changed or self.get_meta('archives') is None
+        if images_changed:
+            with self._lock:
+                stored = {
+                    name: (size, mtime_ns)
+                    for name, size, mtime_ns in self.db.execute("SELECT name, size, mtime_ns FROM images")
+                    if '/' not in name
+                }
+            updates = []
+            present = set()
+            archives = []
+            with os.scandir(image_folder) as entries:
+                for entry in entries:
+                    lower = entry.name.lower()
+                    if lower.endswith(SHARD_EXTENSIONS) and entry.is_file():
+                        archives.append(entry.name)
+                        continue
+                    if not lower.endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                        continue
+                    present.add(entry.name)
+                    stat = entry.stat()
+                    if stored.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                        updates.append((entry.name, natural_sort_key(entry.name), stat.st_size, stat.st_mtime_ns))
+            removed = [(name,) for name in stored if name not in present]
+            with self._lock:
+                self.db.executemany(
+                    "INSERT INTO images (name, sort_key, size, mtime_ns) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns",
+                    updates
+                )
+                self.db.executemany("DELETE FROM images WHERE name = ?", removed)
+                self.db.commit()
+            self.set_meta('images_mtime_ns', images_mtime)
+            self.set_meta('archives', json.dumps(sorted(archives)))
+            changed = bool(updates or removed)
+        # 归档可能被原地替换而不改变目录修改时间，每次同步都检查归档自身的大小和修改时间
+        archives_changed = self._sync_archives(image_folder, json.loads(self.get_meta('archives', '[]')))
+        changed = changed or archives_changed
+
+        masks_changed, masks_mtime = self._folder_changed(mask_folder, 'masks_mtime_ns', recursive=True)
+        if images_changed or archives_changed or masks_changed:
+            mask_stems = set()
+            # 归档成员的蒙版位于以归档名命名的子目录中，主名使用相对 mask_folder 的路径
+            for folder, subfolders, files in os.walk(mask_folder):
+                prefix = os.path.relpath(folder, mask_folder).replace(os.sep, '/')
+                prefix = '' if prefix == '.' else prefix + '/'
+                if not prefix:
+                    subfolders[:] = [name for name in subfolders if name.lower().endswith(SHARD_EXTENSIONS)]
+                for name in files:
+                    if name.endswith(RLE_SUFFIX):
+                        mask_stems.add(prefix + name[:-len(RLE_SUFFIX)])
+                    elif name.lower().endswith('.png'):
+                        mask_stems.add(prefix + os.path.splitext(name)[0])
+            with self._lock:
+                flips = [
+                    (int(not has_mask), name)
+                    for name, has_mask in self.db.execute("SELECT name, has_mask FROM images")
+                    if (os.path.splitext(name)[0] in mask_stems) != bool(has_mask)
+                ]
+                self.db.executemany("UPDATE images SET has_mask = ? WHERE name = ?", flips)
+                self.db.commit()
+            self.set_meta('masks_mtime_ns', masks_mtime)
+            changed = changed or bool(flips)
+        return changed
+
+    def _sync_archives(self, image_folder, archives):
+        """同步归档成员；成员名为 "<归档名>/<成员路径>"，大小取未压缩大小，修改时间取归档的修改时间"""
+        changed = False
+        signatures = json.loads(self.get_meta('archive_signatures', '{}'))
+        for name in set(signatures) - set(archives):
+            with self._lock:
+                self.db.execute("DELETE FROM images WHERE substr(name, 1, ?) = ?", (len(name) + 1, name + '/'))
+                self.db.commit()
+            del signatures[name]
+            changed = True
+        for name in archives:
+            path = os.path.join(image_folder, name)
+            try:
+                stat = os.stat(path)
+                signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+                if signatures.get(name) == signature:
+                    continue
+                members = shard_archive(path, refresh=True).members()
+            except (OSError, tarfile.TarError, zipfile.BadZipFile, sqlite3.Error) as e:
+                print(f"Failed to index archive {path}: {e}")
+                continue
+            with self._lock:
+                self.db.execute("DELETE FROM images WHERE substr(name, 1, ?) = ?", (len(name) + 1, name + '/'))
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO images (name, sort_key, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                    ((f"{name}/{member}", natural_sort_key(f"{name}/{member}"), size, stat.st_mtime_ns)
+                     for member, size in members)
+                )
+                self.db.commit()
+            signatures[name] = signature
+            changed = True
+        if changed:
+            self.set_meta('archive_signatures', json.dumps(signatures))
+        return changed
+
+    def names(self):
+        """按自然顺序返回全部图像文件名"""
+        with self._lock:
+            return [row[0] for row in self.db.execute("SELECT name FROM images ORDER BY sort_key")]
+
+    def next_unannotated(self, after_name=None):
+        """返回自然顺序中 after_name 之后第一张没有蒙版的图像，到末尾后从头查找"""
+        with self._lock:
+            row = None
+            if after_name is not None:
+                row = self.db.execute(
+                    "SELECT name FROM images WHERE has_mask = 0 AND sort_key > "
+                    "(SELECT sort_key FROM images WHERE name = ?) ORDER BY sort_key LIMIT 1",
+                    (after_name,)
+                ).fetchone()
+            if row is None:
+                row = self.db.execute(
+                    "SELECT name FROM images WHERE has_mask = 0 ORDER BY sort_key LIMIT 1"
+                ).fetchone()
+        return row[0] if row else None
+
+    def annotated(self):
+        """按自然顺序返回有蒙版的图像文件名"""
+        with self._lock:
+            return [row[0] for row in self.db.execute("SELECT name FROM images WHERE has_mask = 1 ORDER BY sort_key")]
+
+    def set_has_mask(self, name, has_mask):
+        with self._lock:
+            self.db.execute("UPDATE images SET has_mask = ? WHERE name = ?", (int(has_mask), name))
+            self.db.commit()
+
+    def remove(self, name):
+        with self._lock:
+            self.db.execute("DELETE FROM images WHERE name = ?", (name,))
+            self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def count_components(binary):
+    """
+    统计二值数组中 8 邻接连通区域的个数。先逐行提取前景游程，再用向量化的并查集
+    合并上下两行中相接（含对角相接）的游程，开销与游程数而不是像素数成正比。
+    """
+    height, width = binary.shape
+    padded = np.zeros((height, width + 2), np.int8)
+    padded[:, 1:-1] = binary
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    count = rows.size
+    if count == 0:
+        return 0
+    # 游程按 (行, 列) 编码为全局有序的键，便于用二分查找定位上一行中相接的游程
+    stride = width + 2
+    rows = rows.astype(np.int64)
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    above = (rows - 1) * stride
+    # 上一行游程 [sa, ea) 与本行游程 [sb, eb) 8 邻接相接的条件：ea >= sb 且 sa <= eb
+    lo = np.searchsorted(end_keys, above + starts, 'left')
+    hi = np.searchsorted(start_keys, above + ends, 'right')
+    links = np.maximum(hi - lo, 0)
+    b = np.repeat(np.arange(count), links)
+    offsets = np.arange(links.sum()) - np.repeat(np.cumsum(links) - links, links)
+    a = np.repeat(lo, links) + offsets
+    parent = np.arange(count)
+    while True:
+        # 路径压缩到根，再把每条仍跨越两棵树的边的较大根挂到较小根下
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+        root_a, root_b = parent[a], parent[b]
+        differ = root_a != root_b
+        if not differ.any():
+            break
+        a, b, root_a, root_b = a[differ], b[differ], root_a[differ], root_b[differ]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+    return int(np.count_nonzero(parent == np.arange(count)))
+
+
+def mask_statistics(image_path, mask_path, label_mode=False):
+    """
+    统计单张图像蒙版的尺寸、前景比例、连通区域数和非二值像素数。
+    标签图中任何非零类别都算前景，不统计非二值像素，改为列出出现的类别。
+    """
+    image_size = read_image_size(image_path)
+    mask = read_mask_file(mask_path)
+    array = qimage_array(mask, writable=False)
+    binary = array > 0 if label_mode else array >= 128
+    if label_mode:
+        gray = 0
+        classes = ",".join(str(value) for value in np.flatnonzero(np.bincount(array.ravel(), minlength=256)[1:]) + 1)
+    else:
+        gray = int(np.count_nonzero((array != 0) & (array != 255)))
+        classes = None
+    return {
+        'width': image_size.width(), 'height': image_size.height(),
+        'mask_width': mask.width(), 'mask_height': mask.height(),
+        'foreground': np.count_nonzero(binary) / max(array.size, 1),
+        'components': count_components(binary),
+        'gray': gray,
+        'classes': classes,
+    }
+
+
+def mask_statistics_task(name, image_path, mask_path, label_mode=False):
+    """进程池中执行的统计任务，出错时返回错误信息而不是抛出异常"""
+    try:
+        return name, mask_statistics(image_path, mask_path, label_mode), None
+    except Exception as e:
+        return name, None, str(e)
+
+
+class DatasetStats:
+    """
+    数据集质检统计，按图像和蒙版的修改时间缓存在主文件夹的 SQLite 中；
+    update 只重新统计文件发生变化（或标签图模式切换过）的图像，统计在进程池中并行进行。
+    """
+    COLUMNS = ('width', 'height', 'mask_width', 'mask_height', 'foreground', 'components', 'gray', 'classes')
+
+    def __init__(self, main_folder):
+        path = app_data_path(main_folder, 'stats.sqlite')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = OFF")
+        # 缓存表结构来自旧版本时直接重建，统计会在下次 update 时补齐
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(stats)")}
+        if columns and 'label_mode' not in columns:
+            self.db.execute("DROP TABLE stats")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats ("
+            "name TEXT PRIMARY KEY, image_mtime_ns INTEGER, mask_mtime_ns INTEGER, label_mode INTEGER, "
+            "width INTEGER, height INTEGER, mask_width INTEGER, mask_height INTEGER, "
+            "foreground REAL, components INTEGER, gray INTEGER, classes TEXT, error TEXT)"
+        )
+        self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def stale(self, names, image_folder, mask_folder, label_mode=False):
+        """返回图像或蒙版修改时间与缓存不一致、或按另一种蒙版模式统计的条目 [(名称, 图像时间, 蒙版时间)]"""
+        with self._lock:
+            cached = {
+                row[0]: (row[1], row[2])
+                for row in self.db.execute(
+                    "SELECT name, image_mtime_ns, mask_mtime_ns FROM stats WHERE label_mode = ?", (int(label_mode),)
+                )
+            }
+        stale = []
+        for name in names:
+            mtimes = (
+                file_mtime_ns(os.path.join(image_folder, name)),
+                mask_mtime_ns(os.path.join(mask_folder, os.path.splitext(name)[0] + '.png')),
+            )
+            if cached.get(name) != mtimes:
+                stale.append((name, *mtimes))
+        return stale
+
+    def _store(self, rows):
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO stats (name, image_mtime_ns, mask_mtime_ns, label_mode, "
+                + ", ".join(self.COLUMNS) + ", error) VALUES (?, ?, ?, ?, " + ", ".join("?" * len(self.COLUMNS)) + ", ?)",
+                rows
+            )
+            self.db.commit()
+
+    def update(self, image_folder, mask_folder, names, jobs=BATCH_JOBS, progress=None, cancel=None,
+               label_mode=False):
+        """
+        重新统计发生变化的图像并删除已不存在的条目，返回重新统计的数量。
+        progress(完成数, 总数) 用于报告进度；cancel 为 threading.Event，置位后尽快停止；
+        label_mode 为 True 时按多类别标签图统计。
+        """
+        with self._lock:
+            cached = {row[0] for row in self.db.execute("SELECT name FROM stats")}
+            removed = cached - set(names)
+            self.db.executemany("DELETE FROM stats WHERE name = ?", [(name,) for name in removed])
+            self.db.commit()
+        stale = self.stale(names, image_folder, mask_folder, label_mode)
+        # 没有蒙版的图像不需要统计
+        rows = [(name, image_mtime, None, int(label_mode)) + (None,) * len(self.COLUMNS) + (None,)
+                for name, image_mtime, mask_mtime in stale if mask_mtime is None]
+        self._store(rows)
+        tasks = [(name, image_mtime, mask_mtime) for name, image_mtime, mask_mtime in stale if mask_mtime is not None]
+        if not tasks:
+            return len(stale)
+        mtimes = {name: (image_mtime, mask_mtime, int(label_mode)) for name, image_mtime, mask_mtime in tasks}
+        arguments = (
+            [name for name, _, _ in tasks],
+            [os.path.join(image_folder, name) for name, _, _ in tasks],
+            [os.path.join(mask_folder, os.path.splitext(name)[0] + '.png') for name, _, _ in tasks],
+            [label_mode] * len(tasks),
+        )
+        with contextlib.ExitStack() as stack:
+            if len(tasks) <= QA_INLINE_LIMIT or jobs <= 1:
+                results = map(mask_statistics_task, *arguments)
+            else:
+                pool = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=jobs, mp_context=multiprocessing.get_context('spawn')
+                ))
+                stack.callback(pool.shutdown, wait=False, cancel_futures=True)
+                chunksize = max(1, min(32, len(tasks) // (jobs * 8)))
+                results = pool.map(mask_statistics_task, *arguments, chunksize=chunksize)
+            rows = []
+            for done, (name, stats, error) in enumerate(results, 1):
+                stats = stats or {}
+                rows.append((name, *mtimes[name]) + tuple(stats.get(column) for column in self.COLUMNS) + (error,))
+                # 分批写入，中断后已完成的部分不必重算
+                if len(rows) >= 256:
+                    self._store(rows)
+                    rows = []
+                if progress is not None:
+                    progress(done, len(tasks))
+                if cancel is not None and cancel.is_set():
+                    break
+            self._store(rows)
+        return len(stale)
+
+    def records(self):
+        """按名称返回全部缓存的统计结果（字典），并附上 flags 列表"""
+        with self._lock:
+            cursor = self.db.execute("SELECT name, mask_mtime_ns, " + ", ".join(self.COLUMNS) + ", error FROM stats")
+            rows = cursor.fetchall()
+        records = {}
+        for name, mask_mtime, *values, error in rows:
+            record = dict(zip(self.COLUMNS, values), has_mask=mask_mtime is not None, error=error)
+            record['classes'] = [int(value) for value in record['classes'].split(",") if value] \
+                if record['classes'] is not None else None
+            record['flags'] = self.flags(record)
+            records[name] = record
+        return records
+
+    @staticmethod
+    def flags(record):
+        """根据统计结果给出质检标记（QA_FLAGS 的键）"""
+        if not record['has_mask']:
+            return ['no_mask']
+        if record['error'] is not None or record['foreground'] is None:
+            return []
+        flags = []
+        if record['foreground'] == 0:
+            flags.append('empty')
+        elif record['foreground'] < QA_TINY_RATIO:
+            flags.append('tiny')
+        elif record['foreground'] > QA_HUGE_RATIO:
+            flags.append('huge')
+        if (record['width'], record['height']) != (record['mask_width'], record['mask_height']):
+            flags.append('size_mismatch')
+        if record['gray']:
+            flags.append('not_binary')
+        return flags
+
+
+def read_image_bytes(image_path):
+    """图像文件或归档成员的原始字节"""
+    shard = split_shard_path(image_path)
+    if shard is not None:
+        return shard_archive(shard[0]).read(shard[1])
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+
+def mask_png_bytes(mask_path):
+    """蒙版的 8 位 PNG 字节：本来就是 8 位 PNG 时直接读取文件，其他格式解码后重新编码"""
+    if stored_mask_format(mask_path) == 'png':
+        with open(mask_path, 'rb') as f:
+            return f.read()
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    read_mask_file(mask_path).save(buffer, 'PNG')
+    return bytes(buffer.data())
+
+
+class ShardExporter:
+    """
+    把已标注的图像和蒙版流式导出为定长的 tar 分片（webdataset 布局：<主名>.<扩展名> 为图像，
+    <主名>.mask.png 为 8 位蒙版），并维护 manifest.json。每个样本所在的分片记录在导出目录的
+    export.sqlite 中：新样本追加到最后一个未满的分片，修改或删除样本只把它所在的分片标记为待重写。
+    删除后分片变小而不重新平衡，以免牵动其他分片。start() 后台线程在出现变化的 delay 秒后
+    批量重写待重写的分片，训练数据与标注保持几分钟以内的差距而不需要全量重建。
+    """
+
+    def __init__(self, main_folder, output=None, shard_size=EXPORT_SHARD_SAMPLES, delay=EXPORT_DELAY_SECONDS):
+        self.image_folder = os.path.join(main_folder, 'images')
+        self.mask_folder = os.path.join(main_folder, 'masks')
+        self.output = output or os.path.join(main_folder, 'export')
+        self.delay = delay
+        os.makedirs(self.output, exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.output, 'export.sqlite'), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "name TEXT PRIMARY KEY, shard INTEGER NOT NULL, image_mtime_ns INTEGER, mask_mtime_ns INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS samples_shard ON samples (shard)")
+        # generation 每次标记都会递增，flush 只在重写期间没有新标记时才清除 dirty
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "id INTEGER PRIMARY KEY, dirty INTEGER NOT NULL, generation INTEGER NOT NULL DEFAULT 0)"
+        )
+        if 'generation' not in {row[1] for row in self.db.execute("PRAGMA table_info(shards)")}:
+            self.db.execute("ALTER TABLE shards ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'shard_size'").fetchone()
+        if row is None:
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('shard_size', ?)", (str(shard_size),))
+            self.shard_size = shard_size
+        else:
+            # 已有导出沿用原来的分片大小，改变大小需要重建
+            self.shard_size = int(row[0])
+        self.db.commit()
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _mask_path(self, name):
+        return os.path.join(self.mask_folder, os.path.splitext(name)[0] + '.png')
+
+    def _mtimes(self, name):
+        return file_mtime_ns(os.path.join(self.image_folder, name)), mask_mtime_ns(self._mask_path(name))
+
+    def _mark(self, shards):
+        """在持有锁的事务中把分片标记为待重写"""
+        shards = [(shard,) for shard in shards]
+        self.db.executemany("INSERT OR IGNORE INTO shards (id, dirty) VALUES (?, 1)", shards)
+        self.db.executemany("UPDATE shards SET dirty = 1, generation = generation + 1 WHERE id = ?", shards)
+
+    def _apply(self, names):
+        """在持有锁的事务中更新 names 的记录：新增、修改或（蒙版已不存在时）删除；返回变化的数量"""
+        stored = {}
+        for chunk in range(0, len(names), 500):
+            part = names[chunk:chunk + 500]
+            stored.update(
+                (name, (shard, image_mtime, mask_mtime)) for name, shard, image_mtime, mask_mtime in self.db.execute(
+                    f"SELECT name, shard, image_mtime_ns, mask_mtime_ns FROM samples WHERE name IN "
+                    f"({', '.join('?' * len(part))})", part
+                )
+            )
+        last = self.db.execute("SELECT shard, COUNT(*) FROM samples GROUP BY shard ORDER BY shard DESC LIMIT 1").fetchone()
+        last_shard, last_count = last if last else (-1, self.shard_size)
+        dirty = set()
+        changed = 0
+        for name in names:
+            image_mtime, mask_mtime = self._mtimes(name)
+            entry = stored.get(name)
+            if mask_mtime is None or image_mtime is None:
+                if entry is not None:
+                    self.db.execute("DELETE FROM samples WHERE name = ?", (name,))
+                    dirty.add(entry[0])
+                    changed += 1
+                continue
+            if entry is not None:
+                if entry[1:] == (image_mtime, mask_mtime):
+                    continue
+                shard = entry[0]
+            else:
+                if last_count >= self.shard_size:
+                    last_shard, last_count = last_shard + 1, 0
+                shard = last_shard
+                last_count += 1
+            self.db.execute(
+                "INSERT OR REPLACE INTO samples (name, shard, image_mtime_ns, mask_mtime_ns) VALUES (?, ?, ?, ?)",
+                (name, shard, image_mtime, mask_mtime)
+            )
+            dirty.add(shard)
+            changed += 1
+        self._mark(dirty)
+        self.db.commit()
+        return changed
+
+    def update(self, name):
+        """图像的蒙版已保存（或已删除）；只标记所在分片，实际重写在后台进行"""
+        self.update_many([name])
+
+    def update_many(self, names):
+        with self._lock:
+            changed = self._apply(list(names))
+        if changed:
+            self._changed.set()
+        return changed
+
+    def remove(self, name):
+        """图像已从数据集删除"""
+        with self._lock:
+            row = self.db.execute("SELECT shard FROM samples WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return
+            self.db.execute("DELETE FROM samples WHERE name = ?", (name,))
+            self._mark([row[0]])
+            self.db.commit()
+        self._changed.set()
+
+    def sync(self, names):
+        """与数据集全量对齐（用于启动和命令行）：names 为当前有蒙版的图像，其他已导出的样本被删除"""
+        names = list(names)
+        with self._lock:
+            exported = [row[0] for row in self.db.execute("SELECT name FROM samples")]
+        wanted = set(names)
+        return self.update_many(names + [name for name in exported if name not in wanted])
+
+    def rebuild_all(self):
+        """把所有分片标记为待重写（导出文件被删除或损坏时使用）"""
+        with self._lock:
+            self.db.execute("UPDATE shards SET dirty = 1, generation = generation + 1")
+            self.db.commit()
+
+    def shard_path(self, shard):
+        return os.path.join(self.output, f"shard-{shard:06d}.tar")
+
+    def _write_shard(self, shard, names):
+        path = self.shard_path(shard)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with tarfile.open(tmp_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+                for name in sorted(names, key=natural_sort_key):
+                    key, ext = os.path.splitext(name)
+                    mask_path = self._mask_path(name)
+                    try:
+                        members = (
+                            (key + ext.lower(), read_image_bytes(os.path.join(self.image_folder, name))),
+                            (key + '.mask.png', mask_png_bytes(mask_path)),
+                        )
+                    except (OSError, KeyError, AttributeError) as e:
+                        # 文件在标记之后被删除；下一次 update 会移除该样本
+                        print(f"Skipping {name} in export: {e}")
+                        continue
+                    mtime = (mask_mtime_ns(mask_path) or 0) / 1e9
+                    for member, data in members:
+                        info = tarfile.TarInfo(member)
+                        info.size = len(data)
+                        info.mtime = mtime
+                        tar.addfile(info, io.BytesIO(data))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @PROFILER.timed('export_flush')
+    def flush(self, progress=None):
+        """重写所有待重写的分片并更新清单，返回重写的分片数"""
+        with self._lock:
+            dirty = self.db.execute("SELECT id, generation FROM shards WHERE dirty = 1 ORDER BY id").fetchall()
+        written = 0
+        for done, (shard, generation) in enumerate(dirty):
+            with self._lock:
+                names = [row[0] for row in self.db.execute("SELECT name FROM samples WHERE shard = ?", (shard,))]
+            try:
+                if names:
+                    self._write_shard(shard, names)
+                else:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.shard_path(shard))
+            except OSError as e:
+                # 标记保持不变，下一次 flush 重试
+                print(f"Failed to write export shard {shard}: {e}")
+                continue
+            # 写完后才清除标记；重写期间又被标记过（generation 已变化）的分片留给下一次 flush
+            with self._lock:
+                self.db.execute("UPDATE shards SET dirty = 0 WHERE id = ? AND generation = ?", (shard, generation))
+                self.db.commit()
+            written += 1
+            if progress is not None:
+                progress(done + 1, len(dirty))
+        if dirty:
+            self._write_manifest()
+        return written
+
+    def _write_manifest(self):
+        with self._lock:
+            rows = self.db.execute("SELECT shard, COUNT(*) FROM samples GROUP BY shard ORDER BY shard").fetchall()
+        shards = []
+        for shard, count in rows:
+            path = self.shard_path(shard)
+            size = os.path.getsize(path) if os.path.exists(path) else None
+            shards.append({'file': os.path.basename(path), 'samples': count, 'bytes': size})
+        manifest = {
+            'format': 'webdataset-tar',
+            'shard_size': self.shard_size,
+            'samples': sum(count for _, count in rows),
+            'updated': time.time(),
+            'shards': shards,
+        }
+        write_bytes_atomic(json.dumps(manifest, indent=1).encode('utf-8'), os.path.join(self.output, 'manifest.json'))
+
+    def start(self, names=None):
+        """启动后台导出线程；names 为当前有蒙版的图像时先在后台与数据集对齐"""
+        self._thread = threading.Thread(target=self._run, args=(names,), name='shard-export', daemon=True)
+        self._thread.start()
+
+    def _run(self, names):
+        if names is not None:
+            self.sync(names)
+        self.flush()
+        while not self._stop.is_set():
+            self._changed.wait()
+            # 第一次变化之后再等 delay 秒，把这段时间内的修改合并到一次重写中
+            self._changed.clear()
+            self._stop.wait(self.delay)
+            self.flush()
+
+    def stop(self):
+        """停止后台线程，并在退出前写完待重写的分片"""
+        if self._thread is not None:
+            self._stop.set()
+            self._changed.set()
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self.db.close()
+
+
+class LeaseManager:
+    """
+    多名标注员共享同一主文件夹时，用租约文件 .iw_anno/leases/<图像名>.lease 协调各自标注的图像。
+    租约以 O_EXCL 方式创建，由后台线程定期续期；实例退出时释放，崩溃后过期即可被其他实例接管。
+    """
+
+    def __init__(self, main_folder, owner=None, duration=LEASE_SECONDS, heartbeat=LEASE_HEARTBEAT_SECONDS):
+        self.folder = app_data_path(main_folder, 'leases')
+        os.makedirs(self.folder, exist_ok=True)
+        self.owner = owner or f"{getpass.getuser()}@{socket.gethostname()}:{os.getpid()}"
+        self.duration = duration
+        self.held = set()
+        # 续期时发现已被他人接管的租约
+        self.lost = set()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, args=(heartbeat,), name='lease-heartbeat', daemon=True)
+        self._thread.start()
+
+    def _path(self, name):
+        # 归档成员的图像名带有子路径，租约文件统一放在同一目录下
+        return os.path.join(self.folder, f"{name.replace('/', '%2F')}.lease")
+
+    def _content(self):
+        return json.dumps({'owner': self.owner, 'expires': time.time() + self.duration}).encode('utf-8')
+
+    def _read(self, path):
+        """返回租约内容；文件不存在时返回 None，刚创建尚未写入内容时返回空字典"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        try:
+            lease = json.loads(data)
+        except ValueError:
+            lease = {}
+        lease.setdefault('expires', mtime + self.duration)
+        return lease
+
+    def holder(self, name):
+        """返回持有该图像有效租约的实例，没有时返回 None"""
+        lease = self._read(self._path(name))
+        if lease is None or lease['expires'] < time.time():
+            return None
+        return lease.get('owner', '')
+
+    def held_by_other(self, name):
+        if name in self.held:
+            return False
+        holder = self.holder(name)
+        return holder is not None and holder != self.owner
+
+    def acquire(self, name):
+        """尝试认领该图像，成功（或已持有）时返回 True"""
+        with self._lock:
+            if name in self.held:
+                return True
+            path = self._path(name)
+            for _ in range(2):
+                try:
+                    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except FileExistsError:
+                    lease = self._read(path)
+                    if lease is not None and lease.get('owner') == self.owner:
+                        self.held.add(name)
+                        return True
+                    if lease is not None and lease['expires'] >= time.time():
+                        return False
+                    if lease is None:
+                        continue
+                    # 接管过期的租约：先改名，再确认改名拿到的正是刚才读到的过期租约。
+                    # 另一实例可能已抢先接管并创建了新租约，这时把它放回原处并放弃
+                    stale = f"{path}.{uuid.uuid4().hex}.stale"
+                    try:
+                        os.rename(path, stale)
+                    except FileNotFoundError:
+                        continue
+                    if self._read(stale) != lease:
+                        try:
+                            # 用硬链接放回，不覆盖此间又被创建的租约
+                            os.link(stale, path)
+                        except FileExistsError:
+                            pass
+                        os.remove(stale)
+                        return False
+                    os.remove(stale)
+                    continue
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self._content())
+                self.held.add(name)
+                self.lost.discard(name)
+                return True
+            return False
+
+    def acquire_batch(self, names, count, start=0):
+        """
+        从 names[start] 开始按顺序（到末尾后回到开头）认领最多 count 张未被他人持有的图像，返回新认领的图像。
+        多名标注员从各自不同的位置开始，可以各取一段而不必争抢同一批图像。
+        """
+        names = list(names)
+        acquired = []
+        for name in names[start:] + names[:start]:
+            if len(acquired) >= count:
+                break
+            if name not in self.held and self.acquire(name):
+                acquired.append(name)
+        return acquired
+
+    def release(self, name):
+        with self._lock:
+            if name not in self.held:
+                return
+            self.held.discard(name)
+            path = self._path(name)
+            lease = self._read(path)
+            if lease is not None and lease.get('owner') == self.owner:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def renew(self):
+        """续期全部持有的租约；已被他人接管的租约移入 lost"""
+        with self._lock:
+            for name in list(self.held):
+                path = self._path(name)
+                lease = self._read(path)
+                if lease is None or lease.get('owner') != self.owner:
+                    self.held.discard(name)
+                    self.lost.add(name)
+                    continue
+                try:
+                    write_bytes_atomic(self._content(), path)
+                except OSError as e:
+                    print(f"Failed to renew lease {name}: {e}")
+
+    def _heartbeat(self, interval):
+        while not self._stop.wait(interval):
+            self.renew()
+
+    def stop(self):
+        """停止续期并释放全部租约"""
+        self._stop.set()
+        self._thread.join()
+        for name in list(self.held):
+            self.release(name)
+
+
+class SuperpixelEngine:
+    """
+    在后台进程池中为即将浏览的图像计算超像素，结果以图像修改时间为键缓存到磁盘。
+    查询从不阻塞：磁盘上还没有结果时返回 None 并优先提交计算。
+    """
+
+    def __init__(self, workers=SUPERPIXEL_WORKERS, max_bytes=SUPERPIXEL_CACHE_BYTES):
+        self.workers = workers
+        self.executor = None
+        # 缓存路径 -> future；完成回调在进程池的管理线程中执行，访问需持有锁。
+        # Future.cancel() 会在当前线程同步调用完成回调，因此使用可重入锁
+        self.futures = {}
+        self._lock = threading.RLock()
+        self.cache = LRUCache(max_bytes)
+
+    @staticmethod
+    def cache_path(cache_dir, image_path):
+        return os.path.join(cache_dir, f"{image_stem(image_path)}_{file_mtime_ns(image_path)}.npy")
+
+    def schedule(self, cache_dir, image_paths):
+        """按顺序提交尚未计算的图像；不在列表中且尚未开始的旧任务会被取消"""
+        wanted = {self.cache_path(cache_dir, path): path for path in image_paths}
+        with self._lock:
+            for cache_path, future in list(self.futures.items()):
+                if cache_path not in wanted and future.cancel():
+                    self.futures.pop(cache_path, None)
+            for cache_path, image_path in wanted.items():
+                self._submit(cache_dir, cache_path, image_path)
+
+    def _submit(self, cache_dir, cache_path, image_path):
+        with self._lock:
+            if cache_path in self.futures or cache_path in self.cache or os.path.exists(cache_path):
+                return
+            if self.executor is None:
+                # Qt 已启动多个线程，子进程用 spawn 方式创建以避免 fork 带来的死锁
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            os.makedirs(cache_dir, exist_ok=True)
+            try:
+                future = self.executor.submit(compute_superpixels, image_path, cache_path)
+            except BrokenProcessPool:
+                # 子进程异常退出后进程池不可再用，重新创建
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                future = self.executor.submit(compute_superpixels, image_path, cache_path)
+            self.futures[cache_path] = future
+            future.add_done_callback(lambda f, key=cache_path: self._finished(key, f))
+
+    def _finished(self, cache_path, future):
+        with self._lock:
+            if self.futures.get(cache_path) is future:
+                self.futures.pop(cache_path, None)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Superpixel computation failed for {cache_path}: {future.exception()}")
+
+    def labels(self, cache_dir, image_path):
+        """返回该图像的超像素标签数组，尚未计算完成时返回 None"""
+        cache_path = self.cache_path(cache_dir, image_path)
+        labels = self.cache.get(cache_path)
+        if labels is None and os.path.exists(cache_path):
+            labels = np.load(cache_path)
+            self.cache.put(cache_path, labels, labels.nbytes)
+        if labels is None:
+            self._submit(cache_dir, cache_path, image_path)
+        return labels
+
+    def shutdown(self):
+        with self._lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def stub_model(images):
+    """
+    内置的示例模型：把比整幅图像平均亮度更亮的像素作为前景。
+    不追求效果，只用于验证预标注流水线并测量吞吐量（模型规格写作 "stub"）。
+    """
+    return [image.mean(axis=2) > image.mean() for image in images]
+
+
+def load_model(spec):
+    """
+    按 "模块:函数" 或 "文件.py:函数" 加载预标注模型，"stub" 表示内置的 stub_model。
+    模型接收一批 (高, 宽, 3) 的 uint8 RGB 数组，返回同样数量的二维数组：
+    bool、0-255 的整数或 0-1 的概率，前景阈值为一半。
+    """
+    if spec == 'stub':
+        return stub_model
+    module_name, _, attribute = spec.rpartition(':')
+    if not module_name or not attribute:
+        raise ValueError(f"Model must be given as module:function, got {spec!r}")
+    if module_name.endswith('.py'):
+        module_spec = importlib.util.spec_from_file_location(
+            os.path.splitext(os.path.basename(module_name))[0], module_name
+        )
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_name)
+    return getattr(module, attribute)
+
+
+# 预标注子进程中已加载的模型（每个进程只加载一次）
+_preannotation_model = None
+
+
+def preannotate_worker_init(spec):
+    global _preannotation_model
+    _preannotation_model = load_model(spec)
+
+
+def preannotate_batch(items, max_side=PREANNOTATE_MAX_SIDE):
+    """
+    在子进程中运行：解码一批缩小的图像，一次调用模型，把二值化后的建议蒙版
+    以 Grayscale8 PNG 原子地写入各自的缓存路径。items 为 [(图像路径, 缓存路径)]。
+    """
+    images = [decode_preview(image_path, max_side).convertToFormat(QImage.Format_RGB888) for image_path, _ in items]
+    outputs = _preannotation_model([qimage_array(image, writable=False) for image in images])
+    if len(outputs) != len(items):
+        raise ValueError(f"Model returned {len(outputs)} masks for {len(items)} images")
+    for (_, cache_path), output in zip(items, outputs):
+        output = np.asarray(output)
+        if output.dtype == bool:
+            binary = output
+        elif np.issubdtype(output.dtype, np.floating):
+            binary = output >= 0.5
+        else:
+            binary = output >= 128
+        mask = QImage(binary.shape[1], binary.shape[0], QImage.Format_Grayscale8)
+        qimage_array(mask)[:] = binary * np.uint8(255)
+        write_image_atomic(mask, cache_path, 'PNG')
+    return [cache_path for _, cache_path in items]
+
+
+def load_proposal(cache_path, size):
+    """读取建议蒙版并按最近邻缩放到图像尺寸（保持二值）；不存在时返回 None"""
+    mask = QImage(cache_path)
+    if mask.isNull():
+        return None
+    mask = mask.convertToFormat(QImage.Format_Grayscale8)
+    if mask.size() != size:
+        mask = mask.scaled(size, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+    return mask
+
+
+class PreannotationEngine:
+    """
+    在后台进程池中用用户提供的模型为即将浏览、还没有蒙版的图像生成建议蒙版，
+    结果按模型和图像修改时间缓存到磁盘。凑满一批再提交以提高模型吞吐量；
+    有空闲进程时不足一批也立即提交，避免当前图像等待。查询从不阻塞。
+    """
+
+    def __init__(self, model, workers=PREANNOTATE_WORKERS, batch_size=PREANNOTATE_BATCH, on_ready=None):
+        self.model = model
+        self.workers = workers
+        self.batch_size = batch_size
+        # 建议蒙版写入后在工作线程中调用，参数为图像路径
+        self.on_ready = on_ready
+        self.executor = None
+        self.failed = False
+        # 缓存路径 -> 所在批次的 future；完成回调在进程池的管理线程中执行，访问需持有锁。
+        # Future.cancel() 会在当前线程同步调用完成回调，因此使用可重入锁
+        self.futures = {}
+        self._lock = threading.RLock()
+
+    def cache_dir(self, main_folder):
+        """不同模型的结果分开缓存，切换模型后不会读到旧模型的建议"""
+        return app_data_path(main_folder, 'proposals', hashlib.sha1(self.model.encode('utf-8')).hexdigest()[:12])
+
+    @staticmethod
+    def cache_path(cache_dir, image_path):
+        return os.path.join(cache_dir, f"{image_stem(image_path)}_{file_mtime_ns(image_path)}.png")
+
+    def proposal(self, cache_dir, image_path):
+        """已生成的建议蒙版路径，尚未生成时返回 None"""
+        cache_path = self.cache_path(cache_dir, image_path)
+        return cache_path if os.path.exists(cache_path) else None
+
+    def schedule(self, cache_dir, image_paths):
+        """按顺序为尚未生成建议的图像分批提交任务；批次中的图像都不再需要且尚未开始时取消该批"""
+        if self.failed:
+            return
+        wanted = OrderedDict((self.cache_path(cache_dir, path), path) for path in image_paths)
+        with self._lock:
+            for future in set(self.futures.values()):
+                if all(path not in wanted for path in future.cache_paths) and future.cancel():
+                    for path in future.cache_paths:
+                        self.futures.pop(path, None)
+            pending = [
+                (image_path, cache_path) for cache_path, image_path in wanted.items()
+                if cache_path not in self.futures and not os.path.exists(cache_path)
+            ]
+            if not pending:
+                return
+            os.makedirs(cache_dir, exist_ok=True)
+            for start in range(0, len(pending), self.batch_size):
+                batch = pending[start:start + self.batch_size]
+                busy = len(set(self.futures.values()))
+                if len(batch) < self.batch_size and busy >= self.workers:
+                    # 进程都在忙，零散的图像留到下一次调度时与后续图像凑成一批
+                    break
+                self._submit(batch)
+
+    def _submit(self, batch):
+        if self.executor is None:
+            # 与超像素相同：spawn 方式创建子进程，每个子进程启动时加载一次模型
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=preannotate_worker_init, initargs=(self.model,)
+            )
+        try:
+            future = self.executor.submit(preannotate_batch, batch)
+        except BrokenProcessPool:
+            self.executor = None
+            self.failed = True
+            print(f"Pre-annotation model {self.model} could not be started; proposals are disabled.")
+            return
+        future.cache_paths = [cache_path for _, cache_path in batch]
+        future.image_paths = [image_path for image_path, _ in batch]
+        for cache_path in future.cache_paths:
+            self.futures[cache_path] = future
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        with self._lock:
+            for cache_path in future.cache_paths:
+                if self.futures.get(cache_path) is future:
+                    self.futures.pop(cache_path, None)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # 模型加载失败或子进程崩溃；不再自动重试，以免反复启动失败的进程
+            self.failed = True
+            print(f"Pre-annotation model {self.model} stopped: {error}")
+        elif error is not None:
+            print(f"Pre-annotation failed for {future.image_paths}: {error}")
+        elif self.on_ready is not None:
+            for image_path in future.image_paths:
+                self.on_ready(image_path)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def render_thumbnail(image_path, mask_path, size=THUMBNAIL_SIZE, color=QColor(255, 0, 0, 128), label_mode=False):
+    """生成长边为 size 的缩略图，并按 color 叠加蒙版；标签图按类别调色板着色，透明度取自 color"""
+    image = decode_preview(image_path, size)
+    mask = read_mask_file(mask_path)
+    if mask is not None and not image.isNull() and label_mode:
+        # 类别编号不能插值，最近邻缩放后把字节按 Indexed8 解释，颜色表即调色板
+        mask = mask.scaled(image.size(), Qt.IgnoreAspectRatio, Qt.FastTransformation)
+        mask = mask.convertToFormat(QImage.Format_Grayscale8)
+        data = mask.constBits().asstring(mask.bytesPerLine() * mask.height())
+        labels = QImage(data, mask.width(), mask.height(), mask.bytesPerLine(), QImage.Format_Indexed8)
+        colors = [label_color(class_id) for class_id in range(256)]
+        for class_id, class_color in enumerate(colors):
+            class_color.setAlpha(color.alpha() if class_id else 0)
+        labels.setColorTable([class_color.rgba() for class_color in colors])
+        painter = QPainter(image)
+        painter.drawImage(0, 0, labels)
+        painter.end()
+    elif mask is not None and not image.isNull():
+        mask = mask.scaled(image.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        overlay = QImage(image.size(), QImage.Format_ARGB32)
+        overlay.fill(QColor(color.red(), color.green(), color.blue()))
+        overlay.setAlphaChannel(mask.convertToFormat(QImage.Format_Grayscale8))
+        painter = QPainter(image)
+        painter.setOpacity(color.alphaF())
+        painter.drawImage(0, 0, overlay)
+        painter.end()
+    return image
+
+
+class ThumbnailLoader(QObject):
+    """
+    在后台线程中生成缩略图并缓存到磁盘，缓存文件中记录图像与蒙版的修改时间，任一变化即重新生成。
+    请求按后进先出处理，最近滚动到可见区域的缩略图最先生成；积压过多时丢弃最早的请求。
+    label_mode 为 True 时按标签图调色板叠加蒙版，缓存键中同时记录该模式。
+    """
+    ready = pyqtSignal(str, object)  # 名称、缩略图 QImage（失败时为 None）
+
+    def __init__(self, cache_dir, workers=THUMBNAIL_WORKERS, label_mode=False):
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.label_mode = label_mode
+        os.makedirs(cache_dir, exist_ok=True)
+        self._queue = OrderedDict()
+        self._active = set()
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._run, name=f'thumbnail-{i}', daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def cache_path(self, name):
+        return os.path.join(self.cache_dir, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.jpg')
+
+    def request(self, name, image_path, mask_path):
+        with self._cond:
+            if name in self._active:
+                return
+            # 重复请求移到栈顶
+            self._queue.pop(name, None)
+            self._queue[name] = (image_path, mask_path)
+            while len(self._queue) > THUMBNAIL_QUEUE:
+                self._queue.popitem(last=False)
+            self._cond.notify()
+
+    def clear(self):
+        with self._cond:
+            self._queue.clear()
+
+    def stop(self):
+        with self._cond:
+            self._queue.clear()
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def load(self, name, image_path, mask_path):
+        """读取磁盘缓存，缓存不存在或已过期时重新生成"""
+        label_mode = self.label_mode
+        key = f"{file_mtime_ns(image_path)}:{mask_mtime_ns(mask_path)}:{int(label_mode)}"
+        path = self.cache_path(name)
+        reader = QImageReader(path)
+        if reader.canRead() and reader.text('key') == key:
+            thumbnail = reader.read()
+            if not thumbnail.isNull():
+                return thumbnail
+        thumbnail = render_thumbnail(image_path, mask_path, label_mode=label_mode)
+        if thumbnail.isNull():
+            return None
+        thumbnail.setText('key', key)
+        write_image_atomic(thumbnail, path, 'JPEG', 85)
+        return thumbnail
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                name, (image_path, mask_path) = self._queue.popitem(last=True)
+                self._active.add(name)
+            try:
+                thumbnail = self.load(name, image_path, mask_path)
+            except Exception as e:
+                print(f"Failed to create thumbnail for {name}: {e}")
+                thumbnail = None
+            with self._cond:
+                self._active.discard(name)
+            self.ready.emit(name, thumbnail)
+
+
+class FilmstripModel(QAbstractListModel):
+    """
+    胶片栏的数据模型。视图使用统一尺寸时只为可见的行调用 data，
+    内存中没有的缩略图先显示占位图并交给 ThumbnailLoader 在后台生成。
+    """
+
+    def __init__(self, paths, parent=None):
+        super().__init__(parent)
+        # paths(名称) 返回 (图像路径, 蒙版路径)
+        self.paths = paths
+        self.names = []
+        self.rows = {}
+        self.loader = None
+        self.pixmaps = LRUCache(THUMBNAIL_CACHE_BYTES)
+        self.placeholder = QPixmap(THUMBNAIL_SIZE, THUMBNAIL_SIZE * 3 // 4)
+        self.placeholder.fill(QColor(64, 64, 64))
+
+    def set_loader(self, loader):
+        if self.loader is not None:
+            self.loader.ready.disconnect(self.thumbnail_ready)
+        self.loader = loader
+        self.pixmaps.clear()
+        if loader is not None:
+            loader.ready.connect(self.thumbnail_ready)
+
+    def set_names(self, names):
+        """图像列表变化后重建模型（names 与 image_list 为同一列表）"""
+        self.beginResetModel()
+        self.names = names
+        self.rows = {name: row for row, name in enumerate(names)}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.names):
+            return None
+        name = self.names[index.row()]
+        if role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return name
+        if role == Qt.DecorationRole:
+            pixmap = self.pixmaps.get(name)
+            if pixmap is None:
+                if self.loader is not None:
+                    self.loader.request(name, *self.paths(name))
+                return self.placeholder
+            return pixmap
+        return None
+
+    def thumbnail_ready(self, name, thumbnail):
+        # 生成失败时缓存占位图，避免每次重绘都重新请求
+        pixmap = QPixmap.fromImage(thumbnail) if thumbnail is not None else self.placeholder
+        self.pixmaps.put(name, pixmap, pixmap.width() * pixmap.height() * 4)
+        self.refresh(name)
+
+    def invalidate(self, name):
+        """蒙版已修改，重新生成该图像的缩略图"""
+        self.pixmaps.discard(name)
+        self.refresh(name)
+
+    def invalidate_all(self):
+        """叠加方式改变，丢弃内存中的全部缩略图并重绘"""
+        self.pixmaps.clear()
+        if self.loader is not None:
+            self.loader.clear()
+        self.set_names(self.names)
+
+    def refresh(self, name):
+        row = self.rows.get(name)
+        if row is not None and row < len(self.names) and self.names[row] == name:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
 
 class ImageLabel(QLabel):
     def __init__(self, parent=None, scroll_area=None, main_window=None):
@@ -28,19 +2968,66 @@ class ImageLabel(QLabel):
         self.brush_color = QColor(255, 255, 255)
         self.eraser_color = QColor(0, 0, 0)
         self.erase_mode = False
+        # 超像素填充模式：单击填充所在超像素，按住 Shift 单击则擦除
+        self.fill_mode = False
         self.mask = None
         self.image = None
         self.display_image = None
+        # 图像与蒙版的金字塔，以及按层分块缓存的合成结果
+        self.tile_cache = LRUCache(TILE_CACHE_BYTES)
+        self.image_pyramid = None
+        self.mask_pyramid = None
+        self.composite_uid = None
+        # 已失效但尺寸可复用的合成瓦片
+        self.spare_tiles = {}
+        # 叠加层颜色（alpha 为不透明度）及合成方式
+        self.overlay_color = QColor(255, 0, 0, 128)
+        self.compositor = OverlayCompositor(self.overlay_color) if np is not None else None
+        self.use_numpy_compositor = self.compositor is not None
+        # 多类别标签图模式：蒙版值为类别编号，按调色板着色，可以逐类隐藏
+        self.label_mode = False
+        self.class_visible = [True] * 256
+        self.color_table = []
         self.show_mask = True
         self.scroll_area = scroll_area
         self.main_window = main_window
         self.show_image = True  # 添加控制图像显示的标志
+        # 笔画坐标先缓存，每帧最多绘制一次
+        self.pending_points = []
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setTimerType(Qt.PreciseTimer)
+        self.stroke_timer.timeout.connect(self.flush_stroke)
+        # 缩放或拖动过程中使用最近邻采样，停止一段时间后再平滑重绘
+        self.interacting = False
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.timeout.connect(self.end_interaction)
+        if scroll_area is not None:
+            scroll_area.horizontalScrollBar().valueChanged.connect(self.begin_interaction)
+            scroll_area.verticalScrollBar().valueChanged.connect(self.begin_interaction)
 
     def set_mask(self, mask):
         self.mask = mask
+        self.pending_points = []
+        if self.mask_pyramid is not None:
+            self.mask_pyramid.release()
+        self.mask_pyramid = ImagePyramid(mask, self.tile_cache, smooth=not self.label_mode) if mask is not None else None
 
-    def set_image(self, image):
+    def set_image(self, image, pyramid_dir=None, size=None):
+        """size 为原图尺寸，与 image 不同时 image 是缩小的预览图"""
         self.image = image
+        if self.image_pyramid is not None:
+            self.image_pyramid.release()
+        if image is None:
+            self.image_pyramid = None
+        elif size is not None and size != image.size():
+            self.image_pyramid = PreviewPyramid(image, size, self.tile_cache, pyramid_dir)
+        else:
+            self.image_pyramid = ImagePyramid(image, self.tile_cache, pyramid_dir)
+
+    def image_rect(self):
+        """原图坐标下的图像范围（显示预览图时也是原图尺寸）"""
+        return QRect(QPoint(0, 0), self.image_pyramid.level_sizes[0])
 
     def set_brush_size(self, size):  # 设置画笔尺寸
         self.brush_size = size
@@ -57,6 +3044,9 @@ class ImageLabel(QLabel):
     def set_erase_mode(self, mode):
         self.erase_mode = mode
 
+    def set_fill_mode(self, mode):
+        self.fill_mode = mode
+
     def set_show_mask(self, show):
         self.show_mask = show
 
@@ -64,6 +3054,46 @@ class ImageLabel(QLabel):
         """设置是否显示原始图像"""
         self.show_image = show
 
+    def set_overlay_color(self, color):
+        self.overlay_color = QColor(color)
+        self.update_overlay_colors()
+
+    def set_label_mode(self, enabled):
+        """切换标签图模式；蒙版金字塔需要按新的缩放方式重建"""
+        self.label_mode = enabled
+        self.update_overlay_colors()
+        if self.mask is not None:
+            self.set_mask(self.mask)
+        self.update_display()
+
+    def set_class_visible(self, class_id, visible):
+        """显示或隐藏某个类别；只更新查找表并重新合成，不重新解码图像或蒙版"""
+        self.class_visible[class_id] = visible
+        self.update_overlay_colors()
+        self.update_display()
+
+    def label_colors(self):
+        """标签图的调色板：背景和隐藏的类别完全透明，其他类别使用叠加层的不透明度"""
+        colors = []
+        for class_id in range(256):
+            color = label_color(class_id)
+            color.setAlpha(self.overlay_color.alpha() if class_id and self.class_visible[class_id] else 0)
+            colors.append(color)
+        return colors
+
+    def update_overlay_colors(self):
+        if self.label_mode:
+            colors = self.label_colors()
+            self.color_table = [color.rgba() for color in colors]
+            if self.compositor is not None:
+                self.compositor.set_palette(colors)
+        elif self.compositor is not None:
+            self.compositor.set_color(self.overlay_color)
+
+    def set_numpy_compositor(self, enabled):
+        """在 NumPy 查找表合成与 Qt 合成之间切换"""
+        self.use_numpy_compositor = enabled and self.compositor is not None
+
     def wheelEvent(self, event):
         if self.image is None:
             return
@@ -78,92 +3108,272 @@ class ImageLabel(QLabel):
 
         # 仅在缩放因子有变化时更新
         if zoom_factor_new != zoom_factor_before:
+            # 记录指针下的图像位置，缩放后保持它仍在指针下
+            anchor = self.map_to_image(cursor_pos)
+            viewport_pos = self.mapTo(self.scroll_area.viewport(), cursor_pos) if self.scroll_area else None
             self.zoom_factor = zoom_factor_new
-            self.update_display(cursor_pos)
+            self.begin_interaction()
+            # 各层的合成瓦片仍然有效，只需重新布局
+            self.update_layout()
+            if viewport_pos is not None:
+                self.anchor_to(anchor, viewport_pos)
+
+    def view_transform(self):
+        """图像坐标到标签坐标的变换，绘制和坐标换算都通过它进行"""
+        return QTransform.fromScale(self.zoom_factor, self.zoom_factor)
+
+    def map_to_image(self, pos):
+        """标签坐标转换为图像坐标（浮点，不裁剪）"""
+        inverse, _ = self.view_transform().inverted()
+        return inverse.map(QPointF(pos))
+
+    def anchor_to(self, image_point, viewport_pos):
+        """滚动视图，使图像上的 image_point 显示在视口的 viewport_pos 处"""
+        label_pos = self.view_transform().map(image_point)
+        current = self.mapTo(self.scroll_area.viewport(), label_pos.toPoint())
+        delta = current - viewport_pos
+        horizontal = self.scroll_area.horizontalScrollBar()
+        vertical = self.scroll_area.verticalScrollBar()
+        horizontal.setValue(horizontal.value() + delta.x())
+        vertical.setValue(vertical.value() + delta.y())
+
+    def begin_interaction(self, *args):
+        """进入交互状态：暂用最近邻采样绘制，直到停止操作一段时间"""
+        self.interacting = True
+        self.idle_timer.start(SMOOTH_RENDER_DELAY_MS)
+
+    def end_interaction(self):
+        if self.drawing:
+            # 笔画仍在进行，等松开后再平滑重绘
+            self.idle_timer.start(SMOOTH_RENDER_DELAY_MS)
+            return
+        self.interacting = False
+        self.update()
+
+    @PROFILER.timed('composite')
+    def compose_tile(self, size, image_tile, mask_tile, out=None):
+        """合成一个瓦片（原图或白色背景 + 半透明蒙版叠加层）"""
+        if self.use_numpy_compositor:
+            return self.compositor.compose(size, image_tile, mask_tile, out)
+        if image_tile is not None:
+            tile = image_tile.copy()
+        else:
+            # 创建白色背景
+            tile = QImage(size, QImage.Format_RGB32)
+            tile.fill(Qt.white)
+
+        if mask_tile is not None and self.label_mode:
+            # 把蒙版字节按 Indexed8 解释，颜色表即调色板，由 Qt 一次完成着色与混合
+            data = mask_tile.constBits().asstring(mask_tile.bytesPerLine() * mask_tile.height())
+            labels = QImage(data, size.width(), size.height(), mask_tile.bytesPerLine(), QImage.Format_Indexed8)
+            labels.setColorTable(self.color_table)
+            painter = QPainter(tile)
+            painter.drawImage(0, 0, labels)
+            painter.end()
+        # 如果启用了蒙版显示，添加蒙版叠加
+        elif mask_tile is not None:
+            # 创建半透明红色叠加层
+            red_overlay = QImage(size, QImage.Format_ARGB32)
+            red_overlay.fill(Qt.transparent)
+
+            # 使用蒙版创建剪切区域
+            mask_image = mask_tile.convertToFormat(QImage.Format_Mono)
+            mask_image.invertPixels()
+            mask_region = QRegion(QBitmap.fromImage(mask_image))
+
+            # 在红色叠加层上绘制半透明红色
+            painter = QPainter(red_overlay)
+            painter.setClipRegion(mask_region)
+            painter.fillRect(red_overlay.rect(), self.overlay_color)
+            painter.end()
+
+            # 将红色叠加层绘制到显示图像上
+            painter = QPainter(tile)
+            painter.drawImage(0, 0, red_overlay)
+            painter.end()
+        return tile
+
+    def composite_tile(self, level, tx, ty):
+        key = (self.composite_uid, level, tx, ty)
+        tile = self.tile_cache.get(key)
+        if tile is None:
+            rect = self.image_pyramid.tile_rect(level, tx, ty)
+            image_tile = self.image_pyramid.tile(level, tx, ty) if self.show_image else None
+            mask_tile = None
+            if self.show_mask and self.mask_pyramid is not None:
+                mask_tile = self.mask_pyramid.tile(level, tx, ty)
+            tile = self.compose_tile(rect.size(), image_tile, mask_tile, self.spare_tiles.pop(key, None))
+            self.tile_cache.put(key, tile, image_nbytes(tile))
+        return tile
 
     def update_display(self, cursor_pos=None):
+        """丢弃全部合成瓦片并按当前缩放因子重新布局，用于缩放、切换图像及显示开关变化"""
         if self.image:
-            # 创建显示用的图像
-            if self.show_image:
-                display_image = self.image.copy()
-            else:
-                # 创建白色背景
-                display_image = QImage(self.image.size(), QImage.Format_RGB32)
-                display_image.fill(Qt.white)
-            
-            # 如果启用了蒙版显示，添加蒙版叠加
-            if self.show_mask and self.mask:
-                # 创建半透明红色叠加层
-                red_overlay = QImage(self.image.size(), QImage.Format_ARGB32)
-                red_overlay.fill(Qt.transparent)
-                
-                # 使用蒙版创建剪切区域
-                mask_image = self.mask.convertToFormat(QImage.Format_Mono)
-                mask_image.invertPixels()
-                mask_region = QRegion(QBitmap.fromImage(mask_image))
-                
-                # 在红色叠加层上绘制半透明红色
-                painter = QPainter(red_overlay)
-                painter.setClipRegion(mask_region)
-                painter.fillRect(self.mask.rect(), QColor(255, 0, 0, 128))
-                painter.end()
-                
-                # 将红色叠加层绘制到显示图像上
-                painter = QPainter(display_image)
-                painter.drawImage(0, 0, red_overlay)
-                painter.end()
-
-            # 根据缩放因子调整图像大小
-            scaled_width = int(display_image.width() * self.zoom_factor)
-            scaled_height = int(display_image.height() * self.zoom_factor)
-            scaled_image = display_image.scaled(
-                scaled_width, scaled_height,
-                Qt.KeepAspectRatio, Qt.SmoothTransformation
-            )
+            if self.composite_uid is not None:
+                uid = self.composite_uid
+                self.tile_cache.discard_if(lambda key: key[0] == uid)
+            self.composite_uid = next(ImagePyramid._uids)
+            self.spare_tiles.clear()
+            self.update_layout()
+
+    def update_layout(self):
+        """按视图变换调整标签尺寸，实际只绘制滚动区域中可见的瓦片"""
+        if self.image:
+            self.setFixedSize(self.view_transform().mapRect(QRectF(self.image_rect())).size().toSize())
+            self.update()
+
+    def update_region(self, rect):
+        """
+        蒙版在 rect（图像坐标）内被修改后，仅丢弃并重绘受影响的瓦片。
+        """
+        if self.image is None or self.composite_uid is None:
+            self.update_display()
+            return
+        rect = rect.intersected(self.image_rect())
+        if rect.isEmpty():
+            return
+        if self.mask_pyramid is not None:
+            self.mask_pyramid.invalidate(rect)
+        for level in range(len(self.image_pyramid.level_sizes)):
+            level_rect = QRect(
+                QPoint(rect.left() >> level, rect.top() >> level),
+                QPoint(rect.right() >> level, rect.bottom() >> level)
+            ).adjusted(-1, -1, 1, 1)
+            for tx, ty in self.image_pyramid.tiles_in(level, level_rect):
+                key = (self.composite_uid, level, tx, ty)
+                tile = self.tile_cache.pop(key)
+                if tile is not None:
+                    # 保留失效瓦片的缓冲区，重新合成时直接覆盖写入
+                    self.spare_tiles[key] = tile
+        self.update(self.view_transform().mapRect(QRectF(rect)).toAlignedRect().adjusted(-2, -2, 2, 2))
+
+    @PROFILER.timed('frame')
+    def paintEvent(self, event):
+        if self.main_window and self.main_window.startup_pending:
+            # 绘制完成后再通知，避免在绘制过程中执行其他工作
+            QTimer.singleShot(0, lambda shown=self.image is not None: self.main_window.frame_painted(shown))
+        if self.image is None or self.composite_uid is None:
+            super().paintEvent(event)
+            return
+        transform = self.view_transform()
+        inverse, _ = transform.inverted()
+        # 选择最接近当前缩放的金字塔层，只绘制与刷新区域相交的瓦片
+        level = self.image_pyramid.level_for_zoom(self.zoom_factor)
+        level_size = self.image_pyramid.level_sizes[level]
+        # 该层坐标到图像坐标的比例
+        image_size = self.image_pyramid.level_sizes[0]
+        level_x = image_size.width() / level_size.width()
+        level_y = image_size.height() / level_size.height()
+        exposed = inverse.mapRect(QRectF(event.rect()))
+        level_rect = QRect(
+            QPoint(int(exposed.left() / level_x), int(exposed.top() / level_y)),
+            QPoint(int(exposed.right() / level_x), int(exposed.bottom() / level_y))
+        )
+        painter = QPainter(self)
+        # 交互过程中使用最近邻采样，空闲后再平滑重绘
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, not self.interacting)
+        for tx, ty in self.image_pyramid.tiles_in(level, level_rect):
+            rect = self.image_pyramid.tile_rect(level, tx, ty)
+            image_rect = QRectF(rect.x() * level_x, rect.y() * level_y, rect.width() * level_x, rect.height() * level_y)
+            # 变换后取整到相同的边界，保证相邻瓦片之间没有缝隙
+            target = transform.mapRect(image_rect)
+            left, top = round(target.left()), round(target.top())
+            right, bottom = round(target.right()), round(target.bottom())
+            tile = self.composite_tile(level, tx, ty)
+            with PROFILER.stage('upload'):
+                painter.drawImage(QRect(left, top, right - left, bottom - top), tile)
+        painter.end()
 
-            # 设置图像并调整标签大小
-            self.setPixmap(QPixmap.fromImage(scaled_image))
-            self.setFixedSize(scaled_image.size())
+    def clear(self):
+        self.set_image(None)
+        self.set_mask(None)
+        if self.composite_uid is not None:
+            uid = self.composite_uid
+            self.tile_cache.discard_if(lambda key: key[0] == uid)
+            self.composite_uid = None
+        self.spare_tiles.clear()
+        super().clear()
 
     def mousePressEvent(self, event):
         if self.image is None:
             return
-        if event.button() == Qt.LeftButton:
+        if event.button() == Qt.LeftButton and self.fill_mode:
+            self.setFocus()
+            if self.main_window:
+                point = self.get_image_coordinates(event.pos())
+                self.main_window.fill_superpixel(point, bool(event.modifiers() & Qt.ShiftModifier))
+        elif event.button() == Qt.LeftButton:
             self.setFocus()  # 将焦点设置到 ImageLabel
             self.drawing = True
             self.last_point = self.get_image_coordinates(event.pos())
+            self.pending_points = []
+            self.begin_interaction()
             if self.main_window:
-                self.main_window.save_mask_state()  # 保存当前状态以用于撤销
+                self.main_window.save_mask_state()  # 开始记录本笔画用于撤销
 
     def mouseMoveEvent(self, event):
         if self.image is None or not self.drawing:
             return
         current_point = self.get_image_coordinates(event.pos())
         if current_point and self.last_point:
-            painter = QPainter(self.mask)
-            pen_color = self.eraser_color if self.erase_mode else self.brush_color
-            pen_size = self.eraser_size if self.erase_mode else self.brush_size
-            pen = QPen(pen_color, pen_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-            painter.setPen(pen)
-            painter.drawLine(self.last_point, current_point)
-            painter.end()
-            self.last_point = current_point
-            self.update_display()
+            # 只缓存坐标，由按显示刷新率触发的定时器统一绘制
+            previous = self.pending_points[-1] if self.pending_points else self.last_point
+            if current_point != previous:
+                self.pending_points.append(current_point)
+                if not self.stroke_timer.isActive():
+                    self.stroke_timer.start(self.frame_interval())
 
+    def frame_interval(self):
+        """当前屏幕一帧的时长（毫秒）"""
+        screen = self.window().windowHandle().screen() if self.window().windowHandle() else None
+        screen = screen or QGuiApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen else 60
+        return max(1, int(1000 / (refresh_rate or 60)))
+
+    @PROFILER.timed('stroke')
+    def flush_stroke(self):
+        """将缓存的坐标作为一条折线一次绘制到蒙版上，并只刷新折线覆盖的区域"""
+        if not self.pending_points:
+            self.stroke_timer.stop()
+            return
+        points = [self.last_point] + self.pending_points
+        self.pending_points = []
+        pen_color = self.eraser_color if self.erase_mode else self.brush_color
+        pen_size = self.eraser_size if self.erase_mode else self.brush_size
+        # 折线覆盖的矩形区域
+        half = pen_size // 2 + 2
+        polyline = QPolygon(points)
+        dirty_rect = polyline.boundingRect().adjusted(-half, -half, half, half)
+        if self.main_window:
+            self.main_window.before_mask_change(dirty_rect)
+        draw_stroke(self.mask, points, pen_size, pen_color)
+        if self.main_window:
+            self.main_window.mask_dirty = True
+            self.main_window.record_stroke(points, pen_size, self.erase_mode)
+        self.last_point = points[-1]
+        # 只刷新该区域，同一帧内的多次刷新请求会被 Qt 合并
+        self.update_region(dirty_rect)
 
     def mouseReleaseEvent(self, event):
         if self.image is None:
             return
-        if event.button() == Qt.LeftButton:
+        if event.button() == Qt.LeftButton and self.drawing:
+            # 绘制最后一段尚未刷新的笔画
+            self.mouseMoveEvent(event)
+            self.flush_stroke()
+            self.stroke_timer.stop()
             self.drawing = False
+            if self.main_window:
+                self.main_window.finish_mask_change()
 
     def get_image_coordinates(self, pos):
         if self.image is None:
             return None
-        image_x = pos.x() / self.zoom_factor
-        image_y = pos.y() / self.zoom_factor
-        image_x = max(0, min(image_x, self.image.width() - 1))
-        image_y = max(0, min(image_y, self.image.height() - 1))
+        image_pos = self.map_to_image(pos)
+        image_x, image_y = image_pos.x(), image_pos.y()
+        image_rect = self.image_rect()
+        image_x = max(0, min(image_x, image_rect.width() - 1))
+        image_y = max(0, min(image_y, image_rect.height() - 1))
         return QPoint(int(image_x), int(image_y))
 
     def keyPressEvent(self, event):
@@ -174,8 +3384,25 @@ class ImageLabel(QLabel):
             super().keyPressEvent(event)
 
 class SegmentationTool(QMainWindow):
-    def __init__(self):
+    # 后台解码完成的全分辨率图像（路径、QImage，失败时为 None）
+    image_decoded = pyqtSignal(str, object)
+    # 后台同步完成的数据集索引及是否有变化
+    index_synced = pyqtSignal(object, bool)
+    # 后台质检统计更新完成
+    stats_updated = pyqtSignal(object)
+    # 模型为该图像生成的建议蒙版已写入缓存（在工作线程中发出）
+    proposal_ready = pyqtSignal(str)
+
+    def __init__(self, session=True):
+        """session 为 False 时不恢复也不保存上次的会话（用于基准测试等脚本）"""
         super().__init__()
+        # 启动各阶段相对于进程启动的时间点（毫秒）
+        self.startup_marks = OrderedDict([('imports', (time.perf_counter() - STARTUP_BEGIN) * 1000)])
+        self.startup_pending = True
+        # 第一帧绘制之前推迟执行的非必要工作
+        self.deferred = []
+        # 窗口已关闭：尚未执行的推迟工作和排队中的回调都不再执行
+        self.closing = False
         
         # 确保在运行时获取正确的路径
         if hasattr(sys, '_MEIPASS'):
@@ -216,6 +3443,10 @@ class SegmentationTool(QMainWindow):
         self.clear_button.clicked.connect(self.clear_annotations)
         self.clear_button.setEnabled(False)
 
+        self.unannotated_button = QPushButton("Next Unannotated", self)
+        self.unannotated_button.clicked.connect(self.load_next_unannotated_image)
+        self.unannotated_button.setEnabled(False)
+
         self.auto_save_checkbox = QCheckBox("Auto Save", self)
         self.auto_save_checkbox.setChecked(True)
 
@@ -251,10 +3482,19 @@ class SegmentationTool(QMainWindow):
         self.eraser_button.setCheckable(True)
         self.eraser_button.clicked.connect(self.set_eraser_mode)
 
+        # 超像素填充按钮（需要 NumPy）
+        self.fill_button = QPushButton("Fill", self)
+        self.fill_button.setToolTip("Superpixel fill: click to fill a segment, Shift+click to erase it (Ctrl+E)")
+        self.fill_button.setFixedSize(60, 40)
+        self.fill_button.setCheckable(True)
+        self.fill_button.setEnabled(np is not None)
+        self.fill_button.clicked.connect(self.set_fill_mode)
+
         # 创建按钮组
         self.tool_group = QButtonGroup(self)
         self.tool_group.addButton(self.brush_button)
         self.tool_group.addButton(self.eraser_button)
+        self.tool_group.addButton(self.fill_button)
         self.tool_group.setExclusive(True)
 
         # 设置初始样式
@@ -281,6 +3521,16 @@ class SegmentationTool(QMainWindow):
         self.size_spinbox.valueChanged.connect(self.size_slider.setValue)
         self.size_spinbox.valueChanged.connect(self.change_size)
 
+        # 标签图模式下画笔写入的类别编号（数字键 1-9 也可切换）
+        self.label_mode = False
+        self.class_label = QLabel("Class:", self)
+        self.class_spinbox = QSpinBox()
+        self.class_spinbox.setRange(1, 255)
+        self.class_spinbox.setFixedWidth(50)
+        self.class_spinbox.valueChanged.connect(self.set_label_class)
+        self.class_label.hide()
+        self.class_spinbox.hide()
+
         # 初始化 ImageLabel 的参数
         self.image_label.set_brush_size(self.brush_size)
         self.image_label.set_eraser_size(self.eraser_size)
@@ -292,6 +3542,10 @@ class SegmentationTool(QMainWindow):
         self.count_label = QLabel("Annotated samples: 0", self)
         self.image_name_label = QLabel("Image: None", self)
 
+        # 状态栏显示后台保存的耗时和队列长度
+        self.save_status_label = QLabel("Save queue: 0", self)
+        self.statusBar().addPermanentWidget(self.save_status_label)
+
         # 设置布局
         button_layout = QHBoxLayout()
         button_layout.addWidget(self.load_button)
@@ -299,6 +3553,7 @@ class SegmentationTool(QMainWindow):
         button_layout.addWidget(self.next_button)
         button_layout.addWidget(self.delete_button)
         button_layout.addWidget(self.clear_button)
+        button_layout.addWidget(self.unannotated_button)
         button_layout.addWidget(self.auto_save_checkbox)
         button_layout.addWidget(self.show_mask_checkbox)
         button_layout.addWidget(self.show_image_checkbox)  # 添加到布局中
@@ -307,6 +3562,7 @@ class SegmentationTool(QMainWindow):
         tool_layout = QHBoxLayout()
         tool_layout.addWidget(self.brush_button)
         tool_layout.addWidget(self.eraser_button)
+        tool_layout.addWidget(self.fill_button)
         tool_layout.addSpacing(15)  # 添加一些间距，分隔工具按钮和尺寸控件
         
         # 创建尺寸控件的子布局
@@ -324,6 +3580,8 @@ class SegmentationTool(QMainWindow):
         size_widget.setFixedWidth(170)  # 设置固定宽度，防止过度扩展
         
         tool_layout.addWidget(size_widget)  # 添加尺寸控件组
+        tool_layout.addWidget(self.class_label)
+        tool_layout.addWidget(self.class_spinbox)
         tool_layout.addStretch()  # 添加弹性空间，将控件推向左侧
         tool_layout.setContentsMargins(0, 0, 0, 0)
         
@@ -343,6 +3601,29 @@ class SegmentationTool(QMainWindow):
         container.setLayout(layout)
         self.setCentralWidget(container)
 
+        # 胶片栏：虚拟化的缩略图列表，只为可见的格子生成缩略图，点击跳转到对应图像
+        self.thumbnail_loader = None
+        self.filmstrip_model = FilmstripModel(self.paths_for, self)
+        self.filmstrip_view = QListView()
+        self.filmstrip_view.setModel(self.filmstrip_model)
+        self.filmstrip_view.setViewMode(QListView.IconMode)
+        self.filmstrip_view.setFlow(QListView.LeftToRight)
+        self.filmstrip_view.setWrapping(False)
+        self.filmstrip_view.setMovement(QListView.Static)
+        self.filmstrip_view.setUniformItemSizes(True)
+        self.filmstrip_view.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.filmstrip_view.setGridSize(QSize(THUMBNAIL_SIZE + 16, THUMBNAIL_SIZE + 32))
+        self.filmstrip_view.setTextElideMode(Qt.ElideMiddle)
+        self.filmstrip_view.setFocusPolicy(Qt.NoFocus)
+        self.filmstrip_view.clicked.connect(lambda index: self.jump_to_image(index.row()))
+        self.filmstrip_view.setFixedHeight(THUMBNAIL_SIZE + 56)
+        self.filmstrip_dock = QDockWidget("Filmstrip", self)
+        self.filmstrip_dock.setObjectName('filmstrip')
+        self.filmstrip_dock.setAllowedAreas(Qt.TopDockWidgetArea | Qt.BottomDockWidgetArea)
+        self.filmstrip_dock.setWidget(self.filmstrip_view)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.filmstrip_dock)
+        self.filmstrip_dock.hide()
+
         self.main_folder = None
         self.image_folder = None
         self.mask_folder = None
@@ -350,12 +3631,45 @@ class SegmentationTool(QMainWindow):
 
         self.image_list = []
         self.current_index = -1
+        self.dataset_index = None
+        self.index_sync_thread = None
+        self.index_synced.connect(self.refresh_image_list)
+        self.dataset_stats = None
+        self.stats_thread = None
+        self.stats_cancel = threading.Event()
+        # 统计更新完成后要跳转到的质检标记
+        self.stats_target = None
+        self.stats_updated.connect(self.stats_ready)
+        # 浏览方向（1 为向后，-1 为向前），用于决定预读取的优先顺序
+        self.navigation_direction = 1
+        self.prefetcher = ImagePrefetcher()
+        self.superpixels = SuperpixelEngine() if np is not None else None
+        # 模型预标注：没有已保存蒙版的图像以模型的建议作为初始蒙版（需要 NumPy）
+        self.preannotator = None
+        # 当前蒙版是否为尚未修改过的模型建议，以及正在等待建议的当前图像
+        self.proposal_unreviewed = False
+        self.awaiting_proposal = None
+        self.proposal_ready.connect(self.apply_late_proposal, Qt.QueuedConnection)
+        # 正在后台解码、当前只显示了预览图的图像
+        self.loading_image_path = None
+        self.pyramid_dir = None
+        self.image_decoded.connect(self.full_image_loaded, Qt.QueuedConnection)
 
         self.image = None
         self.mask = None
+        # 蒙版自加载以来是否被修改过，未修改时跳过保存
+        self.mask_dirty = False
 
-        # 历史栈
-        self.mask_history = []
+        # 后台蒙版写入队列
+        self.mask_writer = MaskWriter()
+        self.mask_writer.saved.connect(self.mask_saved)
+        self.mask_writer.failed.connect(self.mask_save_failed)
+        self.save_latency = None
+        # 当前文件夹的笔画日志（崩溃后恢复未保存的修改）
+        self.journal = None
+
+        # 撤销/重做历史（按图像分开，只保存变化的瓦片）
+        self.undo_history = UndoHistory()
 
         # 快捷键设置
         undo_shortcut = QKeySequence("Ctrl+Z")
@@ -364,9 +3678,136 @@ class SegmentationTool(QMainWindow):
         self.undo_action.triggered.connect(self.undo)
         self.addAction(self.undo_action)
 
+        redo_shortcut = QKeySequence("Ctrl+Shift+Z")
+        self.redo_action = QAction(self)
+        self.redo_action.setShortcut(redo_shortcut)
+        self.redo_action.triggered.connect(self.redo)
+        self.addAction(self.redo_action)
+
         # 初始化计数
         self.annotated_count = 0
 
+        # 显示菜单：叠加层颜色与合成方式
+        view_menu = self.menuBar().addMenu("View")
+        self.overlay_color_action = QAction("Overlay Colour...", self)
+        self.overlay_color_action.triggered.connect(self.choose_overlay_color)
+        view_menu.addAction(self.overlay_color_action)
+        self.numpy_compositor_action = QAction("NumPy Compositing", self)
+        self.numpy_compositor_action.setCheckable(True)
+        self.numpy_compositor_action.setChecked(self.image_label.use_numpy_compositor)
+        self.numpy_compositor_action.setEnabled(self.image_label.compositor is not None)
+        self.numpy_compositor_action.toggled.connect(self.toggle_numpy_compositor)
+        view_menu.addAction(self.numpy_compositor_action)
+        self.hud_action = QAction("Performance HUD", self)
+        self.hud_action.setCheckable(True)
+        self.hud_action.toggled.connect(self.set_hud_visible)
+        view_menu.addAction(self.hud_action)
+        # 标签图模式下逐类显示或隐藏
+        self.classes_menu = view_menu.addMenu("Classes")
+        self.classes_menu.setEnabled(False)
+        for class_id in range(1, LABEL_CLASSES + 1):
+            swatch = QPixmap(12, 12)
+            swatch.fill(label_color(class_id))
+            action = QAction(QIcon(swatch), f"Class {class_id}", self)
+            action.setCheckable(True)
+            action.setChecked(True)
+            action.toggled.connect(lambda visible, class_id=class_id: self.image_label.set_class_visible(class_id, visible))
+            self.classes_menu.addAction(action)
+        self.filmstrip_action = self.filmstrip_dock.toggleViewAction()
+        self.filmstrip_action.setShortcut(QKeySequence("Ctrl+T"))
+        view_menu.addAction(self.filmstrip_action)
+
+        # 性能 HUD：叠加在画布左上角，定时刷新帧耗时和各阶段平均耗时
+        self.hud_label = QLabel(self.scroll_area)
+        self.hud_label.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.hud_label.setStyleSheet(
+            "background-color: rgba(0, 0, 0, 160); color: white; font-family: monospace; padding: 4px;"
+        )
+        self.hud_label.move(8, 8)
+        self.hud_label.hide()
+        self.hud_timer = QTimer(self)
+        self.hud_timer.setInterval(500)
+        self.hud_timer.timeout.connect(self.update_hud)
+
+        # 蒙版菜单：保存格式与 PNG 压缩级别（读取时自动识别格式）
+        self.mask_format = 'png'
+        self.png_compression = -1
+        mask_menu = self.menuBar().addMenu("Mask")
+        # 大图的蒙版使用内存映射文件作为后备存储
+        self.use_mapped_masks = True
+        self.mapped_mask = None
+        self.mapped_base_path = None
+        self.mapped_masks_action = QAction("Memory-Mapped Large Masks", self)
+        self.mapped_masks_action.setCheckable(True)
+        self.mapped_masks_action.setChecked(self.use_mapped_masks)
+        self.mapped_masks_action.toggled.connect(self.toggle_mapped_masks)
+        mask_menu.addAction(self.mapped_masks_action)
+        # 流式导出训练分片，按主文件夹记录是否开启
+        self.exporter = None
+        self.export_action = QAction("Stream Export to Shards", self)
+        self.export_action.setCheckable(True)
+        self.export_action.toggled.connect(self.toggle_export)
+        mask_menu.addAction(self.export_action)
+        # 标签图模式按主文件夹记录在数据集索引中
+        self.label_mode_action = QAction("Multi-Class Label Map", self)
+        self.label_mode_action.setCheckable(True)
+        self.label_mode_action.toggled.connect(self.toggle_label_mode)
+        mask_menu.addAction(self.label_mode_action)
+        self.preannotation_action = QAction("Pre-annotation Model...", self)
+        self.preannotation_action.setEnabled(np is not None)
+        self.preannotation_action.triggered.connect(self.choose_preannotation_model)
+        mask_menu.addAction(self.preannotation_action)
+        # 未审核的建议不会自动保存，需要修改或显式接受
+        self.accept_proposal_action = QAction("Accept Model Proposal", self)
+        self.accept_proposal_action.setShortcut(QKeySequence("Ctrl+Return"))
+        self.accept_proposal_action.setEnabled(False)
+        self.accept_proposal_action.triggered.connect(self.accept_proposal)
+        mask_menu.addAction(self.accept_proposal_action)
+
+        # 团队菜单：多人共享同一文件夹时通过租约分配图像
+        self.leases = None
+        self.lease_name = None
+        # 蒙版写入完成后再释放租约的图像（蒙版路径 -> 图像名）
+        self.lease_release_pending = {}
+        team_menu = self.menuBar().addMenu("Team")
+        self.coordinate_action = QAction("Share Folder With Other Annotators", self)
+        self.coordinate_action.setCheckable(True)
+        self.coordinate_action.toggled.connect(self.toggle_coordination)
+        team_menu.addAction(self.coordinate_action)
+
+        # 质检菜单：按缓存的统计结果跳转到有问题的图像（统计需要 NumPy）
+        qa_menu = self.menuBar().addMenu("QA")
+        for flag, title in QA_FLAGS.items():
+            action = QAction(f"Next Image With {title}", self)
+            action.setEnabled(np is not None)
+            action.triggered.connect(lambda checked, flag=flag: self.load_next_flagged_image(flag))
+            qa_menu.addAction(action)
+        qa_menu.addSeparator()
+        self.refresh_stats_action = QAction("Refresh Statistics", self)
+        self.refresh_stats_action.setEnabled(np is not None)
+        self.refresh_stats_action.triggered.connect(lambda: self.update_stats())
+        qa_menu.addAction(self.refresh_stats_action)
+        format_menu = mask_menu.addMenu("Save Format")
+        self.mask_format_group = QActionGroup(self)
+        for fmt, title in MASK_FORMATS.items():
+            action = QAction(title, self)
+            action.setCheckable(True)
+            action.setChecked(fmt == self.mask_format)
+            # RLE 编解码需要 NumPy
+            action.setEnabled(fmt != 'rle' or np is not None)
+            action.triggered.connect(lambda checked, fmt=fmt: self.set_mask_format(fmt))
+            self.mask_format_group.addAction(action)
+            format_menu.addAction(action)
+        compression_menu = mask_menu.addMenu("PNG Compression")
+        self.png_compression_group = QActionGroup(self)
+        for level, title in ((-1, "Default"), (0, "0 (fastest)"), (1, "1"), (3, "3"), (6, "6"), (9, "9 (smallest)")):
+            action = QAction(title, self)
+            action.setCheckable(True)
+            action.setChecked(level == self.png_compression)
+            action.triggered.connect(lambda checked, level=level: self.set_png_compression(level))
+            self.png_compression_group.addAction(action)
+            compression_menu.addAction(action)
+
         # 默认选择画笔模式
         self.set_brush_mode()
 
@@ -393,15 +3834,122 @@ class SegmentationTool(QMainWindow):
         self.shortcut_down.setContext(Qt.ApplicationShortcut)
         self.shortcut_down.activated.connect(self.load_next_image)
 
+        # 恢复上次的工具、尺寸和缩放；上次的文件夹在事件循环开始后打开
+        self.session = session
+        self.settings = QSettings("iw_anno", "iw_anno")
+        self.restoring = False
+        if session:
+            self.coordinate_action.setChecked(self.settings.value('coordinate', False, type=bool))
+            self.filmstrip_dock.setVisible(self.settings.value('filmstrip', False, type=bool))
+            self.set_preannotation_model(self.settings.value('preannotation_model', '') or '')
+            self.restore_tool_state()
+            if os.path.isdir(self.settings.value('main_folder', '') or ''):
+                self.restoring = True
+                QTimer.singleShot(0, self.restore_session)
+        self.startup_marks['window'] = (time.perf_counter() - STARTUP_BEGIN) * 1000
+
+    def restore_tool_state(self):
+        self.brush_size = self.settings.value('brush_size', self.brush_size, type=int)
+        self.eraser_size = self.settings.value('eraser_size', self.eraser_size, type=int)
+        self.image_label.set_brush_size(self.brush_size)
+        self.image_label.set_eraser_size(self.eraser_size)
+        self.image_label.zoom_factor = self.settings.value('zoom', self.image_label.zoom_factor, type=float)
+        tool = self.settings.value('tool', 'brush')
+        if tool == 'eraser':
+            self.eraser_button.setChecked(True)
+            self.set_eraser_mode()
+        elif tool == 'fill' and self.fill_button.isEnabled():
+            self.fill_button.setChecked(True)
+            self.set_fill_mode()
+        else:
+            self.set_brush_mode()
+
+    def restore_session(self):
+        """直接打开上次的主文件夹并定位到上次的图像"""
+        if self.closing:
+            return
+        start = time.perf_counter()
+        self.open_folder(self.settings.value('main_folder'))
+        self.startup_marks['restore'] = (time.perf_counter() - STARTUP_BEGIN) * 1000
+        PROFILER.record('session_restore', (time.perf_counter() - start) * 1000)
+        self.restoring = False
+        if self.image is None:
+            # 没有可显示的图像，不再等待图像帧
+            self.finish_startup()
+
+    def save_session(self):
+        if not self.session:
+            return
+        if self.main_folder:
+            self.settings.setValue('main_folder', self.main_folder)
+        if self.fill_button.isChecked():
+            tool = 'fill'
+        else:
+            tool = 'eraser' if self.erase_mode else 'brush'
+        self.settings.setValue('tool', tool)
+        self.settings.setValue('brush_size', self.brush_size)
+        self.settings.setValue('eraser_size', self.eraser_size)
+        self.settings.setValue('zoom', self.image_label.zoom_factor)
+        self.settings.setValue('coordinate', self.coordinate_action.isChecked())
+        self.settings.setValue('filmstrip', self.filmstrip_dock.isVisible())
+        self.settings.setValue('preannotation_model', self.preannotator.model if self.preannotator else '')
+        self.settings.sync()
+
+    def frame_painted(self, shown_image):
+        """
+        画布完成一次绘制。恢复会话时等到第一帧图像，否则第一帧界面绘制后即结束启动阶段。
+        """
+        if not self.startup_pending:
+            return
+        now = (time.perf_counter() - STARTUP_BEGIN) * 1000
+        self.startup_marks.setdefault('first_frame', now)
+        if shown_image:
+            self.startup_marks['first_image_frame'] = now
+            self.finish_startup()
+        elif not self.restoring:
+            self.finish_startup()
+
+    def finish_startup(self):
+        """输出启动耗时报告，并开始执行推迟的工作"""
+        if not self.startup_pending or self.closing:
+            return
+        self.startup_pending = False
+        report = " | ".join(f"{name} {ms:.0f} ms" for name, ms in self.startup_marks.items())
+        if self.session:
+            print(f"Startup: {report}")
+        self.statusBar().showMessage(f"Startup: {report}", 5000)
+        for name, ms in self.startup_marks.items():
+            PROFILER.record(f"startup_{name}", ms)
+        QTimer.singleShot(0, self.run_deferred)
+
+    def run_deferred(self):
+        """逐个执行推迟的工作，每项之间回到事件循环；窗口关闭后丢弃剩余的工作"""
+        if self.closing or not self.deferred:
+            self.deferred = None
+            return
+        self.deferred.pop(0)()
+        QTimer.singleShot(0, self.run_deferred)
+
+    def run_after_startup(self, callback):
+        """启动阶段（第一帧绘制之前）把非必要的工作推迟执行"""
+        if self.closing:
+            return
+        if self.deferred is None:
+            callback()
+        else:
+            self.deferred.append(callback)
+
     def set_brush_mode(self):
         """设置画笔模式并更新界面"""
         self.erase_mode = False
         self.image_label.set_erase_mode(False)
+        self.image_label.set_fill_mode(False)
         # 更新尺寸显示为当前画笔尺寸
         self.size_spinbox.setValue(self.brush_size)
         # 更新按钮样式
         self.brush_button.setStyleSheet("background-color: #e6f3ff;")  # 浅蓝色背景
         self.eraser_button.setStyleSheet("")
+        self.fill_button.setStyleSheet("")
         # 同步尺寸到画板
         self.image_label.set_brush_size(self.brush_size)
 
@@ -409,14 +3957,25 @@ class SegmentationTool(QMainWindow):
         """设置橡皮擦模式并更新界面"""
         self.erase_mode = True
         self.image_label.set_erase_mode(True)
+        self.image_label.set_fill_mode(False)
         # 更新尺寸显示为当前橡皮擦尺寸
         self.size_spinbox.setValue(self.eraser_size)
         # 更新按钮样式
         self.eraser_button.setStyleSheet("background-color: #e6f3ff;")  # 浅蓝色背景
         self.brush_button.setStyleSheet("")
+        self.fill_button.setStyleSheet("")
         # 同步尺寸到画板
         self.image_label.set_eraser_size(self.eraser_size)
 
+    def set_fill_mode(self):
+        """设置超像素填充模式并更新界面"""
+        self.image_label.set_fill_mode(True)
+        self.fill_button.setStyleSheet("background-color: #e6f3ff;")  # 浅蓝色背景
+        self.brush_button.setStyleSheet("")
+        self.eraser_button.setStyleSheet("")
+        # 当前图像的超像素可能还没有计算
+        self.schedule_superpixels()
+
     def change_size(self, value):
         """根据当前工具更新对应尺寸"""
         if self.erase_mode:
@@ -435,6 +3994,106 @@ class SegmentationTool(QMainWindow):
         self.image_label.set_show_image(self.show_image_checkbox.isChecked())
         self.image_label.update_display()
 
+    def choose_overlay_color(self):
+        """选择叠加层颜色，alpha 通道决定不透明度"""
+        color = QColorDialog.getColor(
+            self.image_label.overlay_color, self, "Overlay Colour", QColorDialog.ShowAlphaChannel
+        )
+        if color.isValid():
+            self.image_label.set_overlay_color(color)
+            self.image_label.update_display()
+
+    def set_mask_format(self, fmt):
+        """设置之后保存蒙版时使用的格式"""
+        self.mask_format = fmt
+
+    def toggle_export(self, enabled):
+        if self.dataset_index is not None:
+            self.dataset_index.set_meta('export', int(enabled))
+        self.set_export(enabled)
+
+    def set_export(self, enabled):
+        """开启时在后台与已有标注对齐，之后每次保存或删除只重写受影响的分片"""
+        self.export_action.blockSignals(True)
+        self.export_action.setChecked(enabled)
+        self.export_action.blockSignals(False)
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
+        if enabled and self.main_folder and self.dataset_index is not None:
+            try:
+                self.exporter = ShardExporter(self.main_folder)
+            except (OSError, sqlite3.Error) as e:
+                self.statusBar().showMessage(f"Failed to open export folder: {e}", 5000)
+                return
+            self.exporter.start(self.dataset_index.annotated())
+
+    def save_format(self):
+        """保存时实际使用的格式；1 位 PNG 和 RLE 只能表示二值蒙版，标签图总是保存为 8 位 PNG"""
+        return 'png' if self.label_mode else self.mask_format
+
+    def toggle_label_mode(self, enabled):
+        if self.dataset_index is not None:
+            self.dataset_index.set_meta('label_mode', int(enabled))
+        self.set_label_mode(enabled)
+
+    def set_label_mode(self, enabled):
+        """切换二值蒙版与多类别标签图；蒙版内容不变，只改变画笔写入的值和叠加层的着色方式"""
+        self.label_mode = enabled
+        self.label_mode_action.blockSignals(True)
+        self.label_mode_action.setChecked(enabled)
+        self.label_mode_action.blockSignals(False)
+        self.class_label.setVisible(enabled)
+        self.class_spinbox.setVisible(enabled)
+        self.classes_menu.setEnabled(enabled)
+        self.prefetcher.smooth_masks = not enabled
+        self.image_label.set_label_mode(enabled)
+        if self.thumbnail_loader is not None and self.thumbnail_loader.label_mode != enabled:
+            self.thumbnail_loader.label_mode = enabled
+            self.filmstrip_model.invalidate_all()
+        self.set_label_class(self.class_spinbox.value())
+
+    def set_label_class(self, class_id):
+        value = class_id if self.label_mode else 255
+        self.image_label.set_brush_color(QColor(value, value, value))
+        if self.label_mode:
+            self.class_spinbox.setStyleSheet(f"background-color: {label_color(class_id).name()};")
+        else:
+            self.class_spinbox.setStyleSheet("")
+
+    def set_png_compression(self, level):
+        self.png_compression = level
+
+    def toggle_mapped_masks(self, enabled):
+        """从下一次加载图像开始生效"""
+        self.use_mapped_masks = enabled
+
+    def set_hud_visible(self, visible):
+        """显示性能 HUD；跟踪未开启时只在内存中统计"""
+        if visible and not PROFILER.enabled:
+            PROFILER.enable()
+        self.hud_action.setChecked(visible)
+        self.hud_label.setVisible(visible)
+        if visible:
+            self.update_hud()
+            self.hud_timer.start()
+        else:
+            self.hud_timer.stop()
+
+    def update_hud(self):
+        averages = PROFILER.averages()
+        frame = averages.pop('frame', None)
+        lines = [f"{'frame':<15}{frame:6.1f} ms" if frame is not None else f"{'frame':<15}     - ms"]
+        lines += [f"{name:<15}{value:6.1f} ms" for name, value in sorted(averages.items())]
+        lines += [f"{name:<15}{total:6d}" for name, total in sorted(PROFILER.counts.items())]
+        self.hud_label.setText("\n".join(lines))
+        self.hud_label.adjustSize()
+        self.hud_label.raise_()
+
+    def toggle_numpy_compositor(self, enabled):
+        self.image_label.set_numpy_compositor(enabled)
+        self.image_label.update_display()
+
     def update_count_label(self):
         self.count_label.setText(f"Annotated samples: {self.annotated_count}")
 
@@ -449,7 +4108,12 @@ class SegmentationTool(QMainWindow):
         if not main_folder:
             print("No main folder selected.")
             return
+        self.open_folder(main_folder)
 
+    def open_folder(self, main_folder):
+        """打开包含 images/ 和 masks/ 的主文件夹"""
+        # 按上一个文件夹的路径保存或丢弃当前图像的修改
+        self.leave_current_image()
         self.main_folder = main_folder
         self.image_folder = os.path.join(self.main_folder, 'images')
         self.mask_folder = os.path.join(self.main_folder, 'masks')
@@ -461,24 +4125,162 @@ class SegmentationTool(QMainWindow):
 
         if not os.path.exists(self.mask_folder):
             os.makedirs(self.mask_folder)
+        # 切换文件夹前确保上一个文件夹的蒙版已全部写入
+        self.mask_writer.flush()
+        self.close_journal()
+        self.prefetcher.clear()
+        self.undo_history.clear()
 
-        self.image_list = [
-            f for f in os.listdir(self.image_folder)
-            if f.lower().endswith((".png", ".jpg"))
-        ]
-        self.image_list.sort(key=self.natural_key)
+        # 通过持久化索引获取排好序的文件列表，只重新扫描变化的部分
+        self.wait_index_sync()
+        if self.dataset_index is not None:
+            self.dataset_index.close()
+        self.dataset_index = DatasetIndex(self.main_folder)
+        self.image_list = self.dataset_index.names()
+        self.set_label_mode(self.dataset_index.get_meta('label_mode') == '1')
+        self.set_export(False)
+        self.stop_stats()
+        if np is not None:
+            self.dataset_stats = DatasetStats(self.main_folder)
+        last_image = self.dataset_index.get_meta('last_image')
+        if last_image in self.image_list and image_exists(os.path.join(self.image_folder, last_image)):
+            # 已有索引时直接按上次的列表打开，与文件系统的同步在后台进行
+            self.index_sync_thread = threading.Thread(
+                target=self.sync_index, args=(self.dataset_index,), name='index-sync', daemon=True
+            )
+            self.index_sync_thread.start()
+        else:
+            self.dataset_index.sync(self.image_folder, self.mask_folder)
+            self.image_list = self.dataset_index.names()
+        if self.session:
+            self.settings.setValue('main_folder', self.main_folder)
+        self.stop_leases()
+        if self.coordinate_action.isChecked():
+            self.leases = LeaseManager(self.main_folder)
+        self.open_journal()
+        # 在日志恢复之后启动导出，恢复写入的蒙版也会在启动时的对齐中导出
+        self.set_export(self.dataset_index.get_meta('export') == '1')
+        if self.thumbnail_loader is not None:
+            self.thumbnail_loader.stop()
+        self.thumbnail_loader = ThumbnailLoader(app_data_path(self.main_folder, 'thumbnails'), label_mode=self.label_mode)
+        self.filmstrip_model.set_loader(self.thumbnail_loader)
+        self.filmstrip_model.set_names(self.image_list)
 
         if not self.image_list:
             print("No images found.")
             return
 
-        self.current_index = 0
+        # 从上次离开的图像继续（协作模式下跳过他人正在标注的图像）
+        start = self.image_list.index(last_image) if last_image in self.image_list else 0
+        index = self.available_index(start, 1)
+        if index is None:
+            index = self.available_index(start - 1, -1)
+        if index is None:
+            self.statusBar().showMessage("All images are currently held by other annotators.", 5000)
+            return
+        self.current_index = index
+        self.unannotated_button.setEnabled(True)
         self.load_current_image()
 
+    def open_journal(self):
+        """打开当前文件夹的笔画日志，并把上次未保存的修改恢复到蒙版文件"""
+        # 协作模式下每名标注员使用各自的日志，避免重放他人的修改
+        name = 'journal.log'
+        if self.leases is not None:
+            name = f"journal-{re.sub(r'[^A-Za-z0-9_.@-]', '_', f'{getpass.getuser()}@{socket.gethostname()}')}.log"
+        try:
+            self.journal = StrokeJournal(app_data_path(self.main_folder, name))
+        except OSError as e:
+            print(f"Failed to open stroke journal: {e}")
+            return
+        recovered = 0
+        for image_name, records in self.journal.pending().items():
+            image_path = os.path.join(self.image_folder, image_name)
+            if image_name not in self.image_list or not image_exists(image_path):
+                self.journal.discard(image_name)
+                continue
+            mask_path = os.path.join(self.save_folder, os.path.splitext(image_name)[0] + '.png')
+            size = read_image_size(image_path)
+            mask = decode_mask(mask_path, size, not self.label_mode)
+            if mask is None:
+                mask = QImage(size, QImage.Format_Grayscale8)
+                mask.fill(0)
+            for record in records:
+                apply_journal_record(mask, record)
+            try:
+                save_mask_file(mask, mask_path, self.save_format(), self.png_compression)
+            except Exception as e:
+                print(f"Failed to recover edits for {image_name}: {e}")
+                continue
+            self.journal.mark_saved(image_name, records[-1]['seq'])
+            self.dataset_index.set_has_mask(image_name, True)
+            recovered += 1
+        if recovered:
+            print(f"Recovered unsaved edits on {recovered} image(s) from the journal.")
+            self.statusBar().showMessage(f"Recovered unsaved edits on {recovered} image(s) from the journal.", 5000)
+
+    def close_journal(self):
+        if self.journal is not None:
+            # 先处理已写完但尚未送达的 saved 信号，记下保存标记
+            QApplication.sendPostedEvents(self, QEvent.MetaCall)
+            self.journal.close()
+            self.journal = None
+
+    def current_journal_name(self):
+        """当前图像在笔画日志中的名称；没有日志时返回 None"""
+        if self.journal is None or not 0 <= self.current_index < len(self.image_list):
+            return None
+        return self.image_list[self.current_index]
+
+    def record_stroke(self, points, size, erase):
+        name = self.current_journal_name()
+        if name is not None:
+            self.journal.stroke(name, points, size, erase, self.image_label.brush_color.red())
+
+    def record_patch(self, rect):
+        name = self.current_journal_name()
+        if name is not None:
+            self.journal.patch(name, self.mask, rect)
+
+    def sync_index(self, index):
+        """在后台线程中同步索引，完成后通知主线程"""
+        try:
+            changed = index.sync(self.image_folder, self.mask_folder)
+        except Exception as e:
+            print(f"Failed to sync dataset index: {e}")
+            return
+        self.index_synced.emit(index, changed)
+
+    def wait_index_sync(self):
+        if self.index_sync_thread is not None:
+            self.index_sync_thread.join()
+            self.index_sync_thread = None
+
+    def refresh_image_list(self, index, changed):
+        """后台同步发现文件增删后更新图像列表，尽量停留在当前图像"""
+        if index is not self.dataset_index or not changed:
+            return
+        current = self.image_list[self.current_index] if 0 <= self.current_index < len(self.image_list) else None
+        self.image_list = index.names()
+        self.filmstrip_model.set_names(self.image_list)
+        if current in self.image_list:
+            self.current_index = self.image_list.index(current)
+            self.select_filmstrip_item()
+            self.next_button.setEnabled(self.current_index < len(self.image_list) - 1)
+            self.prev_button.setEnabled(self.current_index > 0)
+            self.annotated_count = self.current_index + 1
+            self.update_count_label()
+            self.schedule_prefetch()
+        else:
+            # 当前图像已被删除
+            self.current_index = min(max(self.current_index, 0), len(self.image_list) - 1)
+            self.load_current_image()
+
     def load_current_image(self):
         if self.current_index < 0 or self.current_index >= len(self.image_list):
             print("Current index out of range.")
             self.image_label.clear()
+            self.close_mapped_mask()
             self.next_button.setEnabled(False)
             self.prev_button.setEnabled(False)
             self.delete_button.setEnabled(False)
@@ -487,49 +4289,475 @@ class SegmentationTool(QMainWindow):
             return
 
         filename = self.image_list[self.current_index]
-        image_path = os.path.join(self.image_folder, filename)
-        # 获取不带扩展名的文件名，并添加.png作为mask的扩展名
-        mask_filename = os.path.splitext(filename)[0] + '.png'
-        mask_path = os.path.join(self.mask_folder, mask_filename)
+        image_path, mask_path = self.entry_paths(self.current_index)
 
-        self.image = QImage(image_path).convertToFormat(QImage.Format_RGB32)
-        if os.path.exists(mask_path):
-            self.mask = QImage(mask_path).convertToFormat(QImage.Format_Grayscale8)
-            if self.mask.size() != self.image.size():
-                self.mask = self.mask.scaled(self.image.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        pending_mask = self.mask_writer.pending_image(mask_path)
+        if isinstance(pending_mask, MaskPatch):
+            # 大蒙版的补丁只有写入后才能读取到完整内容
+            self.mask_writer.flush()
+            pending_mask = None
+        self.proposal_unreviewed = False
+        self.awaiting_proposal = None
+        # 优先使用预读取缓存中已解码的图像和蒙版；大图未缓存时先显示预览图
+        cached = self.prefetcher.cached_image(image_path)
+        image_size = cached.size() if cached is not None else read_image_size(image_path)
+        self.loading_image_path = None
+        if cached is None and image_size.width() * image_size.height() >= PROGRESSIVE_MIN_PIXELS:
+            # 蒙版按原图尺寸读取，预览期间的绘制直接落在原图坐标上
+            self.image = decode_preview(image_path)
+            self.mask = self.prefetcher.load_mask(mask_path, image_size)
+            self.loading_image_path = image_path
+            self.prefetcher.request(image_path, mask_path).add_done_callback(
+                lambda future, path=image_path: self.emit_image_decoded(path, future)
+            )
         else:
-            self.mask = QImage(self.image.size(), QImage.Format_Grayscale8)
-            self.mask.fill(0)
+            self.image, self.mask = self.prefetcher.load(image_path, mask_path)
+            image_size = self.image.size()
+        mapped = self.use_mapped_masks and image_size.width() * image_size.height() >= MASK_MAP_MIN_PIXELS
+        if pending_mask is not None:
+            # 该蒙版仍在写入队列中，磁盘上的文件可能是旧内容
+            self.mask = QImage(pending_mask)
+            self.mask_dirty = False
+        elif self.mask is None:
+            self.mask = self.load_current_proposal(image_path, image_size)
+            if self.mask is not None:
+                # 模型建议在用户修改或接受之前不保存，否则离开图像后就与人工标注无法区分
+                self.proposal_unreviewed = True
+                self.mask_dirty = False
+            else:
+                if not mapped:
+                    PROFILER.count('full_image_copy')
+                    self.mask = QImage(image_size, QImage.Format_Grayscale8)
+                    self.mask.fill(0)
+                if self.preannotator is not None:
+                    # 建议稍后生成时，只要还没有修改就替换空白蒙版
+                    self.awaiting_proposal = image_path
+                # 保持每张浏览过的图像都有蒙版文件
+                self.mask_dirty = True
+        else:
+            # 磁盘上的蒙版尺寸与图像不一致时，保存缩放后的版本
+            self.mask_dirty = stored_mask_size(mask_path) != image_size
+        previous_mapped = (self.mapped_mask, self.mapped_base_path)
+        self.mapped_mask = self.mapped_base_path = None
+        if mapped:
+            # 复制到映射文件后即可释放解码得到的整幅蒙版
+            stem = image_stem(image_path)
+            folder = app_data_path(self.main_folder, 'maskmap')
+            os.makedirs(folder, exist_ok=True)
+            self.mapped_mask = MappedMask.create(folder, stem, image_size, self.mask)
+            self.mapped_base_path = self.mapped_mask.snapshot(folder, stem)
+            self.mask = self.mapped_mask.image
 
-        self.image_label.set_image(self.image)
+        # 大图的金字塔瓦片缓存到主文件夹下，下次打开时直接读取
+        self.pyramid_dir = None
+        if image_size.width() * image_size.height() >= PYRAMID_DISK_CACHE_MIN_PIXELS:
+            self.pyramid_dir = app_data_path(
+                self.main_folder, 'pyramid', f"{image_stem(image_path)}_{file_mtime_ns(image_path)}"
+            )
+        self.image_label.set_image(self.image, self.pyramid_dir, image_size)
+        if self.pyramid_dir is not None:
+            ImagePyramid.remove_stale(self.pyramid_dir)
         self.image_label.set_mask(self.mask)
         self.image_label.update_display()
+        # 标签已不再引用上一张图像的映射内存
+        self.release_mapped_mask(*previous_mapped)
 
         self.next_button.setEnabled(self.current_index < len(self.image_list) - 1)
         self.prev_button.setEnabled(self.current_index > 0)
         self.delete_button.setEnabled(True)
         self.clear_button.setEnabled(True)
-        self.image_name_label.setText(f"Image: {filename}")
+        self.update_image_name_label()
         self.annotated_count = self.current_index + 1
         self.update_count_label()
+        self.run_after_startup(self.schedule_prefetch)
+        self.run_after_startup(self.schedule_superpixels)
+        self.run_after_startup(self.schedule_proposals)
+        self.dataset_index.set_meta('last_image', filename)
+        self.update_leases()
+        self.select_filmstrip_item()
+
+    def emit_image_decoded(self, image_path, future):
+        """在解码线程中调用，结果经排队连接交给主线程；被取消的任务会由新的请求替代"""
+        if not future.cancelled():
+            self.image_decoded.emit(image_path, None if future.exception() else future.result())
+
+    def full_image_loaded(self, image_path, image):
+        """后台解码的全分辨率图像替换预览图；缩放、滚动位置和蒙版都不变，进行中的笔画不受影响"""
+        if image_path != self.loading_image_path:
+            return
+        self.loading_image_path = None
+        if image is None:
+            self.statusBar().showMessage(f"Failed to decode {os.path.basename(image_path)}", 5000)
+            return
+        self.image = image
+        self.image_label.set_image(image, self.pyramid_dir)
+        self.image_label.update_display()
+
+    def close_mapped_mask(self):
+        """释放当前的映射蒙版"""
+        self.release_mapped_mask(self.mapped_mask, self.mapped_base_path)
+        self.mapped_mask = self.mapped_base_path = None
+
+    def release_mapped_mask(self, mapped_mask, base_path):
+        """关闭映射蒙版，其保存基准文件在排队中的补丁写完后删除"""
+        if mapped_mask is not None:
+            mapped_mask.close()
+            self.mask_writer.release_base(base_path)
+
+    def entry_paths(self, index):
+        """返回 image_list 中第 index 项的图像路径和蒙版路径"""
+        return self.paths_for(self.image_list[index])
+
+    def paths_for(self, filename):
+        """返回图像文件名对应的图像路径和蒙版路径"""
+        # 获取不带扩展名的文件名，并添加.png作为mask的扩展名
+        mask_filename = os.path.splitext(filename)[0] + '.png'
+        return os.path.join(self.image_folder, filename), os.path.join(self.mask_folder, mask_filename)
+
+    def schedule_prefetch(self):
+        """沿当前浏览方向优先预读取后续图像，其次是反方向的图像"""
+        if self.closing:
+            return
+        step = self.navigation_direction
+        indices = [self.current_index + step * i for i in range(1, self.prefetcher.ahead + 1)]
+        indices += [self.current_index - step * i for i in range(1, self.prefetcher.behind + 1)]
+        self.prefetcher.schedule([
+            self.entry_paths(i) for i in indices if 0 <= i < len(self.image_list)
+        ])
+
+    def superpixel_dir(self):
+        return app_data_path(self.main_folder, 'superpixels')
+
+    def schedule_superpixels(self):
+        """使用填充工具时，在后台进程中计算当前图像及即将浏览的图像的超像素"""
+        if self.closing or self.superpixels is None or not self.fill_button.isChecked():
+            return
+        step = self.navigation_direction
+        indices = [self.current_index + step * i for i in range(self.prefetcher.ahead + 1)]
+        self.superpixels.schedule(self.superpixel_dir(), [
+            self.entry_paths(i)[0] for i in indices if 0 <= i < len(self.image_list)
+        ])
+
+    def choose_preannotation_model(self):
+        spec, accepted = QInputDialog.getText(
+            self, "Pre-annotation Model",
+            "Model as module:function or path/to/file.py:function (\"stub\" for the built-in test model; "
+            "empty to disable):",
+            text=self.preannotator.model if self.preannotator else ''
+        )
+        if accepted:
+            self.set_preannotation_model(spec.strip())
+
+    def set_preannotation_model(self, spec):
+        """切换预标注模型；spec 为空时关闭预标注"""
+        if self.preannotator is not None:
+            if self.preannotator.model == spec:
+                return
+            self.preannotator.shutdown()
+            self.preannotator = None
+        self.awaiting_proposal = None
+        if spec and np is not None:
+            self.preannotator = PreannotationEngine(spec, on_ready=self.proposal_ready.emit)
+            self.schedule_proposals()
+
+    def schedule_proposals(self):
+        """在后台为当前图像及沿浏览方向即将打开、还没有蒙版的图像生成模型建议"""
+        if (self.closing or self.preannotator is None or not self.main_folder
+                or not 0 <= self.current_index < len(self.image_list)):
+            return
+        step = self.navigation_direction
+        paths = []
+        for i in range(PREANNOTATE_AHEAD + 1):
+            index = self.current_index + step * i
+            if not 0 <= index < len(self.image_list):
+                break
+            image_path, mask_path = self.entry_paths(index)
+            if resolve_mask_file(mask_path) is None and self.mask_writer.pending_image(mask_path) is None:
+                paths.append(image_path)
+        self.preannotator.schedule(self.preannotator.cache_dir(self.main_folder), paths)
+
+    def load_current_proposal(self, image_path, size):
+        """读取该图像已生成的模型建议，没有时返回 None"""
+        if self.preannotator is None:
+            return None
+        cache_path = self.preannotator.proposal(self.preannotator.cache_dir(self.main_folder), image_path)
+        return load_proposal(cache_path, size) if cache_path else None
+
+    def apply_late_proposal(self, image_path):
+        """当前图像的建议在打开之后才生成时，替换仍未修改的空白蒙版"""
+        if image_path != self.awaiting_proposal or self.mask is None:
+            return
+        self.awaiting_proposal = None
+        proposal = self.load_current_proposal(image_path, self.mask.size())
+        if proposal is None:
+            return
+        painter = QPainter(self.mask)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(0, 0, proposal)
+        painter.end()
+        if self.mapped_mask is not None:
+            self.mapped_mask.mark_dirty(self.mask.rect())
+        self.proposal_unreviewed = True
+        self.mask_dirty = False
+        self.update_image_name_label()
+        self.image_label.update_region(self.mask.rect())
+
+    def accept_proposal(self):
+        """原样接受当前图像的模型建议，之后与人工标注一样保存"""
+        if not self.proposal_unreviewed or self.mask is None:
+            return
+        self.record_patch(self.mask.rect())
+        self.proposal_unreviewed = False
+        self.mask_dirty = True
+        self.update_image_name_label()
+
+    def update_image_name_label(self):
+        name = self.image_list[self.current_index]
+        if self.proposal_unreviewed:
+            name += " (model proposal, unreviewed)"
+        self.image_name_label.setText(f"Image: {name}")
+        self.accept_proposal_action.setEnabled(self.proposal_unreviewed)
+
+    def fill_superpixel(self, point, erase=False):
+        """将 point 所在的整个超像素写入蒙版（erase 为 True 时清除），作为一步可撤销的修改"""
+        if self.mask is None or point is None or self.superpixels is None:
+            return
+        labels = self.superpixels.labels(self.superpixel_dir(), self.entry_paths(self.current_index)[0])
+        if labels is None:
+            self.statusBar().showMessage("Superpixels are still being computed for this image", 3000)
+            return
+        rect, inside = superpixel_region(labels, self.mask.size(), point)
+        self.save_mask_state()
+        self.before_mask_change(rect)
+        # 一次向量化写入整个超像素
+        region = qimage_array(self.mask)[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+        region[inside] = 0 if erase else self.image_label.brush_color.red()
+        self.finish_mask_change()
+        self.mask_dirty = True
+        self.record_patch(rect)
+        self.image_label.update_region(rect)
+
+    def leave_current_image(self):
+        """
+        关闭文件夹或退出前处理当前图像：开启自动保存时保存，否则与切换图像一样丢弃未保存的修改。
+        日志中只留下崩溃时来不及处理的记录，正常关闭后重新打开不会恢复用户没有保存的修改。
+        """
+        if self.auto_save_checkbox.isChecked():
+            self.save_mask()
+        self.discard_unsaved_history()
+
+    def discard_unsaved_history(self):
+        """离开图像时修改未被保存，重新打开时会读取旧蒙版，其撤销历史和日志记录也随之作废"""
+        if self.mask_dirty and 0 <= self.current_index < len(self.image_list):
+            self.undo_history.discard(self.history_key())
+            if self.journal is not None:
+                self.journal.discard(self.image_list[self.current_index])
+
+    def load_next_unannotated_image(self):
+        """跳转到当前图像之后第一张还没有蒙版的图像"""
+        if self.dataset_index is None or not self.image_list:
+            return
+        if self.auto_save_checkbox.isChecked():
+            self.save_mask()
+        name = self.image_list[self.current_index]
+        visited = set()
+        while True:
+            name = self.dataset_index.next_unannotated(name)
+            if name is None or name in visited:
+                self.statusBar().showMessage("All images are annotated.", 5000)
+                return
+            visited.add(name)
+            if self.leases is None or self.leases.acquire(name):
+                break
+        self.discard_unsaved_history()
+        self.current_index = self.image_list.index(name)
+        self.navigation_direction = 1
+        self.load_current_image()
 
     def load_next_image(self):
         if self.auto_save_checkbox.isChecked():
             self.save_mask()
-        if self.current_index + 1 < len(self.image_list):
-            self.current_index += 1
+        index = self.available_index(self.current_index + 1, 1)
+        if index is not None:
+            self.discard_unsaved_history()
+            self.current_index = index
+            self.navigation_direction = 1
             self.load_current_image()
+        elif self.current_index + 1 < len(self.image_list):
+            self.statusBar().showMessage("Later images are held by other annotators.", 5000)
 
     def load_previous_image(self):
         if self.auto_save_checkbox.isChecked():
             self.save_mask()
-        if self.current_index - 1 >= 0:
-            self.current_index -= 1
+        index = self.available_index(self.current_index - 1, -1)
+        if index is not None:
+            self.discard_unsaved_history()
+            self.current_index = index
+            self.navigation_direction = -1
+            self.load_current_image()
+        elif self.current_index > 0:
+            self.statusBar().showMessage("Earlier images are held by other annotators.", 5000)
+
+    def load_next_flagged_image(self, flag):
+        """跳转到当前图像之后第一张带有指定质检标记的图像；先在后台更新发生变化的统计"""
+        if self.dataset_stats is None or not self.image_list:
+            return
+        if self.auto_save_checkbox.isChecked():
+            self.save_mask()
+        self.update_stats(flag)
+
+    def update_stats(self, flag=None):
+        """在后台线程中增量更新质检统计，完成后跳转到下一张带有 flag 标记的图像（None 表示只更新）"""
+        if self.dataset_stats is None:
+            return
+        self.stats_target = flag
+        if self.stats_thread is not None and self.stats_thread.is_alive():
+            return
+        # 统计读取磁盘上的蒙版，先写完刚保存的修改
+        self.mask_writer.flush()
+        self.statusBar().showMessage("Updating QA statistics...")
+        self.stats_thread = threading.Thread(
+            target=self.run_stats_update, args=(self.dataset_stats, list(self.image_list), self.label_mode),
+            name='qa-stats', daemon=True
+        )
+        self.stats_thread.start()
+
+    def run_stats_update(self, stats, names, label_mode):
+        try:
+            stats.update(self.image_folder, self.mask_folder, names, cancel=self.stats_cancel, label_mode=label_mode)
+        except Exception as e:
+            print(f"Failed to update QA statistics: {e}")
+        self.stats_updated.emit(stats)
+
+    def stats_ready(self, stats):
+        if stats is not self.dataset_stats:
+            return
+        self.statusBar().clearMessage()
+        flag, self.stats_target = self.stats_target, None
+        if flag is None:
+            return
+        records = stats.records()
+        count = len(self.image_list)
+        for offset in range(1, count):
+            index = (self.current_index + offset) % count
+            name = self.image_list[index]
+            if flag not in records.get(name, {}).get('flags', ()):
+                continue
+            if self.leases is not None and not self.leases.acquire(name):
+                continue
+            self.discard_unsaved_history()
+            self.current_index = index
+            self.navigation_direction = 1
             self.load_current_image()
+            return
+        self.statusBar().showMessage(f"No other images with {QA_FLAGS[flag].lower()}.", 5000)
+
+    def stop_stats(self):
+        """取消正在进行的统计更新并关闭统计缓存"""
+        if self.stats_thread is not None:
+            self.stats_cancel.set()
+            self.stats_thread.join()
+            self.stats_thread = None
+            self.stats_cancel.clear()
+        if self.dataset_stats is not None:
+            self.dataset_stats.close()
+            self.dataset_stats = None
+        self.stats_target = None
+
+    def jump_to_image(self, index):
+        """从胶片栏直接跳转到第 index 张图像"""
+        if index == self.current_index or not 0 <= index < len(self.image_list):
+            return
+        if self.auto_save_checkbox.isChecked():
+            self.save_mask()
+        if self.leases is not None and not self.leases.acquire(self.image_list[index]):
+            self.statusBar().showMessage("This image is held by another annotator.", 5000)
+            self.select_filmstrip_item()
+            return
+        self.discard_unsaved_history()
+        self.navigation_direction = 1 if index > self.current_index else -1
+        self.current_index = index
+        self.load_current_image()
+
+    def select_filmstrip_item(self):
+        """在胶片栏中选中并居中显示当前图像（删除图像后列表长度变化时先重建模型）"""
+        if len(self.filmstrip_model.rows) != len(self.image_list):
+            self.filmstrip_model.set_names(self.image_list)
+        if 0 <= self.current_index < len(self.image_list):
+            index = self.filmstrip_model.index(self.current_index)
+            self.filmstrip_view.setCurrentIndex(index)
+            self.filmstrip_view.scrollTo(index, QListView.PositionAtCenter)
+
+    def available_index(self, start, step):
+        """从 start 开始沿 step 方向找到第一张可以打开的图像；协作模式下认领它并跳过他人持有的图像"""
+        index = start
+        while 0 <= index < len(self.image_list):
+            if self.leases is None or self.leases.acquire(self.image_list[index]):
+                return index
+            index += step
+        return None
+
+    def toggle_coordination(self, enabled):
+        """开启时为当前文件夹创建租约管理器；当前图像已被他人持有时跳到下一张空闲图像"""
+        if not enabled:
+            self.stop_leases()
+            return
+        if self.leases is not None or not self.main_folder or not self.image_list:
+            return
+        self.leases = LeaseManager(self.main_folder)
+        if 0 <= self.current_index < len(self.image_list):
+            if self.leases.acquire(self.image_list[self.current_index]):
+                self.update_leases()
+            else:
+                self.statusBar().showMessage("This image is held by another annotator.", 5000)
+                self.load_next_image()
+
+    def stop_leases(self):
+        if self.leases is not None:
+            # 释放之前确保蒙版已经写入，其他人打开时能读到最新内容
+            self.mask_writer.flush()
+            self.leases.stop()
+            self.leases = None
+        self.lease_name = None
+        self.lease_release_pending.clear()
+
+    def lease_mask_path(self, name):
+        return os.path.join(self.save_folder, os.path.splitext(name)[0] + '.png')
+
+    def update_leases(self):
+        """
+        打开新图像后预先认领后面一批图像，并释放其余图像的租约；
+        蒙版仍在写入队列中的图像等写入完成后再释放。
+        """
+        if self.leases is None:
+            return
+        self.lease_name = self.image_list[self.current_index]
+        if not self.leases.acquire(self.lease_name):
+            self.statusBar().showMessage("This image is held by another annotator.", 5000)
+        window = self.image_list[self.current_index + 1:self.current_index + 1 + LEASE_BATCH * 4]
+        ahead = [name for name in window if name in self.leases.held]
+        if len(ahead) < LEASE_BATCH - 1:
+            ahead += self.leases.acquire_batch(window, LEASE_BATCH - 1 - len(ahead))
+        keep = set(ahead) | {self.lease_name}
+        for name in list(self.leases.held - keep):
+            mask_path = self.lease_mask_path(name)
+            if self.mask_writer.pending_image(mask_path) is not None:
+                self.lease_release_pending[mask_path] = name
+            else:
+                self.leases.release(name)
+
+    def release_saved_lease(self, path):
+        name = self.lease_release_pending.pop(path, None)
+        if name is not None and self.leases is not None and name != self.lease_name:
+            self.leases.release(name)
 
     def delete_current_image(self):
         if self.current_index < 0 or self.current_index >= len(self.image_list):
             return
+        if split_shard_path(os.path.join(self.image_folder, self.image_list[self.current_index])) is not None:
+            # 归档是只读的数据源，不能从中删除单个成员
+            self.statusBar().showMessage("Images inside archives are read-only and cannot be deleted", 5000)
+            return
 
         # 弹出确认对话框，询问是否删除当前图片及其标注
         reply = QMessageBox.question(
@@ -543,6 +4771,14 @@ class SegmentationTool(QMainWindow):
         image_path = os.path.join(self.image_folder, filename)
         mask_path = os.path.join(self.mask_folder, filename)
         save_path = os.path.join(self.save_folder, filename)
+        self.prefetcher.invalidate(*self.entry_paths(self.current_index))
+        # 避免排队中的写入在删除后重新生成蒙版文件
+        self.mask_writer.cancel(self.entry_paths(self.current_index)[1])
+        self.undo_history.discard(self.history_key())
+        if self.journal is not None:
+            self.journal.discard(filename)
+        if self.exporter is not None:
+            self.exporter.remove(filename)
 
         # 删除图像文件
         if os.path.exists(image_path):
@@ -556,8 +4792,16 @@ class SegmentationTool(QMainWindow):
         if os.path.exists(save_path) and save_path != mask_path:
             os.remove(save_path)
             print(f"Deleted saved mask: {save_path}")
+        for path in mask_files(self.entry_paths(self.current_index)[1]):
+            if os.path.exists(path):
+                os.remove(path)
+                print(f"Deleted mask: {path}")
 
-        # 从列表中移除当前图片
+        # 从列表和索引中移除当前图片
+        self.dataset_index.remove(filename)
+        if self.leases is not None:
+            self.leases.release(filename)
+            self.lease_name = None
         del self.image_list[self.current_index]
 
         # 更新界面
@@ -566,54 +4810,138 @@ class SegmentationTool(QMainWindow):
             self.image_label.clear()
             self.image = None
             self.mask = None
+            self.close_mapped_mask()
             self.next_button.setEnabled(False)
             self.prev_button.setEnabled(False)
             self.delete_button.setEnabled(False)
             self.clear_button.setEnabled(False)
+            self.unannotated_button.setEnabled(False)
             self.image_name_label.setText("Image: None")
             self.annotated_count = 0
             self.update_count_label()
+            self.filmstrip_model.set_names(self.image_list)
         else:
             # 如果删除的是最后一张图片，则将索引减 1
             if self.current_index >= len(self.image_list):
                 self.current_index = len(self.image_list) - 1
             self.load_current_image()
 
+    @PROFILER.timed('save_mask')
     def save_mask(self):
-        if self.mask is not None:
+        if self.mask is not None and self.mask_dirty:
+            if self.leases is not None and self.image_list[self.current_index] in self.leases.lost:
+                self.statusBar().showMessage("Lease on this image expired and was taken over; saving anyway.", 5000)
             # 获取原始文件名（不含扩展名）并添加.png扩展名
             filename = os.path.splitext(self.image_list[self.current_index])[0] + '.png'
             save_path = os.path.join(self.save_folder, filename)
-            self.mask.save(save_path)
+            if self.mapped_mask is not None:
+                # 映射蒙版只提交修改过的瓦片，不能浅拷贝（继续绘制时会分离出整幅副本）
+                image = MaskPatch(self.mapped_base_path, self.mapped_mask.size, self.mapped_mask.take_dirty_tiles())
+            else:
+                # 交给后台线程编码写入；浅拷贝与当前蒙版共享数据，继续绘制时会自动分离
+                image = QImage(self.mask)
+                PROFILER.count('full_image_copy')
+            # 写入完成后在日志中标记该序号之前的修改已保存
+            tag = (self.journal, self.image_list[self.current_index], self.journal.seq if self.journal else 0)
+            self.mask_writer.submit(save_path, image, tag, fmt=self.save_format(), png_compression=self.png_compression)
+            self.mask_dirty = False
+            self.dataset_index.set_has_mask(self.image_list[self.current_index], True)
+            self.update_save_status()
+
+    def mask_saved(self, path, elapsed, depth, tag=None):
+        # 指数滑动平均，平滑显示保存耗时
+        latency = elapsed * 1000
+        self.save_latency = latency if self.save_latency is None else 0.8 * self.save_latency + 0.2 * latency
+        self.update_save_status()
+        self.release_saved_lease(path)
+        if tag is not None:
+            journal, name, seq = tag
+            if journal is not None and journal is self.journal:
+                journal.mark_saved(name, seq)
+            self.filmstrip_model.invalidate(name)
+            if self.exporter is not None:
+                self.exporter.update(name)
+
+    def mask_save_failed(self, path, error):
+        print(f"Failed to save mask {path}: {error}")
+        self.statusBar().showMessage(f"Failed to save mask {os.path.basename(path)}: {error}", 5000)
+        self.update_save_status()
+        self.release_saved_lease(path)
+
+    def update_save_status(self):
+        text = f"Save queue: {self.mask_writer.queue_depth()}"
+        if self.save_latency is not None:
+            text += f" | save {self.save_latency:.0f} ms"
+        self.save_status_label.setText(text)
+
+    def history_key(self):
+        """当前图像在撤销历史中的键"""
+        return self.entry_paths(self.current_index)[0]
 
     def save_mask_state(self):
+        """开始记录一步对蒙版的修改"""
         if self.mask is not None:
-            self.mask_history.append(self.mask.copy())
+            self.undo_history.begin(self.history_key(), self.mask)
+
+    def before_mask_change(self, rect):
+        """蒙版的 rect 区域即将被修改"""
+        self.awaiting_proposal = None
+        if self.proposal_unreviewed:
+            # 日志从空白蒙版开始重放，第一次修改前先记下模型建议的内容
+            self.record_patch(self.mask.rect())
+            self.proposal_unreviewed = False
+            self.update_image_name_label()
+        self.undo_history.touch(rect)
+        if self.mapped_mask is not None:
+            self.mapped_mask.mark_dirty(rect)
+
+    def finish_mask_change(self):
+        """结束当前这一步修改"""
+        self.undo_history.end()
 
     def undo(self):
-        if len(self.mask_history) > 1:
-            self.mask_history.pop()
-            self.mask = self.mask_history[-1].copy()
-            self.image_label.set_mask(self.mask)
-            self.image_label.update_display()
+        if self.mask is not None:
+            dirty_rect = self.undo_history.undo(self.history_key(), self.mask)
+            if dirty_rect is not None:
+                self.mask_dirty = True
+                if self.mapped_mask is not None:
+                    self.mapped_mask.mark_dirty(dirty_rect)
+                # 日志记录撤销后的内容，重放时不依赖撤销历史
+                self.record_patch(dirty_rect)
+                self.image_label.update_region(dirty_rect)
+
+    def redo(self):
+        if self.mask is not None:
+            dirty_rect = self.undo_history.redo(self.history_key(), self.mask)
+            if dirty_rect is not None:
+                self.mask_dirty = True
+                if self.mapped_mask is not None:
+                    self.mapped_mask.mark_dirty(dirty_rect)
+                self.record_patch(dirty_rect)
+                self.image_label.update_region(dirty_rect)
 
     def clear_annotations(self):
         """清除当前图像的所有标注"""
         if self.mask is not None:
-            # 创建新的空白蒙版
-            self.mask = QImage(self.image.size(), QImage.Format_Grayscale8)
-            self.mask.fill(0)  # 填充黑色（无标注）
-            
-            # 更新 ImageLabel
-            self.image_label.set_mask(self.mask)
-            self.image_label.update_display()
-            
-            # 保存当前状态用于撤销
+            # 作为一步可撤销的修改，就地填充黑色（无标注）
             self.save_mask_state()
+            self.before_mask_change(self.mask.rect())
+            self.mask.fill(0)
+            self.finish_mask_change()
+            self.mask_dirty = True
+            name = self.current_journal_name()
+            if name is not None:
+                self.journal.append('clear', name)
+
+            # 更新 ImageLabel
+            self.image_label.update_region(self.mask.rect())
 
     def keyPressEvent(self, event):
         # 处理快捷键
-        if event.modifiers() == Qt.ControlModifier:
+        if event.modifiers() == Qt.ControlModifier | Qt.ShiftModifier and event.key() == Qt.Key_Z:
+            # Ctrl+Shift+Z: 重做
+            self.redo()
+        elif event.modifiers() == Qt.ControlModifier:
             if event.key() == Qt.Key_Z:
                 # Ctrl+Z: 撤销上一步操作
                 self.undo()
@@ -625,6 +4953,13 @@ class SegmentationTool(QMainWindow):
                 # Ctrl+W: 切换到橡皮擦模式
                 self.eraser_button.setChecked(True)
                 self.set_eraser_mode()
+            elif event.key() == Qt.Key_E and self.fill_button.isEnabled():
+                # Ctrl+E: 切换到超像素填充模式
+                self.fill_button.setChecked(True)
+                self.set_fill_mode()
+        elif self.label_mode and Qt.Key_1 <= event.key() <= Qt.Key_9:
+            # 标签图模式下数字键选择画笔的类别
+            self.class_spinbox.setValue(event.key() - Qt.Key_0)
         # 处理方向键
         elif event.key() == Qt.Key_Left or event.key() == Qt.Key_Up:
             # 左方向键或上方向键：上一张图片
@@ -637,13 +4972,370 @@ class SegmentationTool(QMainWindow):
         else:
             super().keyPressEvent(event)
 
+    def closeEvent(self, event):
+        # 之后才执行的定时回调（推迟的启动工作、预读取调度等）看到该标记后直接返回
+        self.closing = True
+        self.deferred = None
+        self.save_session()
+        self.wait_index_sync()
+        self.stop_stats()
+        self.leave_current_image()
+        # 退出前写完所有排队中的蒙版
+        self.mask_writer.stop()
+        self.close_journal()
+        # 写入队列清空之后再停止导出，退出前的最后一次保存也会写入分片
+        QApplication.sendPostedEvents(self, QEvent.MetaCall)
+        self.set_export(False)
+        if self.thumbnail_loader is not None:
+            self.thumbnail_loader.stop()
+        if self.leases is not None:
+            self.leases.stop()
+        self.prefetcher.shutdown()
+        if self.superpixels is not None:
+            self.superpixels.shutdown()
+        if self.preannotator is not None:
+            self.preannotator.shutdown()
+        self.image_label.clear()
+        self.close_mapped_mask()
+        super().closeEvent(event)
+
     def mousePressEvent(self, event):
         # 当鼠标点击窗口时，确保窗口获得焦点
         self.setFocus()
         super().mousePressEvent(event)
 
+def batch_worker_init():
+    """批处理子进程的初始化：QBitmap/QRegion 需要 QGuiApplication，使用不创建窗口的 offscreen 平台"""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    global _batch_app
+    _batch_app = QGuiApplication.instance() or QGuiApplication(['iw_anno-batch'])
+
+
+def mask_classes(mask):
+    """标签图中出现的非零类别编号（升序）"""
+    bytes_per_line, data = grayscale_bytes(mask, mask.rect())
+    present = set()
+    for y in range(mask.height()):
+        present.update(data[y * bytes_per_line:y * bytes_per_line + mask.width()])
+    present.discard(0)
+    return sorted(present)
+
+
+def mask_polygons(mask, class_id=None):
+    """
+    将蒙版的前景轮廓转换为多边形列表（每个多边形为 [[x, y], ...]，首尾相同）。
+    孔洞作为单独的多边形输出，按奇偶规则填充即可还原蒙版。
+    指定 class_id 时只取标签图中等于该类别的像素。
+    """
+    if class_id is not None:
+        # 把字节按 Indexed8 解释，颜色表只把该类别映射为白色
+        bytes_per_line, data = grayscale_bytes(mask, mask.rect())
+        labels = QImage(data, mask.width(), mask.height(), bytes_per_line, QImage.Format_Indexed8)
+        labels.setColorTable([0xFFFFFFFF if value == class_id else 0xFF000000 for value in range(256)])
+        mask = labels.convertToFormat(QImage.Format_Grayscale8)
+    bits = mask.convertToFormat(QImage.Format_Mono, Qt.ThresholdDither)
+    # 转换后前景为颜色索引 0，而 QBitmap 把索引 1 视为区域内
+    bits.invertPixels()
+    path = QPainterPath()
+    path.addRegion(QRegion(QBitmap.fromImage(bits)))
+    return [
+        [[int(point.x()), int(point.y())] for point in polygon]
+        for polygon in path.simplified().toSubpathPolygons()
+    ]
+
+
+def batch_process(op, image_path, mask_path, options):
+    """
+    在子进程中对单张图像的蒙版执行批处理操作，返回 (状态, 说明)。
+    状态为 'changed'、'unchanged'、'skipped'（没有蒙版，或操作不适用于标签图）或 'failed'。
+    """
+    try:
+        fmt = stored_mask_format(mask_path)
+        if fmt is None:
+            return 'skipped', "no mask"
+        if op == 'contours':
+            mask = read_mask_file(mask_path).convertToFormat(QImage.Format_Grayscale8)
+            stem = image_stem(image_path)
+            data = {'size': [mask.width(), mask.height()]}
+            if options.get('label_mode', False):
+                # 标签图按类别分别输出，避免阈值化丢掉编号小于 128 的类别
+                data['classes'] = {str(class_id): mask_polygons(mask, class_id) for class_id in mask_classes(mask)}
+                count = sum(len(polygons) for polygons in data['classes'].values())
+            else:
+                data['polygons'] = mask_polygons(mask)
+                count = len(data['polygons'])
+            write_bytes_atomic(json.dumps(data, separators=(',', ':')).encode('utf-8'),
+                               os.path.join(options['output'], stem + '.json'))
+            return 'changed', f"{count} polygons"
+        target_fmt = options.get('format') or fmt
+        label_mode = options.get('label_mode', False)
+        if label_mode and (op == 'binarize' or options.get('format') in ('png1', 'rle')):
+            return 'skipped', "label map (multi-class masks cannot be binarised)"
+        if op == 'resize':
+            image_size = read_image_size(image_path)
+            if stored_mask_size(mask_path) == image_size:
+                return 'unchanged', ""
+            # 与 GUI 打开图像时的处理一致：平滑缩放到图像尺寸，标签图按最近邻缩放
+            mask = decode_mask(mask_path, image_size, not label_mode)
+        elif op == 'binarize':
+            mask = read_mask_file(mask_path)
+            if fmt != 'png':
+                return 'unchanged', ""  # 1 位 PNG 与 RLE 本身就是二值的
+            array = qimage_array(mask)
+            if not np.any((array != 0) & (array != 255)):
+                return 'unchanged', ""
+            array[:] = np.where(array >= 128, 255, 0)
+        elif op == 'convert':
+            if fmt == target_fmt and options.get('png_compression', -1) < 0:
+                return 'unchanged', ""
+            mask = read_mask_file(mask_path)
+        else:
+            raise ValueError(f"Unknown batch operation: {op}")
+        save_mask_file(mask, mask_path, target_fmt, options.get('png_compression', -1))
+        return 'changed', ""
+    except Exception as e:
+        return 'failed', str(e)
+
+
+class ConsoleProgress:
+    """在 stderr 的同一行上刷新进度、速率和预计剩余时间，最多每 interval 秒刷新一次"""
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = None
+        self.shown = False
+
+    def __call__(self, done, total):
+        elapsed = time.perf_counter() - self.start
+        if self.last_report is not None and elapsed - self.last_report < self.interval and done < total:
+            return
+        self.last_report = elapsed
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate else 0
+        print(f"\r[{done}/{total}] {rate:.1f} img/s, ETA {eta:.0f}s", end='', file=sys.stderr, flush=True)
+        self.shown = True
+
+    def finish(self):
+        if self.shown:
+            print(file=sys.stderr)
+
+
+def batch_main(argv):
+    """
+    命令行批处理入口：python main.py batch <op> <main_folder> [--jobs N]。
+    在进程池中并行处理 images/ 下的每张图像，完成的条目记入
+    .iw_anno/batch/<op>.jsonl，中断后重新运行会跳过蒙版未再修改的图像。
+    """
+    parser = argparse.ArgumentParser(prog='main.py batch', description="Bulk mask operations without the GUI.")
+    parser.add_argument('op', choices=list(BATCH_OPERATIONS),
+                        help="; ".join(f"{op}: {text}" for op, text in BATCH_OPERATIONS.items()))
+    parser.add_argument('folder', help="main folder containing images/ and masks/")
+    parser.add_argument('--jobs', '-j', type=int, default=BATCH_JOBS, help="worker processes")
+    parser.add_argument('--format', choices=list(MASK_FORMATS),
+                        help="storage format to write (convert: required; other ops: keep each mask's format)")
+    parser.add_argument('--png-compression', type=int, default=-1, choices=range(-1, 10), metavar='0-9',
+                        help="zlib level for PNG output")
+    parser.add_argument('--output', help="directory for contour JSON (default: <folder>/contours)")
+    parser.add_argument('--restart', action='store_true', help="ignore the progress journal and process everything")
+    args = parser.parse_args(argv)
+    if args.op == 'convert' and not args.format:
+        parser.error("convert requires --format")
+    if args.op == 'binarize' and np is None:
+        parser.error("binarize requires NumPy")
+
+    image_folder = os.path.join(args.folder, 'images')
+    mask_folder = os.path.join(args.folder, 'masks')
+    if not os.path.isdir(image_folder):
+        print(f"Image folder does not exist: {image_folder}", file=sys.stderr)
+        return 1
+    options = {'format': args.format, 'png_compression': args.png_compression}
+    if args.op == 'contours':
+        options['output'] = os.path.abspath(args.output or os.path.join(args.folder, 'contours'))
+        os.makedirs(options['output'], exist_ok=True)
+
+    index = DatasetIndex(args.folder)
+    index.sync(image_folder, mask_folder)
+    names = index.names()
+    # 标签图的像素值是类别编号，不能插值，也不能保存为只能表示二值的格式
+    options['label_mode'] = index.get_meta('label_mode') == '1'
+    index.close()
+
+    # 进度日志：选项相同且蒙版修改时间与记录一致的图像视为已完成
+    journal_path = app_data_path(args.folder, 'batch', f"{args.op}.jsonl")
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    signature = json.dumps(options, sort_keys=True)
+    finished = {}
+    if args.restart and os.path.exists(journal_path):
+        os.remove(journal_path)
+    elif os.path.exists(journal_path):
+        with open(journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 中断时写了一半的行
+                if entry.get('options') == signature:
+                    finished[entry['name']] = entry['mask_mtime_ns']
+
+    def mask_path_for(name):
+        return os.path.join(mask_folder, os.path.splitext(name)[0] + '.png')
+
+    todo = [name for name in names if name not in finished or finished[name] != mask_mtime_ns(mask_path_for(name))]
+    print(f"{args.op}: {len(todo)} of {len(names)} images to process "
+          f"({len(names) - len(todo)} already done), {args.jobs} jobs", file=sys.stderr)
+    if not todo:
+        return 0
+
+    counts = dict.fromkeys(('changed', 'unchanged', 'skipped', 'failed'), 0)
+    progress = ConsoleProgress()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=context, initializer=batch_worker_init) as pool, \
+            open(journal_path, 'a', encoding='utf-8') as journal:
+        # 分块提交减少进程间通信次数，块不宜过大以保证负载均衡
+        chunksize = max(1, min(32, len(todo) // (args.jobs * 8)))
+        results = pool.map(
+            batch_process, itertools.repeat(args.op),
+            [os.path.join(image_folder, name) for name in todo], [mask_path_for(name) for name in todo],
+            itertools.repeat(options), chunksize=chunksize
+        )
+        try:
+            for done, (name, (status, detail)) in enumerate(zip(todo, results), 1):
+                counts[status] += 1
+                if status == 'failed':
+                    print(f"\n{name}: {detail}", file=sys.stderr)
+                else:
+                    journal.write(json.dumps({
+                        'name': name, 'options': signature, 'mask_mtime_ns': mask_mtime_ns(mask_path_for(name))
+                    }) + '\n')
+                    journal.flush()
+                progress(done, len(todo))
+        except KeyboardInterrupt:
+            print("\nInterrupted; rerun the same command to resume.", file=sys.stderr)
+            pool.shutdown(wait=False, cancel_futures=True)
+            return 130
+    progress.finish()
+    print(", ".join(f"{status}: {count}" for status, count in counts.items()), file=sys.stderr)
+    return 1 if counts['failed'] else 0
+
+
+def report_main(argv):
+    """
+    命令行质检报告：python main.py report <main_folder>。
+    增量更新统计缓存后输出各类标记的数量及对应图像，可用 --json 导出逐图结果。
+    """
+    parser = argparse.ArgumentParser(prog='main.py report', description="Dataset QA and coverage statistics.")
+    parser.add_argument('folder', help="main folder containing images/ and masks/")
+    parser.add_argument('--jobs', '-j', type=int, default=BATCH_JOBS, help="worker processes")
+    parser.add_argument('--json', help="write per-image statistics and flags to this file")
+    parser.add_argument('--limit', type=int, default=10, help="flagged images to list per flag (0 lists all)")
+    args = parser.parse_args(argv)
+    if np is None:
+        parser.error("report requires NumPy")
+
+    image_folder = os.path.join(args.folder, 'images')
+    mask_folder = os.path.join(args.folder, 'masks')
+    if not os.path.isdir(image_folder):
+        print(f"Image folder does not exist: {image_folder}", file=sys.stderr)
+        return 1
+    index = DatasetIndex(args.folder)
+    index.sync(image_folder, mask_folder)
+    names = index.names()
+    label_mode = index.get_meta('label_mode') == '1'
+    index.close()
+    stats = DatasetStats(args.folder)
+    progress = ConsoleProgress()
+    updated = stats.update(image_folder, mask_folder, names, args.jobs, progress, label_mode=label_mode)
+    progress.finish()
+    records = stats.records()
+    stats.close()
+
+    print(f"{len(names)} images, {updated} re-analysed")
+    coverage = [records[name]['foreground'] for name in names if records[name]['foreground'] is not None]
+    if coverage:
+        print(f"coverage: mean {sum(coverage) / len(coverage):.2%}, "
+              f"median {sorted(coverage)[len(coverage) // 2]:.2%}, "
+              f"min {min(coverage):.2%}, max {max(coverage):.2%}")
+    if label_mode:
+        classes = Counter(value for name in names for value in records[name]['classes'] or ())
+        if classes:
+            print("classes: " + ", ".join(f"{value} ({count} images)" for value, count in sorted(classes.items())))
+    failed = [name for name in names if records[name]['error']]
+    for flag, title in list(QA_FLAGS.items()) + [('error', "Unreadable")]:
+        flagged = failed if flag == 'error' else [name for name in names if flag in records[name]['flags']]
+        if not flagged:
+            continue
+        print(f"{title}: {len(flagged)}")
+        for name in flagged[:args.limit or None]:
+            print(f"    {name}")
+        if args.limit and len(flagged) > args.limit:
+            print(f"    ... {len(flagged) - args.limit} more")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({name: records[name] for name in names}, f, indent=1)
+    return 0
+
+
+def export_main(argv):
+    """
+    命令行导出：python main.py export <main_folder>。把有蒙版的图像与上次导出对齐，
+    只重写新增、修改或删除的样本所在的 tar 分片，并更新 manifest.json。
+    """
+    parser = argparse.ArgumentParser(prog='main.py export', description="Export annotations into tar shards.")
+    parser.add_argument('folder', help="main folder containing images/ and masks/")
+    parser.add_argument('--output', help="export directory (default: <folder>/export)")
+    parser.add_argument('--shard-size', type=int, default=EXPORT_SHARD_SAMPLES,
+                        help="samples per shard for a new export")
+    parser.add_argument('--rebuild', action='store_true', help="rewrite every shard")
+    args = parser.parse_args(argv)
+
+    image_folder = os.path.join(args.folder, 'images')
+    mask_folder = os.path.join(args.folder, 'masks')
+    if not os.path.isdir(image_folder):
+        print(f"Image folder does not exist: {image_folder}", file=sys.stderr)
+        return 1
+    index = DatasetIndex(args.folder)
+    index.sync(image_folder, mask_folder)
+    names = index.annotated()
+    index.close()
+    exporter = ShardExporter(args.folder, args.output, args.shard_size)
+    if exporter.shard_size != args.shard_size:
+        print(f"Keeping the existing shard size of {exporter.shard_size}; "
+              f"delete {exporter.output} to export with a different size.", file=sys.stderr)
+    changed = exporter.sync(names)
+    if args.rebuild:
+        exporter.rebuild_all()
+    progress = ConsoleProgress()
+    rewritten = exporter.flush(progress)
+    progress.finish()
+    exporter.stop()
+    print(f"{len(names)} annotated images, {changed} changed, {rewritten} shard(s) rewritten in {exporter.output}")
+    return 0
+
+
+def configure_profiler(argv):
+    """
+    根据 IW_ANNO_TRACE 环境变量及 --trace [PATH]、--hud 参数开启性能跟踪，
+    返回去掉这些参数后的 argv 以及是否显示 HUD。
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--trace', nargs='?', const=TRACE_DEFAULT_PATH)
+    parser.add_argument('--hud', action='store_true')
+    args, rest = parser.parse_known_args(argv[1:])
+    trace = args.trace or os.environ.get(TRACE_ENV)
+    if trace:
+        PROFILER.enable(TRACE_DEFAULT_PATH if trace == '1' else trace)
+    return argv[:1] + rest, args.hud
+
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    # 打包后的程序启动超像素子进程时需要
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] in ('batch', 'report', 'export'):
+        sys.exit({'batch': batch_main, 'report': report_main, 'export': export_main}[sys.argv[1]](sys.argv[2:]))
+    argv, show_hud = configure_profiler(sys.argv)
+    app = QApplication(argv)
     window = SegmentationTool()
+    window.set_hud_visible(show_hud)
     window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+from PyQt5.QtCore import QPoint
+from PyQt5.QtGui import QColor, QImage
+
+import main
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def open_window(folder):
+    window = main.SegmentationTool(session=False)
+    window.show()
+    window.auto_save_checkbox.setChecked(False)
+    window.open_folder(str(folder))
+    return window
+
+
+def test_clean_close_does_not_replay_unsaved_edits(app, tmp_path):
+    os.makedirs(tmp_path / 'images')
+    image = QImage(64, 48, QImage.Format_RGB32)
+    image.fill(QColor(128, 128, 128))
+    image.save(str(tmp_path / 'images' / 'img0.png'))
+
+    window = open_window(tmp_path)
+    points = [QPoint(10, 10), QPoint(40, 30)]
+    main.draw_stroke(window.mask, points, 8, QColor(255, 255, 255))
+    window.mask_dirty = True
+    window.record_stroke(points, 8, False)
+    window.close()
+    assert os.listdir(tmp_path / 'masks') == []
+
+    window = open_window(tmp_path)
+    window.close()
+    assert os.listdir(tmp_path / 'masks') == []